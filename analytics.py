@@ -0,0 +1,300 @@
+"""
+Аналитика по истории XP и активности на NumPy
+daily_actions (вместе со свёрнутыми daily_xp_rollups) или logs читаются пачками по ключу
+и сразу сворачиваются до пар (пользователь, день) — память ограничена числом таких пар,
+а не числом строк. Метрики считаются векторно по этим массивам
+Запуск: python analytics.py [daily_actions|logs]
+"""
+import os
+import sys
+
+import numpy as np
+
+import database
+
+# Сколько строк читать из БД за раз
+CHUNK_ROWS = int(os.getenv('ANALYTICS_CHUNK_ROWS', '200000'))
+
+# Дни храним как число дней от 1970-01-01; julianday('1970-01-01') = 2440587.5
+_EPOCH_JULIAN = 2440587.5
+_EPOCH = np.datetime64('1970-01-01', 'D')
+# Пара (пользователь, день) упаковывается в одно int64: user_id << 20 | день
+_DAY_BITS = 20
+_DAY_MASK = (1 << _DAY_BITS) - 1
+
+# Запросы пачек: первая колонка — ключ обхода, затем user_id, день, XP, число действий, тип действия;
+# вторым элементом — колонка даты для фильтра since. Строки без пользователя или даты (NULL или не разбирается) пропускаются
+_SOURCES = {
+    'daily_actions': (
+        f'''SELECT id, user_id, CAST(julianday(action_date) - {_EPOCH_JULIAN} AS INTEGER),
+                   COALESCE(xp_earned, 0), COALESCE(count, 1), COALESCE(action_type, '')
+            FROM daily_actions
+            WHERE id > ? AND user_id IS NOT NULL AND julianday(action_date) IS NOT NULL {{since}}
+            ORDER BY id LIMIT ?''',
+        'action_date',
+    ),
+    'daily_xp_rollups': (
+        f'''SELECT rowid, user_id, CAST(julianday(action_date) - {_EPOCH_JULIAN} AS INTEGER),
+                   xp_earned, actions, action_type
+            FROM daily_xp_rollups
+            WHERE rowid > ? AND julianday(action_date) IS NOT NULL {{since}}
+            ORDER BY rowid LIMIT ?''',
+        'action_date',
+    ),
+    'logs': (
+        f'''SELECT id, user_id, CAST(julianday(created_at) - {_EPOCH_JULIAN} AS INTEGER),
+                   0, 1, COALESCE(action_type, '')
+            FROM logs
+            WHERE id > ? AND user_id IS NOT NULL AND julianday(created_at) IS NOT NULL {{since}}
+            ORDER BY id LIMIT ?''',
+        'created_at',
+    ),
+}
+
+
+def to_dates(days: np.ndarray) -> np.ndarray:
+    """Дни от 1970-01-01 в datetime64[D]"""
+    return _EPOCH + days.astype('timedelta64[D]')
+
+
+def iter_columns(query: str, params: tuple = (), chunk_rows: int = CHUNK_ROWS):
+    """
+    Keyset-обход запроса пачками: на каждую пачку — кортеж колонок (список значений на колонку)
+    Первый параметр запроса — последний прочитанный ключ, последний — LIMIT, между ними params
+    Соединение берётся из пула только на время чтения пачки
+    """
+    last = -1
+    while True:
+        with database.get_connection() as conn:
+            rows = conn.execute(query, (last, *params, chunk_rows)).fetchall()
+        if not rows:
+            return
+        yield tuple(zip(*rows))
+        if len(rows) < chunk_rows:
+            return
+        last = rows[-1][0]
+
+
+def _reduce(keys: np.ndarray, *values: np.ndarray) -> tuple:
+    """Сложить values по одинаковым keys: (уникальные ключи по возрастанию, суммы...)"""
+    unique, inverse = np.unique(keys, return_inverse=True)
+    sums = (np.bincount(inverse, weights=value, minlength=len(unique)).astype(np.int64) for value in values)
+    return (unique, *sums)
+
+
+class _CodeBook:
+    """Коды строк (типов действий), общие для всех пачек"""
+
+    def __init__(self):
+        self.codes = {}
+
+    def encode(self, values) -> np.ndarray:
+        unique, inverse = np.unique(np.asarray(values, dtype=str), return_inverse=True)
+        # Цикл только по различным значениям пачки, не по строкам
+        lut = np.array([self.codes.setdefault(value, len(self.codes)) for value in unique.tolist()], dtype=np.int64)
+        return lut[inverse]
+
+    def names(self) -> list:
+        return sorted(self.codes, key=self.codes.get)
+
+
+class Activity:
+    """
+    Активность, свёрнутая до пар (пользователь, день), отсортированных по пользователю и дню:
+    user_ids, days (дни от 1970-01-01), xp, actions; плюс итоги по типам действий
+    """
+
+    def __init__(self, user_ids, days, xp, actions, action_types, action_counts, action_xp):
+        self.user_ids = user_ids
+        self.days = days
+        self.xp = xp
+        self.actions = actions
+        self.action_types = action_types
+        self.action_counts = action_counts
+        self.action_xp = action_xp
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    @property
+    def first_day(self) -> int:
+        return int(self.days.min())
+
+    @property
+    def last_day(self) -> int:
+        return int(self.days.max())
+
+    def xp_series(self, user_id: int) -> tuple:
+        """XP пользователя по дням активности: (даты, xp)"""
+        start, stop = np.searchsorted(self.user_ids, [user_id, user_id + 1])
+        return to_dates(self.days[start:stop]), self.xp[start:stop]
+
+    def xp_by_day(self) -> tuple:
+        """XP всех пользователей по дням, без пропусков: (даты, xp)"""
+        if not len(self):
+            return to_dates(np.array([], dtype=np.int64)), np.array([], dtype=np.int64)
+        offset = self.days - self.first_day
+        xp = np.bincount(offset, weights=self.xp).astype(np.int64)
+        return to_dates(np.arange(self.first_day, self.last_day + 1)), xp
+
+    def active_users(self, window: int = 1) -> tuple:
+        """
+        Уникальные активные пользователи за скользящее окно window дней на каждый день: (даты, число)
+        window=1 — DAU, 7 — WAU, 30 — MAU
+        День d у пользователя покрывает окна, заканчивающиеся в [d, d + window - 1]; чтобы не считать
+        пользователя дважды, покрытие начинается после конца покрытия его предыдущего активного дня
+        """
+        if not len(self):
+            return to_dates(np.array([], dtype=np.int64)), np.array([], dtype=np.int64)
+        first, span = self.first_day, self.last_day - self.first_day + 1
+        days = self.days - first
+        start = days.copy()
+        same_user = np.empty(len(days), dtype=bool)
+        same_user[0] = False
+        same_user[1:] = self.user_ids[1:] == self.user_ids[:-1]
+        start[1:] = np.where(same_user[1:], np.maximum(days[1:], days[:-1] + window), days[1:])
+        end = np.minimum(days + window - 1, span - 1)
+        valid = start <= end
+        delta = np.bincount(start[valid], minlength=span + 1) - np.bincount(end[valid] + 1, minlength=span + 1)
+        return to_dates(np.arange(first, first + span)), np.cumsum(delta)[:span]
+
+    def active_summary(self) -> dict:
+        """DAU, WAU и MAU на последний день данных"""
+        if not len(self):
+            return {'date': None, 'dau': 0, 'wau': 0, 'mau': 0}
+        dates, dau = self.active_users(1)
+        return {
+            'date': str(dates[-1]),
+            'dau': int(dau[-1]),
+            'wau': int(self.active_users(7)[1][-1]),
+            'mau': int(self.active_users(30)[1][-1]),
+        }
+
+    def retention_cohorts(self, period: int = 7, periods: int = 12) -> dict:
+        """
+        Когорты по периоду первой активности (period дней): размер когорты и доля пользователей,
+        активных через 0, 1, … periods-1 периодов. retention[i, k] — NaN, если период ещё не наступил
+        """
+        if not len(self):
+            return {'cohorts': to_dates(np.array([], dtype=np.int64)), 'sizes': np.array([], dtype=np.int64),
+                    'retention': np.zeros((0, periods))}
+        bucket = (self.days - self.first_day) // period
+        pairs = np.unique((self.user_ids << _DAY_BITS) | bucket)
+        users, buckets = pairs >> _DAY_BITS, pairs & _DAY_MASK
+        starts = np.flatnonzero(np.r_[True, users[1:] != users[:-1]])
+        first_bucket = np.repeat(buckets[starts], np.diff(np.r_[starts, len(users)]))
+        offset = buckets - first_bucket
+        total = int(buckets.max()) + 1
+        keep = offset < periods
+        counts = np.bincount(first_bucket[keep] * periods + offset[keep],
+                             minlength=total * periods).reshape(total, periods)
+        sizes = counts[:, 0]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            retention = counts / sizes[:, None]
+        # Периоды, которые для когорты ещё не наступили
+        retention[np.arange(periods)[None, :] > (total - 1 - np.arange(total))[:, None]] = np.nan
+        return {
+            'cohorts': to_dates(self.first_day + np.arange(total) * period),
+            'sizes': sizes,
+            'retention': retention,
+        }
+
+    def action_distribution(self) -> dict:
+        """{тип действия: {'actions', 'xp', 'share'}} по убыванию числа действий"""
+        total = int(self.action_counts.sum()) or 1
+        order = np.argsort(-self.action_counts, kind='stable')
+        return {
+            self.action_types[i]: {
+                'actions': int(self.action_counts[i]),
+                'xp': int(self.action_xp[i]),
+                'share': float(self.action_counts[i] / total),
+            }
+            for i in order
+        }
+
+
+def load_activity(source: str = 'daily_actions', since: str = None, include_rollups: bool = True,
+                  chunk_rows: int = CHUNK_ROWS) -> Activity:
+    """
+    Прочитать daily_actions (и daily_xp_rollups, если include_rollups) или logs пачками
+    и свернуть до пар (пользователь, день). since — 'YYYY-MM-DD', с какого дня читать
+    """
+    if source == 'daily_actions':
+        queries = [_SOURCES['daily_actions']] + ([_SOURCES['daily_xp_rollups']] if include_rollups else [])
+    elif source == 'logs':
+        queries = [_SOURCES['logs']]
+    else:
+        raise ValueError(f"Неизвестный источник: {source}")
+
+    codebook = _CodeBook()
+    parts, pending = [], 0
+    action_counts = np.zeros(0, dtype=np.int64)
+    action_xp = np.zeros(0, dtype=np.int64)
+
+    def merge(parts: list) -> list:
+        keys, xp, actions = (np.concatenate(column) for column in zip(*parts))
+        return [_reduce(keys, xp, actions)]
+
+    for query, date_column in queries:
+        query = query.format(since=f'AND {date_column} >= ?' if since else '')
+        for columns in iter_columns(query, (since,) if since else (), chunk_rows):
+            user_ids = np.array(columns[1], dtype=np.int64)
+            days = np.array(columns[2], dtype=np.int64)
+            xp = np.array(columns[3], dtype=np.int64)
+            actions = np.array(columns[4], dtype=np.int64)
+            codes = codebook.encode(columns[5])
+
+            size = len(codebook.codes)
+            action_counts = np.pad(action_counts, (0, size - len(action_counts)))
+            action_xp = np.pad(action_xp, (0, size - len(action_xp)))
+            action_counts += np.bincount(codes, weights=actions, minlength=size).astype(np.int64)
+            action_xp += np.bincount(codes, weights=xp, minlength=size).astype(np.int64)
+
+            parts.append(_reduce((user_ids << _DAY_BITS) | days, xp, actions))
+            pending += len(user_ids)
+            # Сливаем частичные свёртки, чтобы их суммарный размер не рос быстрее числа пар
+            if pending >= 4 * chunk_rows and len(parts) > 1:
+                parts, pending = merge(parts), 0
+
+    if not parts:
+        empty = np.array([], dtype=np.int64)
+        return Activity(empty, empty, empty, empty, [], empty, empty)
+    keys, xp, actions = merge(parts)[0] if len(parts) > 1 else parts[0]
+    return Activity(keys >> _DAY_BITS, keys & _DAY_MASK, xp, actions,
+                    codebook.names(), action_counts, action_xp)
+
+
+def level_histogram(chunk_rows: int = CHUNK_ROWS) -> tuple:
+    """Число пользователей на каждом уровне: (уровни с 1, число)"""
+    counts = np.zeros(2, dtype=np.int64)
+    query = 'SELECT user_id, COALESCE(level, 1) FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?'
+    for columns in iter_columns(query, chunk_rows=chunk_rows):
+        chunk = np.bincount(np.array(columns[1], dtype=np.int64))
+        if len(chunk) > len(counts):
+            counts = np.pad(counts, (0, len(chunk) - len(counts)))
+        counts[:len(chunk)] += chunk
+    return np.arange(1, len(counts)), counts[1:]
+
+
+def report(source: str = 'daily_actions') -> dict:
+    """Сводка для админки: активность, распределение действий, уровни, последние когорты"""
+    activity = load_activity(source)
+    levels, level_counts = level_histogram()
+    cohorts = activity.retention_cohorts(periods=4)
+    return {
+        'pairs': len(activity),
+        'active': activity.active_summary(),
+        'actions': activity.action_distribution(),
+        'levels': {int(level): int(count) for level, count in zip(levels, level_counts) if count},
+        'cohorts': [
+            {'week': str(week), 'size': int(size),
+             'retention': [None if np.isnan(rate) else round(float(rate), 3) for rate in rates]}
+            for week, size, rates in zip(cohorts['cohorts'][-8:], cohorts['sizes'][-8:], cohorts['retention'][-8:])
+        ],
+    }
+
+
+if __name__ == "__main__":
+    import json
+    database.init_db()
+    print(json.dumps(report(sys.argv[1] if len(sys.argv) > 1 else 'daily_actions'), ensure_ascii=False, indent=2))
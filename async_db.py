@@ -0,0 +1,91 @@
+"""
+Асинхронный доступ к базе для aiogram-бота
+Те же функции, что в database.py, но awaitable: await async_db.add_xp(...)
+Записи идут через один поток-писатель (без гонок за блокировку и 'database is locked'),
+чтения — через пул потоков-читателей (WAL не блокирует их записью).
+database.py остаётся синхронным для web_server.py
+"""
+import asyncio
+import functools
+import itertools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import database
+
+DB_READERS = int(os.getenv('DB_READERS', '4'))
+
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+_readers = ThreadPoolExecutor(max_workers=DB_READERS, thread_name_prefix='db-reader')
+
+READ_FUNCTIONS = (
+    'get_setting', 'get_data_version', 'get_schema_version',
+    'get_user', 'is_admin', 'get_admin_ids',
+    'get_level_progress', 'get_level_rewards', 'get_level_table', 'get_user_rank', 'get_leaderboard',
+    'get_pending_reminders', 'get_pre_notify_reminders', 'get_upcoming_reminders',
+    'get_all_reminders', 'get_reminder_by_id',
+    'get_all_notes', 'get_note_by_id',
+    'get_all_habits', 'get_habit_by_id',
+    'get_user_stats', 'get_users_stats', 'get_global_stats', 'get_global_stats_history', 'check_user_stats',
+    'get_all_logs', 'get_user_logs', 'get_logs_count', 'get_logs_page', 'count_logs',
+    'get_users_with_stats_page', 'get_all_users_with_stats',
+    'get_heartbeats', 'get_db_size',
+)
+
+WRITE_FUNCTIONS = (
+    'init_db', 'migrate', 'set_setting',
+    'add_user', 'set_admin', 'reset_daily_xp', 'check_daily_limit', 'update_timezone',
+    'add_xp',
+    'add_reminder', 'complete_reminder', 'delete_reminder', 'mark_notified', 'mark_pre_notified',
+    'claim_reminders', 'claim_due_reminders', 'ack_reminders', 'release_reminders', 'release_stale_claims',
+    'add_note', 'delete_note', 'toggle_pin_note',
+    'add_habit', 'complete_habit', 'delete_habit',
+    'add_log', 'insert_logs', 'repair_user_stats',
+    'record_heartbeat', 'snapshot_global_stats',
+)
+
+# Чистые функции без I/O — вызываются как есть
+get_xp_for_level = database.get_xp_for_level
+get_settings_cache_stats = database.get_settings_cache_stats
+
+
+def _wrap(func, executor):
+    """Awaitable-обёртка: вызвать func в executor, не блокируя event loop"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+    return wrapper
+
+
+for _name in READ_FUNCTIONS:
+    globals()[_name] = _wrap(getattr(database, _name), _readers)
+for _name in WRITE_FUNCTIONS:
+    globals()[_name] = _wrap(getattr(database, _name), _writer)
+
+
+async def _aiter_batches(generator, batch_size: int):
+    """Асинхронный обход синхронного генератора: пачка за один переход в поток-читатель"""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = await loop.run_in_executor(_readers, lambda: list(itertools.islice(generator, batch_size)))
+        for item in batch:
+            yield item
+        if len(batch) < batch_size:
+            return
+
+
+def iter_logs(batch_size: int = 1000, **filters):
+    """async for log in iter_logs(...): логи от старых к новым"""
+    return _aiter_batches(database.iter_logs(batch_size, **filters), batch_size)
+
+
+def iter_users_with_stats(batch_size: int = 500):
+    """async for user in iter_users_with_stats(): пользователи по убыванию XP"""
+    return _aiter_batches(database.iter_users_with_stats(batch_size), batch_size)
+
+
+def shutdown(wait: bool = True):
+    """Остановить потоки доступа к базе (при остановке бота)"""
+    _writer.shutdown(wait=wait)
+    _readers.shutdown(wait=wait)
@@ -0,0 +1,930 @@
+"""
+Бенчмарки для базы данных и API
+Запуск: python bench.py <сценарий> [--ops N]
+Каждый сценарий работает на временной копии БД и не трогает assistant.db
+"""
+import argparse
+import asyncio
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import database
+import log_writer
+
+
+def use_temp_db(tmp_dir: str) -> Path:
+    """Переключить database.py на временную БД и создать схему"""
+    database.DB_PATH = Path(tmp_dir) / "bench.db"
+    database.init_db()
+    return database.DB_PATH
+
+
+def report(name: str, ops: int, elapsed: float):
+    """Напечатать результат замера"""
+    print(f"{name:<40} {ops / elapsed:>12,.0f} ops/sec  ({elapsed:.3f} s)")
+
+
+def timed(name: str, ops: int, func):
+    """Выполнить func(i) ops раз и напечатать ops/sec"""
+    start = time.perf_counter()
+    for i in range(ops):
+        func(i)
+    elapsed = time.perf_counter() - start
+    report(name, ops, elapsed)
+    return ops / elapsed
+
+
+# ========== Сценарии ==========
+
+def bench_pool(ops: int):
+    """Соединение на каждый вызов против общего пула"""
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = use_temp_db(tmp)
+        for user_id in range(1, 101):
+            database.add_user(user_id, f"user{user_id}")
+
+        def old_get_user(i):
+            conn = sqlite3.connect(db_path)
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM users WHERE user_id = ?', (i % 100 + 1,))
+            cursor.fetchone()
+            conn.close()
+
+        def old_set_timezone(i):
+            conn = sqlite3.connect(db_path)
+            cursor = conn.cursor()
+            cursor.execute('UPDATE users SET timezone = ? WHERE user_id = ?', ('UTC', i % 100 + 1))
+            conn.commit()
+            conn.close()
+
+        old_read = timed("get_user: connect на вызов", ops, old_get_user)
+        new_read = timed("get_user: пул", ops, lambda i: database.get_user(i % 100 + 1))
+        old_write = timed("update_timezone: connect на вызов", ops, old_set_timezone)
+        new_write = timed("update_timezone: пул", ops, lambda i: database.update_timezone(i % 100 + 1, 'UTC'))
+        print(f"Ускорение чтения: x{new_read / old_read:.1f}, записи: x{new_write / old_write:.1f}")
+        database.close_connections()
+
+
+def bench_xp(ops: int, threads: int = 8):
+    """Параллельные начисления XP: пропускная способность и соблюдение дневного лимита"""
+    with tempfile.TemporaryDirectory() as tmp:
+        use_temp_db(tmp)
+        users = 50
+        for user_id in range(1, users + 1):
+            database.add_user(user_id, f"user{user_id}")
+
+        def award_many(worker: int, count: int):
+            for i in range(count):
+                database.add_xp((worker * count + i) % users + 1, 1, 'bench')
+
+        def run(name: str, total: int):
+            per_thread = total // threads
+            pool = [threading.Thread(target=award_many, args=(w, per_thread)) for w in range(threads)]
+            start = time.perf_counter()
+            for t in pool:
+                t.start()
+            for t in pool:
+                t.join()
+            report(name, per_thread * threads, time.perf_counter() - start)
+
+        # Пропускная способность без упора в лимит
+        database.set_setting('daily_xp_limit', str(ops))
+        run(f"add_xp, {threads} потоков", ops)
+
+        # Лимит под нагрузкой: все потоки бьют в одного пользователя
+        limit = 100
+        database.add_user(0, "hot")
+        database.set_setting('daily_xp_limit', str(limit))
+        per_thread = ops // threads
+        pool = [threading.Thread(target=lambda: [database.add_xp(0, 7, 'bench') for _ in range(per_thread)])
+                for _ in range(threads)]
+        for t in pool:
+            t.start()
+        for t in pool:
+            t.join()
+        daily = database.get_user(0)['daily_xp']
+        print(f"Горячий пользователь: daily_xp={daily}, лимит={limit}, "
+              f"{'OK' if daily <= limit else 'ПРЕВЫШЕН'}")
+        database.close_connections()
+
+
+def bench_logs(ops: int):
+    """Синхронный add_log против фонового писателя пачками"""
+    with tempfile.TemporaryDirectory() as tmp:
+        use_temp_db(tmp)
+        args = lambda i: (i % 100, f"user{i % 100}", 1, 10, 'bench', f"data {i}")
+        timed("add_log: синхронно", ops, lambda i: database.add_log(*args(i)))
+
+        writer = log_writer.LogWriter(max_queue=ops).start()
+        start = time.perf_counter()
+        for i in range(ops):
+            database.add_log(*args(i))
+        enqueued = time.perf_counter() - start
+        writer.stop()
+        total = time.perf_counter() - start
+        report("add_log: постановка в очередь", ops, enqueued)
+        report("add_log: очередь + запись в БД", ops, total)
+        metrics = writer.metrics()
+        print(f"Пачек: {metrics['flushes']}, средний сброс {metrics['avg_flush_ms']:.2f} ms, "
+              f"макс. {metrics['max_flush_ms']:.2f} ms, записано {metrics['written']}, "
+              f"в БД {database.get_logs_count()}")
+        database.close_connections()
+
+
+def bench_dispatch(ops: int):
+    """Диспетчер напоминаний: задержка срабатывания, перезапуск посреди работы, отсутствие дублей"""
+    from collections import Counter
+    from datetime import timedelta
+
+    import reminder_dispatcher
+
+    with tempfile.TemporaryDirectory() as tmp:
+        use_temp_db(tmp)
+        fired = Counter()
+        lateness = []
+
+        async def send(reminder):
+            fired[reminder['id']] += 1
+            due = reminder_dispatcher.parse_remind_at(reminder['remind_at'])
+            lateness.append((reminder_dispatcher.utcnow() - due).total_seconds())
+
+        async def pre_notify(reminder):
+            pass
+
+        async def main():
+            start = reminder_dispatcher.utcnow()
+            ids = [database.add_reminder(i % 50, 'bench', start + timedelta(seconds=1 + 2 * i / ops))
+                   for i in range(ops)]
+            deleted = set(ids[::10])
+
+            for restart in range(2):
+                dispatcher = reminder_dispatcher.ReminderDispatcher(send, pre_notify)
+                task = asyncio.create_task(dispatcher.run())
+                await asyncio.sleep(0.2)
+                if restart == 0:
+                    for reminder_id in deleted:
+                        await asyncio.to_thread(database.delete_reminder, reminder_id)
+                    late_id = await asyncio.to_thread(
+                        database.add_reminder, 1, 'late', reminder_dispatcher.utcnow() + timedelta(seconds=0.5))
+                await asyncio.sleep(1.0)
+                dispatcher.stop()
+                await task
+            dispatcher = reminder_dispatcher.ReminderDispatcher(send, pre_notify)
+            task = asyncio.create_task(dispatcher.run())
+            await asyncio.sleep(2.5)
+            dispatcher.stop()
+            await task
+            return set(ids) - deleted | {late_id}, deleted
+
+        expected, deleted = asyncio.run(main())
+        duplicates = [rid for rid, count in fired.items() if count > 1]
+        missing = expected - set(fired)
+        lateness.sort()
+        print(f"Сработало {len(fired)} из {len(expected)}, дублей {len(duplicates)}, "
+              f"пропущено {len(missing)}, удалённых сработало {len(deleted & set(fired))}")
+        print(f"Опоздание: p50 {lateness[len(lateness) // 2] * 1000:.1f} ms, "
+              f"p99 {lateness[int(len(lateness) * 0.99)] * 1000:.1f} ms")
+        database.close_connections()
+        if duplicates or missing:
+            raise SystemExit("Диспетчер отправил дубли или пропустил напоминания")
+
+
+def bench_claim(ops: int, threads: int = 4):
+    """SELECT + mark_notified на каждое напоминание против claim_due_reminders пачками"""
+    from datetime import datetime, timedelta
+
+    with tempfile.TemporaryDirectory() as tmp:
+        use_temp_db(tmp)
+        past = datetime.utcnow() - timedelta(minutes=5)
+
+        def fill():
+            with database.transaction() as conn:
+                conn.executemany('INSERT INTO reminders (user_id, title, remind_at) VALUES (?, ?, ?)',
+                                 ((i % 100, 'bench', past) for i in range(ops)))
+
+        fill()
+        start = time.perf_counter()
+        for reminder in database.get_pending_reminders():
+            database.mark_notified(reminder['id'])
+        report("get_pending + mark_notified", ops, time.perf_counter() - start)
+
+        fill()
+        claimed = []
+
+        def worker():
+            while True:
+                batch = database.claim_due_reminders(200)
+                if not batch:
+                    return
+                database.ack_reminders([reminder['id'] for reminder in batch])
+                claimed.extend(reminder['id'] for reminder in batch)
+
+        pool = [threading.Thread(target=worker) for _ in range(threads)]
+        start = time.perf_counter()
+        for t in pool:
+            t.start()
+        for t in pool:
+            t.join()
+        report(f"claim_due_reminders + ack, {threads} потока", ops, time.perf_counter() - start)
+        print(f"Захвачено {len(claimed)}, уникальных {len(set(claimed))} из {ops}")
+        database.close_connections()
+
+
+async def start_fake_bot_api(latency: float = 0.02, rate_limit_every: int = 50):
+    """
+    Локальный фейковый Bot API: отвечает на sendMessage через latency секунд,
+    каждый rate_limit_every-й запрос получает 429 с retry_after=1
+    Возвращает (runner, base_url, счётчик запросов)
+    """
+    from aiohttp import web
+
+    calls = {'total': 0, 'ok': 0, '429': 0}
+
+    async def send_message(request):
+        calls['total'] += 1
+        data = await request.post()
+        await asyncio.sleep(latency)
+        if rate_limit_every and calls['total'] % rate_limit_every == 0:
+            calls['429'] += 1
+            return web.json_response({'ok': False, 'error_code': 429,
+                                      'description': 'Too Many Requests: retry after 1',
+                                      'parameters': {'retry_after': 1}})
+        calls['ok'] += 1
+        return web.json_response({'ok': True, 'result': {
+            'message_id': calls['ok'], 'date': int(time.time()),
+            'chat': {'id': int(data['chat_id']), 'type': 'private'}, 'text': data.get('text', '')}})
+
+    app = web.Application()
+    app.router.add_post('/bot{token}/sendMessage', send_message)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}", calls
+
+
+def bench_delivery(ops: int, chats: int = 200):
+    """Последовательная отправка против DeliveryPipeline на фейковом Bot API"""
+    import delivery
+    from reminder_dispatcher import utcnow
+
+    async def main():
+        runner, base_url, calls = await start_fake_bot_api()
+        bot = delivery.create_bot('123456:TEST', base_url)
+        due = utcnow()
+        reminders = [{'id': i, 'user_id': i % chats + 1, 'title': f"bench {i}", 'remind_at': due}
+                     for i in range(ops)]
+        try:
+            serial = reminders[:min(ops, 200)]
+            start = time.perf_counter()
+            for reminder in serial:
+                try:
+                    await bot.send_message(reminder['user_id'], delivery.format_reminder(reminder, 'notified'))
+                except Exception:
+                    pass
+            report("последовательно (без повторов 429)", len(serial), time.perf_counter() - start)
+
+            pipeline = delivery.DeliveryPipeline(bot, workers=32, global_rate=1000, chat_rate=5, chat_burst=5)
+            pipeline.start()
+            due = utcnow()
+            for reminder in reminders:
+                reminder['remind_at'] = due
+            start = time.perf_counter()
+            results = await asyncio.gather(*(pipeline.send(r) for r in reminders), return_exceptions=True)
+            report("DeliveryPipeline, 32 воркера", ops, time.perf_counter() - start)
+            await pipeline.stop()
+            metrics = pipeline.metrics()
+            print(f"Отправлено {metrics['sent']}, ошибок {sum(isinstance(r, Exception) for r in results)}, "
+                  f"429 получено {metrics['rate_limited']}, задержка p50 {metrics['latency_p50']:.2f} s, "
+                  f"p99 {metrics['latency_p99']:.2f} s")
+        finally:
+            await bot.session.close()
+            await runner.cleanup()
+
+    asyncio.run(main())
+
+
+def bench_asyncdb(ops: int, handlers: int = 50):
+    """Задержка event loop при одновременных обработчиках: синхронные вызовы database.py против async_db"""
+    import async_db
+
+    async def measure_lag(stop: asyncio.Event, lags: list, interval: float = 0.005):
+        # Насколько позже запланированного просыпается таймер — столько loop был занят
+        loop = asyncio.get_running_loop()
+        while not stop.is_set():
+            expected = loop.time() + interval
+            await asyncio.sleep(interval)
+            lags.append(max(0.0, loop.time() - expected))
+
+    async def run(name: str, handler):
+        stop, lags = asyncio.Event(), []
+        ticker = asyncio.create_task(measure_lag(stop, lags))
+        per_handler = max(1, ops // handlers)
+        start = time.perf_counter()
+        await asyncio.gather(*(handler(h, per_handler) for h in range(handlers)))
+        elapsed = time.perf_counter() - start
+        stop.set()
+        await ticker
+        lags.sort()
+        report(name, per_handler * handlers, elapsed)
+        if lags:
+            print(f"{'':<40} лаг loop p50 {lags[len(lags) // 2] * 1000:.1f} ms, "
+                  f"p99 {lags[int(len(lags) * 0.99)] * 1000:.1f} ms, max {lags[-1] * 1000:.1f} ms")
+
+    async def sync_handler(h: int, count: int):
+        for i in range(count):
+            user_id = h * 1000 + i % 10
+            database.add_user(user_id, f"user{user_id}")
+            database.add_xp(user_id, 1, 'bench')
+            database.get_user_stats(user_id)
+            await asyncio.sleep(0)
+
+    async def async_handler(h: int, count: int):
+        for i in range(count):
+            user_id = h * 1000 + i % 10
+            await async_db.add_user(user_id, f"user{user_id}")
+            await async_db.add_xp(user_id, 1, 'bench')
+            await async_db.get_user_stats(user_id)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        use_temp_db(tmp)
+        database.set_setting('daily_xp_limit', str(ops * 10))
+        asyncio.run(run("sync database.py в обработчиках", sync_handler))
+        asyncio.run(run("async_db (писатель + читатели)", async_handler))
+        database.close_connections()
+
+
+# Токен бота для подписи initData в сценариях с /api/stats
+BENCH_BOT_TOKEN = '123456:TEST'
+
+
+def signed_init_data(user_id: int, token: str = BENCH_BOT_TOKEN) -> str:
+    """initData Mini App для user_id, подписанная token"""
+    import json
+
+    import telegram_auth
+
+    return telegram_auth.sign_init_data({
+        'query_id': f"AAH{user_id}",
+        'user': json.dumps({'id': user_id, 'first_name': f"user{user_id}", 'language_code': 'ru'}),
+        'auth_date': str(int(time.time())),
+    }, token)
+
+
+def bench_initdata(ops: int, users: int = 1000):
+    """Проверка initData: HMAC на каждый запрос против LRU-кэша, и полный запрос /api/stats"""
+    import os
+
+    import telegram_auth
+
+    token = BENCH_BOT_TOKEN
+    init_data = [signed_init_data(uid, token) for uid in range(1, users + 1)]
+
+    uncached = telegram_auth.InitDataValidator(token, cache_size=0)
+    cached = telegram_auth.InitDataValidator(token)
+    for item in init_data:
+        cached.verify(item)
+    forged = init_data[0].replace('first_name', 'first_nam3')
+
+    def rejected(i):
+        try:
+            uncached.verify(forged)
+        except telegram_auth.InvalidInitData:
+            pass
+
+    for name, func in (
+        ("verify: HMAC на каждый запрос", lambda i: uncached.verify(init_data[i % users])),
+        ("verify: из LRU-кэша", lambda i: cached.verify(init_data[i % users])),
+        ("verify: поддельная подпись", rejected),
+    ):
+        rate = timed(name, ops, func)
+        print(f"{'':<40} {1e6 / rate:.1f} µs на запрос")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        use_temp_db(tmp)
+        fill_users(users)
+        os.environ['BOT_TOKEN'] = token
+        import web_server
+        client = web_server.app.test_client()
+        timed("GET /api/stats/<id> + initData", ops,
+              lambda i: client.get(f"/api/stats/{i % users + 1}", headers={'X-Telegram-Init-Data': init_data[i % users]}))
+        timed("GET /api/stats + initData", ops,
+              lambda i: client.get('/api/stats', headers={'X-Telegram-Init-Data': init_data[i % users]}))
+        print(f"Кэш initData: {web_server.get_init_data_validator().metrics()}")
+        database.close_connections()
+
+
+def bench_batch(ops: int, users: int = 5000):
+    """Статистика пачки пользователей: get_user_stats в цикле против get_users_stats и /api/stats/batch"""
+    import os
+
+    with tempfile.TemporaryDirectory() as tmp:
+        use_temp_db(tmp)
+        fill_users(users)
+        ids = random.Random(1).sample(range(1, users + 1), min(ops, database.USERS_STATS_MAX_IDS))
+        start = time.perf_counter()
+        for user_id in ids:
+            database.get_user_stats(user_id)
+        report("get_user_stats в цикле", len(ids), time.perf_counter() - start)
+        start = time.perf_counter()
+        stats = database.get_users_stats(ids)
+        report("get_users_stats одним запросом", len(ids), time.perf_counter() - start)
+
+        os.environ['BOT_TOKEN'] = BENCH_BOT_TOKEN
+        import web_server
+        client = web_server.app.test_client()
+        init_data = {user_id: signed_init_data(user_id) for user_id in ids}
+        database.set_admin(ids[0], True)
+        admin = init_data[ids[0]]
+        start = time.perf_counter()
+        for user_id in ids:
+            client.get(f"/api/stats/{user_id}", headers={'X-Telegram-Init-Data': init_data[user_id]})
+        report("GET /api/stats/<id> в цикле", len(ids), time.perf_counter() - start)
+        start = time.perf_counter()
+        response = client.post('/api/stats/batch', json={'user_ids': ids}, headers={'X-Telegram-Init-Data': admin})
+        body = response.get_data()
+        report("POST /api/stats/batch", len(ids), time.perf_counter() - start)
+        print(f"Пользователей в ответе get_users_stats: {len(stats)}, размер ответа batch: {len(body):,} байт")
+        database.close_connections()
+
+
+def bench_rank(ops: int, users: int = 1_000_000):
+    """Место в рейтинге на users пользователях: COUNT по индексу против RankedList в памяти"""
+    import leaderboard
+
+    def percentiles(name: str, samples: list):
+        samples.sort()
+        print(f"{name:<40} p50 {samples[len(samples) // 2] * 1e6:.1f} µs, "
+              f"p99 {samples[int(len(samples) * 0.99)] * 1e6:.1f} µs")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        use_temp_db(tmp)
+        rng = random.Random(7)
+        start = time.perf_counter()
+        with database.transaction() as conn:
+            conn.executemany('INSERT INTO users (user_id, username, xp) VALUES (?, ?, ?)',
+                             ((uid, f"user{uid}", int(rng.paretovariate(1.2) * 100)) for uid in range(1, users + 1)))
+        report("вставка пользователей", users, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        board = leaderboard.Leaderboard().load()
+        report("Leaderboard.load", users, time.perf_counter() - start)
+
+        sample = [rng.randint(1, users) for _ in range(ops)]
+        db_times, memory_times = [], []
+        for user_id in sample[:min(ops, 2000)]:
+            t = time.perf_counter()
+            database.get_user_rank(user_id)
+            db_times.append(time.perf_counter() - t)
+        for user_id in sample:
+            t = time.perf_counter()
+            board.rank(user_id)
+            memory_times.append(time.perf_counter() - t)
+        percentiles("get_user_rank (COUNT по индексу)", db_times)
+        percentiles("Leaderboard.rank (в памяти)", memory_times)
+
+        around_times = []
+        for user_id in sample[:min(ops, 2000)]:
+            t = time.perf_counter()
+            board.around(user_id, 5)
+            around_times.append(time.perf_counter() - t)
+        percentiles("Leaderboard.around(radius=5)", around_times)
+
+        database.set_setting('daily_xp_limit', str(ops * 100))
+        start = time.perf_counter()
+        for user_id in sample[:min(ops, 2000)]:
+            database.add_xp(user_id, rng.randint(1, 50), 'bench')
+        report("add_xp + обновление рейтинга", min(ops, 2000), time.perf_counter() - start)
+
+        mismatched = [user_id for user_id in sample[:200] if board.rank(user_id) != database.get_user_rank(user_id)]
+        print(f"Расхождений с БД: {len(mismatched)} из 200")
+        board.close()
+        database.close_connections()
+        if mismatched:
+            raise SystemExit("Рейтинг в памяти разошёлся с БД")
+
+
+def bench_global(ops: int, users: int = 50000):
+    """get_global_stats: пять COUNT(*) против счётчиков row_counts/daily_stats"""
+    old_queries = (
+        'SELECT COUNT(*) FROM users', "SELECT COUNT(*) FROM users WHERE last_active = DATE('now')",
+        'SELECT COUNT(*) FROM reminders', 'SELECT COUNT(*) FROM notes', 'SELECT COUNT(*) FROM habits',
+    )
+
+    def old_global_stats(i):
+        with database.get_connection() as conn:
+            return [conn.execute(sql).fetchone()[0] for sql in old_queries]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        use_temp_db(tmp)
+        fill_users(users)
+        calls = min(ops, 500)
+        timed(f"5 × COUNT(*), {users} пользователей", calls, old_global_stats)
+        timed("get_global_stats (счётчики)", ops, lambda i: database.get_global_stats())
+        stats = database.get_global_stats()
+        expected = old_global_stats(0)
+        print(f"Совпадает с COUNT(*): {list(stats.values()) == expected} {stats}")
+        database.close_connections()
+
+
+def bench_analytics(ops: int, rows: int = 10_000_000, users: int = 100_000, days: int = 365):
+    """analytics.py на rows синтетических daily_actions: загрузка пачками и метрики против GROUP BY в SQL"""
+    import resource
+
+    import numpy as np
+
+    import analytics
+
+    with tempfile.TemporaryDirectory() as tmp:
+        use_temp_db(tmp)
+        # Счётчики user_stats для аналитики не нужны, а вставку 10M строк замедляют в разы
+        with database.transaction() as conn:
+            conn.execute('DROP TRIGGER trg_daily_actions_stats_insert')
+        rng = np.random.default_rng(23)
+        types = np.array(['reminder_create', 'note_create', 'habit_check', 'habit_create', 'quiz'])
+        start = time.perf_counter()
+        chunk = 1_000_000
+        for offset in range(0, rows, chunk):
+            size = min(chunk, rows - offset)
+            # Активность по пользователям неравномерная: номера пользователей из распределения Ципфа
+            user_ids = np.minimum(rng.zipf(1.3, size), users)
+            dates = (np.datetime64('2026-01-01') + rng.integers(0, days, size)).astype(str)
+            with database.transaction() as conn:
+                conn.executemany(
+                    'INSERT INTO daily_actions (user_id, action_type, action_date, xp_earned, count) VALUES (?, ?, ?, ?, ?)',
+                    zip(user_ids.tolist(), types[rng.integers(0, len(types), size)].tolist(), dates.tolist(),
+                        rng.integers(1, 30, size).tolist(), rng.integers(1, 4, size).tolist())
+                )
+        report("вставка daily_actions", rows, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        activity = analytics.load_activity()
+        report(f"load_activity → {len(activity):,} пар", rows, time.perf_counter() - start)
+        print(f"Пик памяти процесса: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB")
+
+        def measure(name: str, func):
+            start = time.perf_counter()
+            result = func()
+            print(f"{name:<40} {(time.perf_counter() - start) * 1000:>10.1f} ms")
+            return result
+
+        _, dau = measure("DAU по дням (NumPy)", lambda: activity.active_users(1))
+        measure("WAU по дням (NumPy)", lambda: activity.active_users(7))
+        measure("MAU по дням (NumPy)", lambda: activity.active_users(30))
+        _, xp = measure("XP по дням (NumPy)", activity.xp_by_day)
+        measure("XP пользователя (NumPy)", lambda: activity.xp_series(1))
+        measure("Когорты по неделям (NumPy)", lambda: activity.retention_cohorts(7, 12))
+        distribution = measure("Распределение действий (NumPy)", activity.action_distribution)
+
+        with database.get_connection() as conn:
+            sql_dau = measure("DAU по дням (SQL GROUP BY)", lambda: conn.execute(
+                'SELECT action_date, COUNT(DISTINCT user_id) FROM daily_actions GROUP BY action_date'
+            ).fetchall())
+            sql_xp = measure("XP по дням (SQL GROUP BY)", lambda: conn.execute(
+                'SELECT action_date, SUM(xp_earned) FROM daily_actions GROUP BY action_date'
+            ).fetchall())
+            sql_distribution = measure("Распределение действий (SQL GROUP BY)", lambda: conn.execute(
+                'SELECT action_type, SUM(count) FROM daily_actions GROUP BY action_type'
+            ).fetchall())
+            sql_mau = measure("MAU на один день (SQL)", lambda: conn.execute(
+                "SELECT COUNT(DISTINCT user_id) FROM daily_actions WHERE action_date > DATE(?, '-30 days')",
+                (str(np.datetime64('2026-01-01') + days - 1),)
+            ).fetchone()[0])
+        matches = (
+            [count for _, count in sql_dau] == dau.tolist()
+            and [total for _, total in sql_xp] == xp.tolist()
+            and {action_type: total for action_type, total in sql_distribution}
+            == {action_type: row['actions'] for action_type, row in distribution.items()}
+            and sql_mau == activity.active_summary()['mau']
+        )
+        print(f"Совпадает с SQL: {matches}")
+        database.close_connections()
+        if not matches:
+            raise SystemExit("Аналитика разошлась с SQL")
+
+
+def bench_levels(ops: int):
+    """Скорость расчёта уровня: прежняя формула, bisect по таблице порогов и LevelTable.progress"""
+    import levels
+
+    with tempfile.TemporaryDirectory() as tmp:
+        use_temp_db(tmp)
+        rng = random.Random(24)
+        samples = [rng.randint(0, 10 ** 7) for _ in range(max(ops, 100000))]
+        timed("int((xp / 100) ** 0.5) + 1", len(samples), lambda i: int((samples[i] / 100) ** 0.5) + 1)
+        timed("levels.level_for_xp (bisect)", len(samples), lambda i: levels.level_for_xp(samples[i]))
+        table = database.get_level_table()
+        timed("LevelTable.progress", len(samples), lambda i: table.progress(samples[i]))
+        database.close_connections()
+
+
+def bench_transfer(ops: int, rows: int = 5_000_000, users: int = 100_000):
+    """transfer.py на rows строках: выгрузка и загрузка NDJSON, продолжение после kill -9, сверка с исходной БД"""
+    import hashlib
+    import os
+    import resource
+    import subprocess
+    import sys
+
+    import transfer
+
+    root = Path(__file__).parent
+    # Доли строк по таблицам: 2% пользователи, дальше напоминания, заметки, привычки, действия, логи
+    shares = {'reminders': 0.06, 'notes': 0.06, 'habits': 0.04, 'daily_actions': 0.42}
+
+    def run(db_path: Path, *args, kill_after: float = None) -> float:
+        """Запустить transfer.py отдельным процессом; kill_after — убить через столько секунд"""
+        env = dict(os.environ, DB_PATH=str(db_path))
+        start = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, 'transfer.py', *map(str, args)], cwd=root, env=env,
+                                stdout=subprocess.DEVNULL)
+        try:
+            proc.wait(kill_after)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+            return time.perf_counter() - start
+        if proc.returncode:
+            raise SystemExit(f"transfer.py {' '.join(map(str, args))} завершился с кодом {proc.returncode}")
+        return time.perf_counter() - start
+
+    def fingerprint(db_path: Path) -> dict:
+        """Число строк и контрольная сумма содержимого по каждой таблице"""
+        result = {}
+        conn = sqlite3.connect(db_path)
+        for table, key in transfer.TABLES:
+            columns = [c for c in transfer.table_columns(conn, table) if c not in transfer._DERIVED_COLUMNS.get(table, ())]
+            result[table] = conn.execute(f'''
+                SELECT COUNT(*), TOTAL({key}), TOTAL(LENGTH({' || '.join(f'quote({c})' for c in columns)}))
+                FROM {table}
+            ''').fetchone()
+        conn.close()
+        return result
+
+    def body_digest(directory: Path) -> str:
+        """Хеш выгрузки без заголовков (в них id выгрузки)"""
+        digest = hashlib.sha256()
+        for table, _ in transfer.TABLES:
+            with open(directory / f"{table}.ndjson", 'rb') as f:
+                f.readline()
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+        return digest.hexdigest()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        source = use_temp_db(str(tmp))
+        rng = random.Random(25)
+        start = time.perf_counter()
+        with database.transaction() as conn:
+            conn.executemany(
+                'INSERT INTO users (user_id, username, xp, level, created_at) VALUES (?, ?, ?, ?, ?)',
+                ((uid, f"user{uid}", rng.randint(0, 50000), rng.randint(1, 20), f"2026-{rng.randint(1, 9):02d}-01 12:00:00")
+                 for uid in range(1, users + 1))
+            )
+        inserts = {
+            'reminders': ('INSERT INTO reminders (user_id, title, remind_at, is_completed) VALUES (?, ?, ?, ?)',
+                          lambda: (rng.randint(1, users), 'Позвонить маме 📞', '2026-11-01 09:00:00', rng.random() < 0.5)),
+            'notes': ('INSERT INTO notes (user_id, content) VALUES (?, ?)',
+                      lambda: (rng.randint(1, users), 'Заметка "с кавычками" и переносом\nстроки ' * rng.randint(1, 3))),
+            'habits': ('INSERT INTO habits (user_id, title, streak) VALUES (?, ?, ?)',
+                       lambda: (rng.randint(1, users), 'Зарядка', rng.randint(0, 100))),
+            'daily_actions': (
+                'INSERT INTO daily_actions (user_id, action_type, action_date, xp_earned, count) VALUES (?, ?, ?, ?, ?)',
+                lambda: (rng.randint(1, users), 'note_create', f"2026-{rng.randint(1, 9):02d}-{rng.randint(1, 28):02d}",
+                         rng.randint(1, 30), 1)),
+        }
+        remaining = rows - users
+        for table, (sql, make_row) in inserts.items():
+            count = int(rows * shares[table])
+            remaining -= count
+            for offset in range(0, count, 500_000):
+                with database.transaction() as conn:
+                    conn.executemany(sql, (make_row() for _ in range(min(500_000, count - offset))))
+        for offset in range(0, remaining, 500_000):
+            database.insert_logs([
+                (rng.randint(1, users), 'user', 3, 500, 'xp', '{"amount": 10}', '2026-09-01 10:00:00')
+                for _ in range(min(500_000, remaining - offset))
+            ])
+        report("заполнение исходной БД", rows, time.perf_counter() - start)
+        database.close_connections()
+
+        clean = tmp / 'clean'
+        elapsed = run(source, 'export', clean)
+        report("export (NDJSON)", rows, elapsed)
+        size = sum(path.stat().st_size for path in clean.glob('*.ndjson'))
+        print(f"{'':<40} {size / 2 ** 20:.0f} MB, пик памяти процесса "
+              f"{resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024:.0f} MB")
+
+        resumed = tmp / 'resumed'
+        run(source, 'export', resumed, kill_after=elapsed / 2)
+        report("export после kill -9 (дозапись)", rows, run(source, 'export', resumed))
+        same_dump = body_digest(resumed) == body_digest(clean)
+        print(f"Продолженная выгрузка совпадает с полной: {same_dump}")
+
+        target = tmp / 'target.db'
+        elapsed = run(target, 'import', clean)
+        report("import (executemany, триггеры)", rows, elapsed)
+        print(f"{'':<40} пик памяти процесса {resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024:.0f} MB")
+
+        crashed = tmp / 'crashed.db'
+        run(crashed, 'import', clean, kill_after=elapsed / 2)
+        report("import после kill -9 (дозагрузка)", rows, run(crashed, 'import', clean))
+
+        expected = fingerprint(source)
+        same_db = fingerprint(target) == expected and fingerprint(crashed) == expected
+        print(f"Загруженные БД совпадают с исходной: {same_db}")
+        database.DB_PATH = crashed
+        broken = database.check_user_stats()
+        with database.get_connection() as conn:
+            counts_ok = all(
+                conn.execute('SELECT count FROM row_counts WHERE name = ?', (table,)).fetchone()[0]
+                == conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+                for table in ('users', 'reminders', 'notes', 'habits', 'logs')
+            )
+        print(f"user_stats и row_counts после загрузки согласованы: {not broken and counts_ok}")
+        database.close_connections()
+        if not (same_dump and same_db and not broken and counts_ok):
+            raise SystemExit("Выгрузка или загрузка разошлась с исходной БД")
+
+
+def _free_port() -> int:
+    import socket
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for_port(port: int, timeout: float = 15.0):
+    import socket
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise SystemExit(f"Сервер на порту {port} не запустился")
+
+
+def load_test(port: int, ops: int, clients: int, users: int) -> tuple:
+    """ops запросов /api/stats/<id> из clients потоков с keep-alive. Возвращает (секунды, задержки, ошибки)"""
+    import http.client
+
+    latencies, errors = [], []
+    per_client = ops // clients
+    init_data = [signed_init_data(uid) for uid in range(1, users + 1)]
+
+    def client(seed: int):
+        rng = random.Random(seed)
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        local = []
+        for _ in range(per_client):
+            start = time.perf_counter()
+            try:
+                user_id = rng.randint(1, users)
+                conn.request('GET', f"/api/stats/{user_id}", headers={'X-Telegram-Init-Data': init_data[user_id - 1]})
+                response = conn.getresponse()
+                response.read()
+                if response.status != 200:
+                    errors.append(response.status)
+                if response.will_close:
+                    conn.close()
+            except (OSError, http.client.HTTPException) as e:
+                errors.append(type(e).__name__)
+                conn.close()
+            local.append(time.perf_counter() - start)
+        conn.close()
+        latencies.extend(local)
+
+    pool = [threading.Thread(target=client, args=(c,)) for c in range(clients)]
+    start = time.perf_counter()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    return time.perf_counter() - start, sorted(latencies), errors
+
+
+def bench_web(ops: int, clients: int = 16, users: int = 1000):
+    """Нагрузочный тест /api/stats: dev-сервер Flask против gunicorn (gunicorn.conf.py)"""
+    import os
+    import signal
+    import subprocess
+    import sys
+
+    root = Path(__file__).parent
+    modes = {
+        'flask dev server': [sys.executable, 'web_server.py'],
+        'gunicorn (gunicorn.conf.py)': [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'web_server:app'],
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = use_temp_db(tmp)
+        fill_users(users)
+        database.close_connections()
+        for name, command in modes.items():
+            port = _free_port()
+            env = dict(os.environ, DB_PATH=str(db_path), PORT=str(port), BOT_TOKEN=BENCH_BOT_TOKEN)
+            server = subprocess.Popen(command, cwd=root, env=env,
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                _wait_for_port(port)
+                load_test(port, min(ops, 200), clients, users)  # прогрев
+                elapsed, latencies, errors = load_test(port, ops, clients, users)
+            finally:
+                server.send_signal(signal.SIGTERM)
+                server.wait(30)
+            report(name, len(latencies), elapsed)
+            print(f"{'':<40} p50 {latencies[len(latencies) // 2] * 1000:.2f} ms, "
+                  f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:.2f} ms, ошибок {len(errors)}")
+
+
+# Исходный запрос get_all_users_with_stats: три LEFT JOIN сразу дают R×N×H строк на пользователя
+OLD_USERS_WITH_STATS_SQL = '''
+    SELECT u.user_id, u.username, u.xp, u.level, u.created_at, u.last_active,
+           COUNT(DISTINCT r.id), SUM(CASE WHEN r.is_completed THEN 1 ELSE 0 END),
+           COUNT(DISTINCT n.id), COUNT(DISTINCT h.id), SUM(h.streak)
+    FROM users u
+    LEFT JOIN reminders r ON u.user_id = r.user_id
+    LEFT JOIN notes n ON u.user_id = n.user_id
+    LEFT JOIN habits h ON u.user_id = h.user_id
+    GROUP BY u.user_id
+    ORDER BY u.xp DESC
+'''
+
+
+def fill_users(users: int, seed: int = 42):
+    """Синтетические пользователи с напоминаниями, заметками и привычками (у каждого десятого — много)"""
+    rng = random.Random(seed)
+    with database.transaction() as conn:
+        conn.executemany('INSERT INTO users (user_id, username, xp) VALUES (?, ?, ?)',
+                         ((uid, f"user{uid}", rng.randint(0, 50000)) for uid in range(1, users + 1)))
+        reminders, notes, habits = [], [], []
+        for uid in range(1, users + 1):
+            scale = 8 if uid % 10 == 0 else 1
+            reminders += [(uid, 't', '2030-01-01 00:00:00', rng.random() < 0.5) for _ in range(rng.randint(0, 3) * scale)]
+            notes += [(uid, 'c') for _ in range(rng.randint(0, 2) * scale)]
+            habits += [(uid, 'h', rng.randint(0, 30)) for _ in range(rng.randint(0, 2) * scale)]
+        conn.executemany('INSERT INTO reminders (user_id, title, remind_at, is_completed) VALUES (?, ?, ?, ?)', reminders)
+        conn.executemany('INSERT INTO notes (user_id, content) VALUES (?, ?)', notes)
+        conn.executemany('INSERT INTO habits (user_id, title, streak) VALUES (?, ?, ?)', habits)
+
+
+def bench_users(ops: int):
+    """get_all_users_with_stats: тройной JOIN против счётчиков user_stats и keyset-пагинации"""
+    with tempfile.TemporaryDirectory() as tmp:
+        use_temp_db(tmp)
+        fill_users(ops)
+
+        start = time.perf_counter()
+        with database.get_connection() as conn:
+            old_rows = conn.execute(OLD_USERS_WITH_STATS_SQL).fetchall()
+        report(f"тройной LEFT JOIN, {ops} польз.", len(old_rows), time.perf_counter() - start)
+
+        start = time.perf_counter()
+        new_rows = list(database.iter_users_with_stats())
+        report(f"user_stats + keyset, {ops} польз.", len(new_rows), time.perf_counter() - start)
+
+        start = time.perf_counter()
+        database.get_users_with_stats_page(50, (new_rows[ops // 2]['xp'], new_rows[ops // 2]['user_id']))
+        print(f"Страница из середины: {(time.perf_counter() - start) * 1000:.2f} ms")
+
+        new_by_id = {row['user_id']: row for row in new_rows}
+        inflated = sum(1 for row in old_rows
+                       if (row[7] or 0, row[10] or 0) != (new_by_id[row[0]]['completed_reminders'],
+                                                          new_by_id[row[0]]['total_streak']))
+        print(f"Пользователей с раздутыми суммами в старом запросе: {inflated}")
+        database.close_connections()
+
+
+SCENARIOS = {
+    'analytics': bench_analytics,
+    'asyncdb': bench_asyncdb,
+    'batch': bench_batch,
+    'claim': bench_claim,
+    'delivery': bench_delivery,
+    'dispatch': bench_dispatch,
+    'global': bench_global,
+    'initdata': bench_initdata,
+    'levels': bench_levels,
+    'logs': bench_logs,
+    'pool': bench_pool,
+    'rank': bench_rank,
+    'transfer': bench_transfer,
+    'users': bench_users,
+    'web': bench_web,
+    'xp': bench_xp,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарки бота-помощника")
+    parser.add_argument('scenario', choices=sorted(SCENARIOS))
+    parser.add_argument('--ops', type=int, default=5000)
+    args = parser.parse_args()
+    SCENARIOS[args.scenario](args.ops)
@@ -2,219 +2,797 @@
 База данных для бота-помощника
 + Система уровней, наград, защита от абуза
 """
+import json
 import sqlite3
 import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime, date
 from pathlib import Path
 from dotenv import load_dotenv
 
+import levels
+
 # Загрузка переменных окружения
 load_dotenv()
 
-DB_PATH = Path(__file__).parent / "assistant.db"
+DB_PATH = Path(os.getenv('DB_PATH', Path(__file__).parent / "assistant.db"))
+
+# Сколько простаивающих соединений держать в пуле
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '8'))
+
+# PRAGMA, которые применяются к каждому новому соединению
+DB_PRAGMAS = (
+    ('auto_vacuum', 'INCREMENTAL'),  # действует только для новой БД, до первой таблицы и WAL
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('cache_size', '-16000'),      # ~16 МБ кэша страниц
+    ('mmap_size', '67108864'),     # 64 МБ memory-mapped I/O
+    ('busy_timeout', '5000'),      # ждём блокировку до 5 секунд
+    ('temp_store', 'MEMORY'),
+)
+
+
+# ========== Соединения ==========
+
+class ConnectionPool:
+    """Пул соединений SQLite с настроенными PRAGMA"""
+
+    def __init__(self, db_path, size: int = DB_POOL_SIZE):
+        self.db_path = str(db_path)
+        self.size = size
+        self.pid = os.getpid()
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        """Открыть и настроить новое соединение"""
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        for name, value in DB_PRAGMAS:
+            conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        """Взять соединение из пула (или открыть новое)"""
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return self._connect()
+
+    def release(self, conn: sqlite3.Connection):
+        """Вернуть соединение в пул"""
+        # Незакоммиченные изменения откатываются, как при conn.close()
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def close_all(self):
+        """Закрыть все простаивающие соединения"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    """Пул для текущего DB_PATH (пересоздаётся после fork и смены пути)"""
+    global _pool
+    pool = _pool
+    if pool is None or pool.db_path != str(DB_PATH) or pool.pid != os.getpid():
+        with _pool_lock:
+            pool = _pool
+            if pool is None or pool.db_path != str(DB_PATH) or pool.pid != os.getpid():
+                pool = _pool = ConnectionPool(DB_PATH)
+    return pool
+
+
+@contextmanager
+def get_connection():
+    """Соединение из пула на время блока with"""
+    pool = get_pool()
+    conn = pool.acquire()
+    try:
+        yield conn
+    except BaseException:
+        if conn.in_transaction:
+            conn.rollback()
+        raise
+    finally:
+        pool.release(conn)
+
+
+@contextmanager
+def transaction(immediate: bool = True):
+    """
+    Транзакция на соединении из пула: commit при выходе, rollback при ошибке
+    BEGIN IMMEDIATE сразу берёт блокировку записи, чтобы чтение и запись не гонялись
+    """
+    with get_connection() as conn:
+        conn.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+        yield conn
+        conn.commit()
+
+
+def close_connections():
+    """Закрыть соединения пула (при остановке процесса)"""
+    if _pool is not None:
+        _pool.close_all()
+
 
 # Загрузка ADMIN_IDS из окружения
+def parse_id_list(ids_str: str) -> list:
+    """Разобрать строку вида '1,2,3' в список ID"""
+    if ids_str:
+        return [int(x.strip()) for x in ids_str.split(',') if x.strip().isdigit()]
+    return []
+
+
 def get_admin_ids_from_env() -> list:
     """Получить список ID админов из .env"""
-    admin_ids_str = os.getenv('ADMIN_IDS', '')
-    if admin_ids_str:
-        return [int(x.strip()) for x in admin_ids_str.split(',') if x.strip().isdigit()]
-    return []
+    return parse_id_list(os.getenv('ADMIN_IDS', ''))
 
 
 def init_db():
     """Инициализация базы данных"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    # Таблица пользователей
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            username TEXT,
-            xp INTEGER DEFAULT 0,
-            level INTEGER DEFAULT 1,
-            timezone TEXT DEFAULT 'Europe/Moscow',
-            is_admin BOOLEAN DEFAULT FALSE,
-            daily_xp INTEGER DEFAULT 0,
-            daily_xp_reset DATE DEFAULT CURRENT_DATE,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            last_active DATE DEFAULT CURRENT_DATE
-        )
-    ''')
-    
-    # Таблица уровней и наград
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS level_rewards (
-            level INTEGER PRIMARY KEY,
-            xp_required INTEGER,
-            reward_text TEXT,
-            reward_xp INTEGER DEFAULT 0
-        )
-    ''')
-    
-    # Награды по умолчанию
-    cursor.execute('''
-        INSERT OR IGNORE INTO level_rewards (level, xp_required, reward_text, reward_xp)
-        VALUES 
-        (1, 0, 'Новичок', 0),
-        (2, 100, 'Любитель', 50),
-        (3, 300, 'Пользователь', 100),
-        (4, 600, 'Активный', 150),
-        (5, 1000, 'Опытный', 200),
-        (6, 1500, 'Эксперт', 250),
-        (7, 2100, 'Мастер', 300),
-        (8, 2800, 'Профи', 400),
-        (9, 3600, 'Ветеран', 500),
-        (10, 4500, 'Легенда', 1000)
-    ''')
-    
-    # Таблица напоминаний
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS reminders (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            title TEXT NOT NULL,
-            description TEXT,
-            remind_at TIMESTAMP NOT NULL,
-            location TEXT,
-            is_completed BOOLEAN DEFAULT FALSE,
-            notified BOOLEAN DEFAULT FALSE,
-            pre_notified BOOLEAN DEFAULT FALSE,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(user_id)
-        )
-    ''')
-    
-    # Таблица заметок
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS notes (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            title TEXT,
-            content TEXT NOT NULL,
-            category TEXT DEFAULT 'general',
-            is_pinned BOOLEAN DEFAULT FALSE,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(user_id)
-        )
-    ''')
-    
-    # Таблица привычек
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS habits (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            title TEXT NOT NULL,
-            frequency TEXT DEFAULT 'daily',
-            streak INTEGER DEFAULT 0,
-            total_completed INTEGER DEFAULT 0,
-            last_completed DATE,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(user_id)
-        )
-    ''')
-    
-    # Таблица ежедневных действий (для защиты от абуза)
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS daily_actions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            action_type TEXT,
-            action_date DATE DEFAULT CURRENT_DATE,
-            xp_earned INTEGER DEFAULT 0,
-            count INTEGER DEFAULT 1,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(user_id)
-        )
-    ''')
-    
-    # Таблица настроек бота
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS bot_settings (
-            key TEXT PRIMARY KEY,
-            value TEXT
-        )
-    ''')
-
-    # Таблица логов действий пользователей
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS logs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            username TEXT,
-            user_level INTEGER DEFAULT 1,
-            user_xp INTEGER DEFAULT 0,
-            action_type TEXT,
-            action_data TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(user_id)
-        )
-    ''')
-
-    # Настройки по умолчанию
-    default_settings = [
-        ('daily_xp_limit', '500'),
-        ('reminder_xp', '10'),
-        ('habit_xp', '20'),
-        ('note_xp', '5'),
-        ('start_xp', '50'),
-        ('admin_ids', '')
-    ]
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        
+        # Таблица пользователей
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                username TEXT,
+                xp INTEGER DEFAULT 0,
+                level INTEGER DEFAULT 1,
+                timezone TEXT DEFAULT 'Europe/Moscow',
+                is_admin BOOLEAN DEFAULT FALSE,
+                daily_xp INTEGER DEFAULT 0,
+                daily_xp_reset DATE DEFAULT CURRENT_DATE,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                last_active DATE DEFAULT CURRENT_DATE
+            )
+        ''')
+        
+        # Таблица уровней и наград
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS level_rewards (
+                level INTEGER PRIMARY KEY,
+                xp_required INTEGER,
+                reward_text TEXT,
+                reward_xp INTEGER DEFAULT 0
+            )
+        ''')
+        
+        # Награды по умолчанию
+        cursor.execute('''
+            INSERT OR IGNORE INTO level_rewards (level, xp_required, reward_text, reward_xp)
+            VALUES 
+            (1, 0, 'Новичок', 0),
+            (2, 100, 'Любитель', 50),
+            (3, 400, 'Пользователь', 100),
+            (4, 900, 'Активный', 150),
+            (5, 1600, 'Опытный', 200),
+            (6, 2500, 'Эксперт', 250),
+            (7, 3600, 'Мастер', 300),
+            (8, 4900, 'Профи', 400),
+            (9, 6400, 'Ветеран', 500),
+            (10, 8100, 'Легенда', 1000)
+        ''')
+        
+        # Таблица напоминаний
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS reminders (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                title TEXT NOT NULL,
+                description TEXT,
+                remind_at TIMESTAMP NOT NULL,
+                location TEXT,
+                is_completed BOOLEAN DEFAULT FALSE,
+                notified BOOLEAN DEFAULT FALSE,
+                pre_notified BOOLEAN DEFAULT FALSE,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users(user_id)
+            )
+        ''')
+        
+        # Таблица заметок
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS notes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                title TEXT,
+                content TEXT NOT NULL,
+                category TEXT DEFAULT 'general',
+                is_pinned BOOLEAN DEFAULT FALSE,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users(user_id)
+            )
+        ''')
+        
+        # Таблица привычек
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS habits (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                title TEXT NOT NULL,
+                frequency TEXT DEFAULT 'daily',
+                streak INTEGER DEFAULT 0,
+                total_completed INTEGER DEFAULT 0,
+                last_completed DATE,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users(user_id)
+            )
+        ''')
+        
+        # Таблица ежедневных действий (для защиты от абуза)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS daily_actions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                action_type TEXT,
+                action_date DATE DEFAULT CURRENT_DATE,
+                xp_earned INTEGER DEFAULT 0,
+                count INTEGER DEFAULT 1,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users(user_id)
+            )
+        ''')
+        
+        # Таблица настроек бота
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS bot_settings (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        ''')
 
-    for key, value in default_settings:
+        # Таблица логов действий пользователей
         cursor.execute('''
-            INSERT OR IGNORE INTO bot_settings (key, value) VALUES (?, ?)
-        ''', (key, value))
+            CREATE TABLE IF NOT EXISTS logs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                username TEXT,
+                user_level INTEGER DEFAULT 1,
+                user_xp INTEGER DEFAULT 0,
+                action_type TEXT,
+                action_data TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users(user_id)
+            )
+        ''')
+
+        # Настройки по умолчанию
+        default_settings = [
+            ('daily_xp_limit', '500'),
+            ('reminder_xp', '10'),
+            ('habit_xp', '20'),
+            ('note_xp', '5'),
+            ('start_xp', '50'),
+            ('admin_ids', ''),
+            ('logs_retention_days', '90'),
+            ('daily_actions_retention_days', '30'),
+            ('retention_batch_size', '1000')
+        ]
+
+        for key, value in default_settings:
+            cursor.execute('''
+                INSERT OR IGNORE INTO bot_settings (key, value) VALUES (?, ?)
+            ''', (key, value))
+        
+        conn.commit()
     
-    conn.commit()
-    conn.close()
+    migrate()
+
+
+# ========== Миграции схемы ==========
+
+def _counter_triggers(table: str, watched: tuple, counters: dict) -> tuple:
+    """
+    Триггеры, поддерживающие счётчики user_stats для таблицы table
+    watched: колонки, от которых зависят счётчики (для AFTER UPDATE OF)
+    counters: {колонка user_stats: выражение над строкой {row} (NEW или OLD)}
+    """
+    def values(row: str) -> str:
+        return ', '.join(expr.format(row=row) for expr in counters.values())
+
+    columns = ', '.join(counters)
+    upsert = (
+        f"INSERT INTO user_stats (user_id, {columns}) VALUES (NEW.user_id, {values('NEW')}) "
+        "ON CONFLICT(user_id) DO UPDATE SET "
+        + ', '.join(f"{col} = {col} + excluded.{col}" for col in counters) + ';'
+    )
+    subtract = (
+        "UPDATE user_stats SET "
+        + ', '.join(f"{col} = {col} - ({expr.format(row='OLD')})" for col, expr in counters.items())
+        + " WHERE user_id = OLD.user_id;"
+    )
+    return (
+        f"CREATE TRIGGER IF NOT EXISTS trg_{table}_stats_insert AFTER INSERT ON {table} "
+        f"BEGIN {upsert} END",
+        f"CREATE TRIGGER IF NOT EXISTS trg_{table}_stats_update AFTER UPDATE OF user_id, {', '.join(watched)} "
+        f"ON {table} BEGIN {subtract} {upsert} END",
+        f"CREATE TRIGGER IF NOT EXISTS trg_{table}_stats_delete AFTER DELETE ON {table} "
+        f"BEGIN {subtract} END",
+    )
+
+
+# Пересчёт user_stats с нуля по базовым таблицам (миграция и repair_user_stats)
+USER_STATS_REBUILD_SQL = '''
+    INSERT INTO user_stats (user_id, total_reminders, completed_reminders, total_notes, pinned_notes,
+                            total_habits, total_streak, total_habit_completions, xp_day, xp_day_total)
+    SELECT ids.user_id,
+           COALESCE(r.total, 0), COALESCE(r.completed, 0),
+           COALESCE(n.total, 0), COALESCE(n.pinned, 0),
+           COALESCE(h.total, 0), COALESCE(h.streak, 0), COALESCE(h.completions, 0),
+           d.action_date, COALESCE(d.xp, 0)
+    FROM (
+        SELECT user_id FROM reminders UNION SELECT user_id FROM notes
+        UNION SELECT user_id FROM habits UNION SELECT user_id FROM daily_actions
+    ) AS ids
+    LEFT JOIN (
+        SELECT user_id, COUNT(*) AS total, SUM(CASE WHEN is_completed THEN 1 ELSE 0 END) AS completed
+        FROM reminders GROUP BY user_id
+    ) AS r ON r.user_id = ids.user_id
+    LEFT JOIN (
+        SELECT user_id, COUNT(*) AS total, SUM(CASE WHEN is_pinned THEN 1 ELSE 0 END) AS pinned
+        FROM notes GROUP BY user_id
+    ) AS n ON n.user_id = ids.user_id
+    LEFT JOIN (
+        SELECT user_id, COUNT(*) AS total, SUM(streak) AS streak, SUM(total_completed) AS completions
+        FROM habits GROUP BY user_id
+    ) AS h ON h.user_id = ids.user_id
+    LEFT JOIN (
+        SELECT user_id, action_date, SUM(xp_earned) AS xp
+        FROM daily_actions WHERE action_date = DATE('now') GROUP BY user_id
+    ) AS d ON d.user_id = ids.user_id
+    WHERE ids.user_id IS NOT NULL
+'''
+
+
+# Колонки user_stats, изменение которых меняет версию статистики пользователя
+_STATS_VERSION_WATCHED = (
+    'total_reminders', 'completed_reminders', 'total_notes', 'pinned_notes',
+    'total_habits', 'total_streak', 'total_habit_completions', 'xp_day', 'xp_day_total',
+)
+
+
+def _stats_version_bump(user_id: str) -> str:
+    """Тело триггера: увеличить счётчик 'user_stats' и записать его в users.stats_version"""
+    return (
+        "UPDATE data_versions SET version = version + 1 WHERE scope = 'user_stats'; "
+        "UPDATE users SET stats_version = (SELECT version FROM data_versions WHERE scope = 'user_stats') "
+        f"WHERE user_id = {user_id};"
+    )
+
+
+def _row_count_triggers(table: str) -> tuple:
+    """Триггеры счётчика строк table в row_counts"""
+    return (
+        f"INSERT OR REPLACE INTO row_counts (name, count) VALUES ('{table}', (SELECT COUNT(*) FROM {table}))",
+        f'''CREATE TRIGGER IF NOT EXISTS trg_{table}_count_insert AFTER INSERT ON {table}
+           BEGIN UPDATE row_counts SET count = count + 1 WHERE name = '{table}'; END''',
+        f'''CREATE TRIGGER IF NOT EXISTS trg_{table}_count_delete AFTER DELETE ON {table}
+           BEGIN UPDATE row_counts SET count = count - 1 WHERE name = '{table}'; END''',
+    )
+
+
+def _daily_stats_bump(day: str, column: str) -> str:
+    """Тело триггера: +1 к column в строке daily_stats за день day"""
+    return (
+        f"INSERT INTO daily_stats (day, {column}) VALUES ({day}, 1) "
+        f"ON CONFLICT(day) DO UPDATE SET {column} = {column} + 1;"
+    )
+
+
+def _daily_stats_backfill(column: str, day: str, table: str) -> str:
+    """Заполнить column в daily_stats по существующим строкам table"""
+    return (
+        f"INSERT INTO daily_stats (day, {column}) "
+        f"SELECT {day}, COUNT(*) FROM {table} WHERE {day} IS NOT NULL GROUP BY 1 "
+        f"ON CONFLICT(day) DO UPDATE SET {column} = excluded.{column}"
+    )
+
+
+# Версия схемы хранится в PRAGMA user_version; каждая миграция переводит БД на свою версию.
+# Условия частичных индексов должны совпадать с текстом WHERE в запросах (FALSE, а не 0),
+# иначе планировщик SQLite их не использует.
+MIGRATIONS = [
+    (1, 'Индексы под запросы пользователя, планировщика и логов', (
+        'CREATE INDEX IF NOT EXISTS idx_reminders_user_remind_at ON reminders (user_id, remind_at)',
+        '''CREATE INDEX IF NOT EXISTS idx_reminders_pending ON reminders (remind_at)
+           WHERE is_completed = FALSE AND notified = FALSE''',
+        '''CREATE INDEX IF NOT EXISTS idx_reminders_pre_notify ON reminders (remind_at)
+           WHERE is_completed = FALSE AND pre_notified = FALSE''',
+        'CREATE INDEX IF NOT EXISTS idx_notes_user_pinned ON notes (user_id, is_pinned, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_habits_user_created ON habits (user_id, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_daily_actions_user_date ON daily_actions (user_id, action_date)',
+        'CREATE INDEX IF NOT EXISTS idx_logs_created ON logs (created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_logs_user_created ON logs (user_id, created_at)',
+    )),
+    (2, 'Счётчики версий данных для сброса кэшей между процессами', (
+        '''CREATE TABLE IF NOT EXISTS data_versions (
+               scope TEXT PRIMARY KEY,
+               version INTEGER NOT NULL DEFAULT 0
+           )''',
+        "INSERT OR IGNORE INTO data_versions (scope, version) VALUES ('settings', 0)",
+        '''CREATE TRIGGER IF NOT EXISTS trg_bot_settings_insert AFTER INSERT ON bot_settings
+           BEGIN UPDATE data_versions SET version = version + 1 WHERE scope = 'settings'; END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_bot_settings_update AFTER UPDATE ON bot_settings
+           BEGIN UPDATE data_versions SET version = version + 1 WHERE scope = 'settings'; END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_bot_settings_delete AFTER DELETE ON bot_settings
+           BEGIN UPDATE data_versions SET version = version + 1 WHERE scope = 'settings'; END''',
+    )),
+    (3, 'Версия списка админов', (
+        "INSERT OR IGNORE INTO data_versions (scope, version) VALUES ('admins', 0)",
+        '''CREATE TRIGGER IF NOT EXISTS trg_users_is_admin AFTER UPDATE OF is_admin ON users
+           WHEN OLD.is_admin IS NOT NEW.is_admin
+           BEGIN UPDATE data_versions SET version = version + 1 WHERE scope = 'admins'; END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_admin_ids_insert AFTER INSERT ON bot_settings
+           WHEN NEW.key = 'admin_ids'
+           BEGIN UPDATE data_versions SET version = version + 1 WHERE scope = 'admins'; END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_admin_ids_update AFTER UPDATE ON bot_settings
+           WHEN NEW.key = 'admin_ids'
+           BEGIN UPDATE data_versions SET version = version + 1 WHERE scope = 'admins'; END''',
+    )),
+    (4, 'Материализованные счётчики статистики пользователей', (
+        '''CREATE TABLE IF NOT EXISTS user_stats (
+               user_id INTEGER PRIMARY KEY,
+               total_reminders INTEGER NOT NULL DEFAULT 0,
+               completed_reminders INTEGER NOT NULL DEFAULT 0,
+               total_notes INTEGER NOT NULL DEFAULT 0,
+               pinned_notes INTEGER NOT NULL DEFAULT 0,
+               total_habits INTEGER NOT NULL DEFAULT 0,
+               total_streak INTEGER NOT NULL DEFAULT 0,
+               total_habit_completions INTEGER NOT NULL DEFAULT 0,
+               xp_day DATE,
+               xp_day_total INTEGER NOT NULL DEFAULT 0
+           )''',
+        *_counter_triggers('reminders', ('is_completed',), {
+            'total_reminders': '1',
+            'completed_reminders': 'CASE WHEN {row}.is_completed THEN 1 ELSE 0 END',
+        }),
+        *_counter_triggers('notes', ('is_pinned',), {
+            'total_notes': '1',
+            'pinned_notes': 'CASE WHEN {row}.is_pinned THEN 1 ELSE 0 END',
+        }),
+        *_counter_triggers('habits', ('streak', 'total_completed'), {
+            'total_habits': '1',
+            'total_streak': 'COALESCE({row}.streak, 0)',
+            'total_habit_completions': 'COALESCE({row}.total_completed, 0)',
+        }),
+        # XP за день: счётчик привязан к дате xp_day и обнуляется, когда приходит действие за новый день
+        '''CREATE TRIGGER IF NOT EXISTS trg_daily_actions_stats_insert AFTER INSERT ON daily_actions
+           BEGIN
+               INSERT INTO user_stats (user_id, xp_day, xp_day_total)
+               VALUES (NEW.user_id, NEW.action_date, COALESCE(NEW.xp_earned, 0))
+               ON CONFLICT(user_id) DO UPDATE SET
+                   xp_day_total = CASE
+                       WHEN xp_day = excluded.xp_day THEN xp_day_total + excluded.xp_day_total
+                       WHEN xp_day IS NULL OR xp_day < excluded.xp_day THEN excluded.xp_day_total
+                       ELSE xp_day_total
+                   END,
+                   xp_day = CASE
+                       WHEN xp_day IS NULL OR xp_day < excluded.xp_day THEN excluded.xp_day
+                       ELSE xp_day
+                   END;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_daily_actions_stats_delete AFTER DELETE ON daily_actions
+           BEGIN
+               UPDATE user_stats SET xp_day_total = xp_day_total - COALESCE(OLD.xp_earned, 0)
+               WHERE user_id = OLD.user_id AND xp_day = OLD.action_date;
+           END''',
+        'DELETE FROM user_stats',
+        USER_STATS_REBUILD_SQL,
+    )),
+    (5, 'Индекс пользователей по XP для рейтинга и постраничного обхода', (
+        'CREATE INDEX IF NOT EXISTS idx_users_xp ON users (xp DESC, user_id)',
+    )),
+    (6, 'Счётчик строк логов и индекс по типу действия', (
+        '''CREATE TABLE IF NOT EXISTS row_counts (
+               name TEXT PRIMARY KEY,
+               count INTEGER NOT NULL DEFAULT 0
+           )''',
+        "INSERT OR REPLACE INTO row_counts (name, count) VALUES ('logs', (SELECT COUNT(*) FROM logs))",
+        '''CREATE TRIGGER IF NOT EXISTS trg_logs_count_insert AFTER INSERT ON logs
+           BEGIN UPDATE row_counts SET count = count + 1 WHERE name = 'logs'; END''',
+        '''CREATE TRIGGER IF NOT EXISTS trg_logs_count_delete AFTER DELETE ON logs
+           BEGIN UPDATE row_counts SET count = count - 1 WHERE name = 'logs'; END''',
+        'CREATE INDEX IF NOT EXISTS idx_logs_action_created ON logs (action_type, created_at)',
+    )),
+    (7, 'Дневные агрегаты XP для старых daily_actions', (
+        '''CREATE TABLE IF NOT EXISTS daily_xp_rollups (
+               user_id INTEGER NOT NULL,
+               action_date DATE NOT NULL,
+               action_type TEXT NOT NULL DEFAULT '',
+               actions INTEGER NOT NULL DEFAULT 0,
+               xp_earned INTEGER NOT NULL DEFAULT 0,
+               PRIMARY KEY (user_id, action_date, action_type)
+           )''',
+        'CREATE INDEX IF NOT EXISTS idx_daily_actions_date ON daily_actions (action_date)',
+    )),
+    (8, 'Отметки захвата напоминаний для пакетной отправки', (
+        'ALTER TABLE reminders ADD COLUMN claimed_at TIMESTAMP',
+        'ALTER TABLE reminders ADD COLUMN pre_claimed_at TIMESTAMP',
+        '''CREATE INDEX IF NOT EXISTS idx_reminders_claimed ON reminders (claimed_at)
+           WHERE claimed_at IS NOT NULL''',
+        '''CREATE INDEX IF NOT EXISTS idx_reminders_pre_claimed ON reminders (pre_claimed_at)
+           WHERE pre_claimed_at IS NOT NULL''',
+    )),
+    # Версия статистики пользователя — значение общего счётчика 'user_stats' на момент последнего
+    # изменения: годится как ETag и позволяет найти всех, кто изменился после известной версии
+    (9, 'Версии статистики пользователей для ETag и сброса кэша', (
+        'ALTER TABLE users ADD COLUMN stats_version INTEGER NOT NULL DEFAULT 0',
+        "INSERT OR IGNORE INTO data_versions (scope, version) VALUES ('user_stats', 0)",
+        f'''CREATE TRIGGER IF NOT EXISTS trg_user_stats_version_insert AFTER INSERT ON user_stats
+           BEGIN {_stats_version_bump('NEW.user_id')} END''',
+        f'''CREATE TRIGGER IF NOT EXISTS trg_user_stats_version_update
+           AFTER UPDATE OF {', '.join(_STATS_VERSION_WATCHED)} ON user_stats
+           BEGIN {_stats_version_bump('NEW.user_id')} END''',
+        f'''CREATE TRIGGER IF NOT EXISTS trg_users_stats_version AFTER UPDATE OF username, xp, level, daily_xp ON users
+           WHEN OLD.username IS NOT NEW.username OR OLD.xp IS NOT NEW.xp
+                OR OLD.level IS NOT NEW.level OR OLD.daily_xp IS NOT NEW.daily_xp
+           BEGIN {_stats_version_bump('NEW.user_id')} END''',
+        'CREATE INDEX IF NOT EXISTS idx_users_stats_version ON users (stats_version)',
+    )),
+    (10, 'Пульс фоновых сервисов для проверки готовности', (
+        '''CREATE TABLE IF NOT EXISTS service_heartbeats (
+               name TEXT PRIMARY KEY,
+               beat_at REAL NOT NULL,
+               lag_seconds REAL NOT NULL DEFAULT 0,
+               queue_depth INTEGER NOT NULL DEFAULT 0
+           )''',
+    )),
+    (11, 'Версия статистики для новых пользователей (рейтинг в других процессах)', (
+        f'''CREATE TRIGGER IF NOT EXISTS trg_users_stats_version_insert AFTER INSERT ON users
+           BEGIN {_stats_version_bump('NEW.user_id')} END''',
+    )),
+    # Общая статистика без COUNT(*): итоги в row_counts, дневные показатели в daily_stats.
+    # Активные за день считаются по переходу users.last_active на новую дату (у пользователя — раз в день);
+    # для прошлых дней при миграции известен только последний день активности каждого пользователя
+    (12, 'Счётчики общей статистики и история по дням', (
+        *_row_count_triggers('users'),
+        *_row_count_triggers('reminders'),
+        *_row_count_triggers('notes'),
+        *_row_count_triggers('habits'),
+        '''CREATE TABLE IF NOT EXISTS daily_stats (
+               day DATE PRIMARY KEY,
+               active_users INTEGER NOT NULL DEFAULT 0,
+               new_users INTEGER NOT NULL DEFAULT 0,
+               reminders_created INTEGER NOT NULL DEFAULT 0,
+               notes_created INTEGER NOT NULL DEFAULT 0,
+               habits_created INTEGER NOT NULL DEFAULT 0,
+               users_total INTEGER,
+               reminders_total INTEGER,
+               notes_total INTEGER,
+               habits_total INTEGER
+           )''',
+        _daily_stats_backfill('active_users', 'last_active', 'users'),
+        _daily_stats_backfill('new_users', 'DATE(created_at)', 'users'),
+        _daily_stats_backfill('reminders_created', 'DATE(created_at)', 'reminders'),
+        _daily_stats_backfill('notes_created', 'DATE(created_at)', 'notes'),
+        _daily_stats_backfill('habits_created', 'DATE(created_at)', 'habits'),
+        f'''CREATE TRIGGER IF NOT EXISTS trg_users_daily_stats_insert AFTER INSERT ON users
+           BEGIN
+               {_daily_stats_bump("DATE(COALESCE(NEW.created_at, 'now'))", 'new_users')}
+               {_daily_stats_bump("COALESCE(NEW.last_active, DATE('now'))", 'active_users')}
+           END''',
+        f'''CREATE TRIGGER IF NOT EXISTS trg_users_daily_stats_active AFTER UPDATE OF last_active ON users
+           WHEN NEW.last_active IS NOT NULL AND NEW.last_active IS NOT OLD.last_active
+           BEGIN {_daily_stats_bump('NEW.last_active', 'active_users')} END''',
+        *(
+            f'''CREATE TRIGGER IF NOT EXISTS trg_{table}_daily_stats_insert AFTER INSERT ON {table}
+               BEGIN {_daily_stats_bump("DATE(COALESCE(NEW.created_at, 'now'))", f'{table}_created')} END'''
+            for table in ('reminders', 'notes', 'habits')
+        ),
+    )),
+    # xp_required заполнялся по другой кривой, чем считал уровень add_xp; приводим к levels.level_start
+    (13, 'Пороги level_rewards по кривой уровней', (
+        f'UPDATE level_rewards SET xp_required = (level - 1) * (level - 1) * {levels.XP_UNIT}',
+    )),
+    # Докуда загружен файл выгрузки (transfer.py); пишется в той же транзакции, что и сами строки
+    (14, 'Контрольные точки загрузки выгрузок', (
+        '''CREATE TABLE IF NOT EXISTS transfer_checkpoints (
+               name TEXT PRIMARY KEY,
+               position INTEGER NOT NULL,
+               rows INTEGER NOT NULL,
+               done INTEGER NOT NULL DEFAULT 0,
+               updated_at REAL
+           )''',
+    )),
+]
+
+
+def get_schema_version() -> int:
+    """Текущая версия схемы БД"""
+    with get_connection() as conn:
+        return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate() -> int:
+    """Применить недостающие миграции, каждую в своей транзакции. Возвращает версию схемы"""
+    version = get_schema_version()
+    for target, description, statements in MIGRATIONS:
+        if target <= version:
+            continue
+        with transaction() as conn:
+            # Другой процесс мог успеть применить миграцию, пока мы ждали блокировку
+            if conn.execute('PRAGMA user_version').fetchone()[0] >= target:
+                continue
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f'PRAGMA user_version = {target}')
+    return get_schema_version()
 
 
 # ========== Настройки ==========
 
+# Время жизни записи в кэше настроек, секунды
+SETTINGS_CACHE_TTL = float(os.getenv('SETTINGS_CACHE_TTL', '60'))
+# Как часто сверять версию настроек с БД (изменения из других процессов); 0 — не сверять
+SETTINGS_VERSION_CHECK = float(os.getenv('SETTINGS_VERSION_CHECK', '1'))
+
+_MISSING = object()
+
+
+class VersionWatcher:
+    """Следит за версией области в data_versions, обращаясь к БД не чаще interval секунд"""
+
+    def __init__(self, scope: str, interval: float = SETTINGS_VERSION_CHECK):
+        self.scope = scope
+        self.interval = interval
+        self._version = None
+        self._checked_at = 0.0
+
+    def changed(self) -> bool:
+        """True, если версия изменилась с прошлой проверки"""
+        if self.interval <= 0:
+            return False
+        now = time.monotonic()
+        if now - self._checked_at < self.interval:
+            return False
+        self._checked_at = now
+        version = get_data_version(self.scope)
+        changed = self._version is not None and version != self._version
+        self._version = version
+        return changed
+
+
+class SettingsCache:
+    """LRU-кэш bot_settings с TTL и счётчиками попаданий"""
+
+    def __init__(self, ttl: float = SETTINGS_CACHE_TTL, max_size: int = 256,
+                 version_check: float = SETTINGS_VERSION_CHECK):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._watcher = VersionWatcher('settings', version_check)
+
+    def get(self, key: str):
+        """Значение из кэша или _MISSING (None означает, что настройки нет в БД)"""
+        now = time.monotonic()
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and item[1] > now:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return item[0]
+            self.misses += 1
+            return _MISSING
+
+    def put(self, key: str, value):
+        """Положить значение в кэш"""
+        with self._lock:
+            self._items[key] = (value, time.monotonic() + self.ttl)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def invalidate(self, key: str = None):
+        """Сбросить одну настройку или весь кэш"""
+        with self._lock:
+            if key is None:
+                self._items.clear()
+            else:
+                self._items.pop(key, None)
+            self.invalidations += 1
+
+    def sync_version(self):
+        """Сбросить кэш, если настройки поменял другой процесс (версия в data_versions)"""
+        if self._watcher.changed():
+            self.invalidate()
+
+    def stats(self) -> dict:
+        """Счётчики кэша"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'size': len(self._items),
+                'invalidations': self.invalidations
+            }
+
+
+_settings_cache = SettingsCache()
+
+
+def get_data_version(scope: str) -> int:
+    """Версия данных из data_versions (увеличивается триггерами при записи)"""
+    with get_connection() as conn:
+        try:
+            row = conn.execute('SELECT version FROM data_versions WHERE scope = ?', (scope,)).fetchone()
+        except sqlite3.OperationalError:
+            return 0  # миграции ещё не применены
+    return row[0] if row else 0
+
+
 def get_setting(key: str, default: str = None) -> str:
     """Получить настройку"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('SELECT value FROM bot_settings WHERE key = ?', (key,))
-    row = cursor.fetchone()
-    conn.close()
-    return row[0] if row else default
+    _settings_cache.sync_version()
+    value = _settings_cache.get(key)
+    if value is _MISSING:
+        with get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT value FROM bot_settings WHERE key = ?', (key,))
+            row = cursor.fetchone()
+        value = row[0] if row else None
+        _settings_cache.put(key, value)
+    return default if value is None else value
 
 
 def set_setting(key: str, value: str):
     """Установить настройку"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT OR REPLACE INTO bot_settings (key, value) VALUES (?, ?)
-    ''', (key, value))
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT OR REPLACE INTO bot_settings (key, value) VALUES (?, ?)
+        ''', (key, value))
+        conn.commit()
+    _settings_cache.invalidate(key)
+    if key == 'admin_ids':
+        _admin_registry.invalidate()
+
+
+def get_settings_cache_stats() -> dict:
+    """Попадания/промахи кэша настроек"""
+    return _settings_cache.stats()
 
 
 # ========== Пользователи ==========
 
 def add_user(user_id: int, username: str = None):
     """Добавить пользователя"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT OR IGNORE INTO users (user_id, username)
-        VALUES (?, ?)
-    ''', (user_id, username))
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT OR IGNORE INTO users (user_id, username)
+            VALUES (?, ?)
+        ''', (user_id, username))
+        conn.commit()
 
 
 def get_user(user_id: int) -> dict:
     """Получить пользователя"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-    row = cursor.fetchone()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
+        row = cursor.fetchone()
     
     if row:
         return {
@@ -230,82 +808,144 @@ def get_user(user_id: int) -> dict:
     return None
 
 
-def is_admin(user_id: int) -> bool:
-    """Проверка на админа"""
-    user = get_user(user_id)
-    
-    # Проверка по списку admin_ids из .env
-    env_admin_ids = get_admin_ids_from_env()
-    if user_id in env_admin_ids:
-        return True
-    
-    # Проверка по флагу is_admin в БД
-    if user and user['is_admin']:
-        return True
+class AdminRegistry:
+    """
+    Неизменяемое множество ID админов: ADMIN_IDS из .env, флаг users.is_admin и настройка admin_ids
+    Собирается один раз и пересобирается после set_admin/set_setting('admin_ids')
+    или когда другой процесс меняет версию 'admins' в data_versions
+    """
 
-    # Проверка по списку admin_ids в БД
-    admin_ids = get_setting('admin_ids', '')
-    if admin_ids:
-        return str(user_id) in admin_ids.split(',')
+    def __init__(self, version_check: float = SETTINGS_VERSION_CHECK):
+        self._ids = None
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._watcher = VersionWatcher('admins', version_check)
+
+    def _load(self) -> frozenset:
+        """Собрать множество админов из .env и БД"""
+        ids = set(get_admin_ids_from_env())
+        with get_connection() as conn:
+            ids.update(row[0] for row in conn.execute('SELECT user_id FROM users WHERE is_admin'))
+            row = conn.execute("SELECT value FROM bot_settings WHERE key = 'admin_ids'").fetchone()
+        ids.update(parse_id_list(row[0] if row else ''))
+        return frozenset(ids)
+
+    def get(self) -> frozenset:
+        """Актуальное множество ID админов"""
+        if self._watcher.changed():
+            self.invalidate()
+        ids = self._ids
+        if ids is None:
+            with self._lock:
+                generation = self._generation
+                ids = self._load()
+                # Не сохраняем результат, если во время загрузки пришёл invalidate()
+                if generation == self._generation:
+                    self._ids = ids
+        return ids
+
+    def invalidate(self):
+        """Пересобрать множество при следующем обращении"""
+        self._generation += 1
+        self._ids = None
+
+
+_admin_registry = AdminRegistry()
+
+
+def get_admin_ids() -> frozenset:
+    """Все ID админов"""
+    return _admin_registry.get()
 
-    return False
+
+def is_admin(user_id: int) -> bool:
+    """Проверка на админа"""
+    return user_id in _admin_registry.get()
 
 
 def set_admin(user_id: int, is_admin_flag: bool):
     """Назначить/снять админа"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        UPDATE users SET is_admin = ? WHERE user_id = ?
-    ''', (is_admin_flag, user_id))
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE users SET is_admin = ? WHERE user_id = ?
+        ''', (is_admin_flag, user_id))
+        conn.commit()
+    _admin_registry.invalidate()
 
 
 def reset_daily_xp(user_id: int):
     """Сброс дневного XP"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE users SET daily_xp = 0, daily_xp_reset = DATE('now')
+            WHERE user_id = ? AND daily_xp_reset < DATE('now')
+        ''', (user_id,))
+        conn.commit()
+
+
+def _reset_and_read_daily(cursor, user_id: int):
+    """
+    Сбросить дневной XP, если наступил новый день, и прочитать состояние одним UPDATE … RETURNING
+    Возвращает (xp, level, daily_xp, daily_limit) или None, если пользователя нет
+    """
     cursor.execute('''
-        UPDATE users SET daily_xp = 0, daily_xp_reset = DATE('now')
-        WHERE user_id = ? AND daily_xp_reset < DATE('now')
+        UPDATE users
+        SET daily_xp = CASE WHEN daily_xp_reset < DATE('now') THEN 0 ELSE daily_xp END,
+            daily_xp_reset = DATE('now')
+        WHERE user_id = ?
+        RETURNING xp, level, daily_xp,
+            (SELECT CAST(value AS INTEGER) FROM bot_settings WHERE key = 'daily_xp_limit')
     ''', (user_id,))
-    conn.commit()
-    conn.close()
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    xp, level, daily_xp, daily_limit = row
+    return xp, level, daily_xp, 500 if daily_limit is None else daily_limit
 
 
 def check_daily_limit(user_id: int, xp_amount: int) -> tuple:
     """Проверка лимита XP на день"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    # Сброс если новый день
-    cursor.execute('''
-        UPDATE users SET daily_xp = 0, daily_xp_reset = DATE('now')
-        WHERE user_id = ? AND daily_xp_reset < DATE('now')
-    ''', (user_id,))
-    
-    # Получаем текущий дневной XP
-    cursor.execute('SELECT daily_xp FROM users WHERE user_id = ?', (user_id,))
-    row = cursor.fetchone()
+    with transaction() as conn:
+        state = _reset_and_read_daily(conn.cursor(), user_id)
     
-    daily_limit = int(get_setting('daily_xp_limit', '500'))
-    
-    if row:
-        current_daily = row[0]
+    if state:
+        _, _, current_daily, daily_limit = state
         if current_daily + xp_amount > daily_limit:
-            conn.close()
             return False, daily_limit - current_daily  # Превышен лимит
     
-    conn.close()
     return True, 0  # ОК
 
 
 # ========== Система XP и уровней ==========
 
+_xp_listeners = []
+
+
+def add_xp_listener(callback):
+    """Подписаться на изменение XP: callback(user_id, new_xp) после commit add_xp"""
+    _xp_listeners.append(callback)
+
+
+def remove_xp_listener(callback):
+    """Отписаться от изменений XP"""
+    if callback in _xp_listeners:
+        _xp_listeners.remove(callback)
+
+
+def _notify_xp_listeners(user_id: int, new_xp: int):
+    """Сообщить подписчикам о новом XP пользователя"""
+    for callback in list(_xp_listeners):
+        callback(user_id, new_xp)
+
+
 def add_xp(user_id: int, xp_amount: int, action_type: str = "general") -> dict:
     """
     Добавить XP пользователю с проверкой лимитов
+    Сброс дня, проверка лимита, начисление, запись действия и бонус за уровень
+    выполняются в одной транзакции BEGIN IMMEDIATE, поэтому параллельные начисления
+    не могут превысить daily_xp_limit
     Возвращает: {'success': bool, 'xp_added': int, 'level': int, 'level_up': bool, 'reward': str}
     """
     result = {
@@ -316,245 +956,389 @@ def add_xp(user_id: int, xp_amount: int, action_type: str = "general") -> dict:
         'reward': None,
         'message': ''
     }
+    level_table = get_level_table()
     
-    # Проверка дневного лимита
-    allowed, remaining = check_daily_limit(user_id, xp_amount)
-    
-    if not allowed:
-        result['message'] = f"⚠️ Дневной лимит XP исчерпан! Осталось: {remaining} XP"
-        return result
-    
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    # Получаем текущего пользователя
-    cursor.execute('SELECT xp, level FROM users WHERE user_id = ?', (user_id,))
-    row = cursor.fetchone()
-    
-    if row:
-        current_xp, current_level = row
+    with transaction() as conn:
+        cursor = conn.cursor()
         
-        # Ограничиваем XP дневным лимитом
-        actual_xp = min(xp_amount, remaining) if remaining > 0 else 0
+        state = _reset_and_read_daily(cursor, user_id)
+        if state is None or xp_amount <= 0:
+            return result
         
-        if actual_xp > 0:
-            new_xp = current_xp + actual_xp
-            
-            # Формула уровня: level = sqrt(xp / 100) + 1
-            new_level = int((new_xp / 100) ** 0.5) + 1
-            
-            # Обновляем пользователя
-            cursor.execute('''
-                UPDATE users SET xp = ?, level = ?, daily_xp = daily_xp + ?, last_active = DATE('now')
-                WHERE user_id = ?
-            ''', (new_xp, new_level, actual_xp, user_id))
-            
-            # Записываем действие
-            cursor.execute('''
-                INSERT INTO daily_actions (user_id, action_type, xp_earned)
-                VALUES (?, ?, ?)
-            ''', (user_id, action_type, actual_xp))
-            
-            result['success'] = True
-            result['xp_added'] = actual_xp
-            result['level'] = new_level
+        current_xp, current_level, current_daily, daily_limit = state
+        result['level'] = current_level
+        
+        # Проверка дневного лимита
+        if current_daily + xp_amount > daily_limit:
+            result['message'] = f"⚠️ Дневной лимит XP исчерпан! Осталось: {daily_limit - current_daily} XP"
+            return result
+        
+        new_xp = current_xp + xp_amount
+        new_level = levels.level_for_xp(new_xp)
+        
+        result['success'] = True
+        result['xp_added'] = xp_amount
+        result['level'] = new_level
+        
+        # Проверка на повышение уровня
+        if new_level > current_level:
+            result['level_up'] = True
             
-            # Проверка на повышение уровня
-            if new_level > current_level:
-                result['level_up'] = True
-                
-                # Получаем награду за уровень
-                cursor.execute('''
-                    SELECT reward_text, reward_xp FROM level_rewards WHERE level = ?
-                ''', (new_level,))
-                reward_row = cursor.fetchone()
+            reward = level_table.reward(new_level)
+            if reward:
+                result['reward'] = reward.reward_text
                 
-                if reward_row:
-                    result['reward'] = reward_row[0]
-                    
-                    # Если есть бонусный XP за награду
-                    if reward_row[1] > 0:
-                        bonus_xp = reward_row[1]
-                        new_xp += bonus_xp
-                        cursor.execute('UPDATE users SET xp = ? WHERE user_id = ?', (new_xp, user_id))
-                        result['message'] = f"🎉 +{bonus_xp} XP бонус!"
-            
-            conn.commit()
+                # Если есть бонусный XP за награду (в дневной лимит не входит)
+                if reward.reward_xp > 0:
+                    new_xp += reward.reward_xp
+                    result['message'] = f"🎉 +{reward.reward_xp} XP бонус!"
+                    # Бонус может перенести через следующий порог — уровень всегда по итоговому XP
+                    new_level = result['level'] = levels.level_for_xp(new_xp)
+        
+        # Обновляем пользователя
+        cursor.execute('''
+            UPDATE users SET xp = ?, level = ?, daily_xp = daily_xp + ?, last_active = DATE('now')
+            WHERE user_id = ?
+        ''', (new_xp, new_level, xp_amount, user_id))
+        
+        # Записываем действие
+        cursor.execute('''
+            INSERT INTO daily_actions (user_id, action_type, xp_earned)
+            VALUES (?, ?, ?)
+        ''', (user_id, action_type, xp_amount))
     
-    conn.close()
+    _notify_xp_listeners(user_id, new_xp)
     return result
 
 
+def get_user_rank(user_id: int) -> int:
+    """
+    Место пользователя по XP (1 — первый; при равном XP выше тот, у кого меньше user_id)
+    Считает пользователей выше по индексу idx_users_xp, не читая строк. None — пользователя нет
+    """
+    with get_connection() as conn:
+        row = conn.execute('SELECT xp FROM users WHERE user_id = ?', (user_id,)).fetchone()
+        if not row:
+            return None
+        return 1 + conn.execute('''
+            SELECT (SELECT COUNT(*) FROM users WHERE xp > ?)
+                 + (SELECT COUNT(*) FROM users WHERE xp = ? AND user_id < ?)
+        ''', (row[0], row[0], user_id)).fetchone()[0]
+
+
+def get_leaderboard(limit: int = 10, offset: int = 0) -> list:
+    """Рейтинг по XP: [{'rank', 'user_id', 'username', 'xp', 'level'}] по индексу idx_users_xp"""
+    with get_connection() as conn:
+        rows = conn.execute('''
+            SELECT user_id, username, xp, level FROM users
+            ORDER BY xp DESC, user_id
+            LIMIT ? OFFSET ?
+        ''', (limit, offset)).fetchall()
+    return [
+        {'rank': offset + i + 1, 'user_id': row[0], 'username': row[1], 'xp': row[2], 'level': row[3]}
+        for i, row in enumerate(rows)
+    ]
+
+
+_level_table = None
+_level_table_lock = threading.Lock()
+
+
+def get_level_table() -> levels.LevelTable:
+    """Награды за уровни из level_rewards — читаются один раз за процесс"""
+    global _level_table
+    if _level_table is None:
+        with _level_table_lock:
+            if _level_table is None:
+                with get_connection() as conn:
+                    rows = conn.execute('SELECT level, xp_required, reward_text, reward_xp FROM level_rewards').fetchall()
+                _level_table = levels.LevelTable(rows)
+    return _level_table
+
+
 def get_xp_for_level(level: int) -> int:
-    """Сколько XP нужно для уровня"""
-    return ((level) ** 2) * 100
+    """Сколько XP нужно, чтобы пройти уровень (= начало уровня level + 1)"""
+    return levels.level_start(level + 1)
 
 
 def get_level_progress(user_id: int) -> dict:
     """Прогресс до следующего уровня"""
     user = get_user(user_id)
-    if not user:
-        return {'level': 1, 'xp': 0, 'next_level_xp': 100, 'progress_percent': 0, 'daily_xp': 0, 'daily_limit': 500}
-    
-    current_level = user['level']
-    current_xp = user['xp']
-    
-    # XP для текущего уровня
-    current_level_xp = get_xp_for_level(current_level - 1)
-    # XP для следующего уровня
-    next_level_xp = get_xp_for_level(current_level)
-    
-    # Прогресс в текущем уровне
-    xp_in_level = current_xp - current_level_xp
-    xp_needed = next_level_xp - current_level_xp
-    progress_percent = (xp_in_level / xp_needed * 100) if xp_needed > 0 else 0
-    
-    # Дневной лимит
-    daily_limit = int(get_setting('daily_xp_limit', '500'))
-    
-    return {
-        'level': current_level,
-        'xp': current_xp,
-        'next_level_xp': next_level_xp,
-        'xp_in_level': xp_in_level,
-        'xp_needed': xp_needed,
-        'progress': xp_in_level,
-        'progress_percent': min(100, progress_percent),
-        'daily_xp': user['daily_xp'],
-        'daily_limit': daily_limit
-    }
+    progress = get_level_table().progress(user['xp'] if user else 0)
+    progress['progress'] = progress['xp_in_level']
+    progress['daily_xp'] = user['daily_xp'] if user else 0
+    progress['daily_limit'] = int(get_setting('daily_xp_limit', '500'))
+    return progress
 
 
 def get_level_rewards() -> list:
     """Получить все награды за уровни"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('SELECT level, xp_required, reward_text, reward_xp FROM level_rewards ORDER BY level')
-    rows = cursor.fetchall()
-    conn.close()
-    
-    return [
-        {'level': row[0], 'xp_required': row[1], 'reward_text': row[2], 'reward_xp': row[3]}
-        for row in rows
-    ]
+    return [reward._asdict() for reward in get_level_table().rewards]
+
+
+def check_levels() -> list:
+    """Сверить xp_required в level_rewards и users.level с кривой уровней. Возвращает список расхождений"""
+    problems = []
+    with get_connection() as conn:
+        for level, xp_required in conn.execute('SELECT level, xp_required FROM level_rewards'):
+            if xp_required != levels.level_start(level):
+                problems.append(f"level_rewards: уровень {level} с {xp_required} XP, по кривой {levels.level_start(level)}")
+        stale = sum(
+            1 for xp, level in conn.execute('SELECT COALESCE(xp, 0), level FROM users')
+            if level != levels.level_for_xp(xp)
+        )
+    if stale:
+        problems.append(f"У {stale} пользователей users.level не совпадает с кривой (python database.py repair-levels)")
+    return problems
+
+
+def repair_levels() -> int:
+    """Пересчитать users.level по XP (раньше бонус за уровень мог перенести XP через порог). Возвращает число исправленных"""
+    with transaction() as conn:
+        rows = [
+            (levels.level_for_xp(xp), user_id)
+            for user_id, xp, level in conn.execute('SELECT user_id, COALESCE(xp, 0), level FROM users')
+            if level != levels.level_for_xp(xp)
+        ]
+        conn.executemany('UPDATE users SET level = ? WHERE user_id = ?', rows)
+    return len(rows)
 
 
 def update_timezone(user_id: int, timezone: str):
     """Обновить часовой пояс"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        UPDATE users SET timezone = ? WHERE user_id = ?
-    ''', (timezone, user_id))
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE users SET timezone = ? WHERE user_id = ?
+        ''', (timezone, user_id))
+        conn.commit()
 
 
 # ========== Напоминания ==========
 
+# Подписчики на изменения напоминаний (например, reminder_dispatcher): callback(event, reminder_id, remind_at)
+_reminder_listeners = []
+
+
+def add_reminder_listener(callback):
+    """Подписаться на добавление ('add') и снятие ('remove') напоминаний"""
+    _reminder_listeners.append(callback)
+
+
+def remove_reminder_listener(callback):
+    """Отписаться от изменений напоминаний"""
+    if callback in _reminder_listeners:
+        _reminder_listeners.remove(callback)
+
+
+def _notify_reminder_listeners(event: str, reminder_id: int, remind_at=None):
+    """Сообщить подписчикам об изменении напоминания (после commit)"""
+    for callback in list(_reminder_listeners):
+        callback(event, reminder_id, remind_at)
+
+
 def add_reminder(user_id: int, title: str, remind_at: datetime, 
                  description: str = None, location: str = None):
     """Добавить напоминание"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO reminders (user_id, title, description, remind_at, location)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (user_id, title, description, remind_at, location))
-    reminder_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO reminders (user_id, title, description, remind_at, location)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (user_id, title, description, remind_at, location))
+        reminder_id = cursor.lastrowid
+        conn.commit()
+    _notify_reminder_listeners('add', reminder_id, remind_at)
     return reminder_id
 
 
+def reminder_from_row(row) -> dict:
+    """Строка reminders (SELECT *) в словарь"""
+    return {
+        'id': row[0],
+        'user_id': row[1],
+        'title': row[2],
+        'description': row[3],
+        'remind_at': row[4],
+        'location': row[5],
+        'is_completed': row[6],
+        'notified': row[7],
+        'pre_notified': row[8] if len(row) > 8 else False
+    }
+
+
+def get_upcoming_reminders(until: datetime, pre_notify_until: datetime, now: datetime) -> list:
+    """
+    Напоминания для планировщика: не отправленные со сроком до until
+    и ещё не предупреждённые со сроком в (now, pre_notify_until]
+    Оба запроса идут по частичным индексам idx_reminders_pending / idx_reminders_pre_notify
+    """
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT * FROM reminders
+            WHERE is_completed = FALSE AND notified = FALSE AND remind_at <= ?
+            UNION
+            SELECT * FROM reminders
+            WHERE is_completed = FALSE AND pre_notified = FALSE AND remind_at > ? AND remind_at <= ?
+        ''', (until, now, pre_notify_until))
+        rows = cursor.fetchall()
+    return [reminder_from_row(row) for row in rows]
+
+
+# Флаг отправки и отметка захвата для каждого вида уведомления
+_CLAIM_COLUMNS = {
+    'notified': ('notified', 'claimed_at'),
+    'pre_notified': ('pre_notified', 'pre_claimed_at'),
+}
+
+
+def claim_reminders(reminder_ids: list, kind: str = 'notified') -> list:
+    """
+    Атомарно захватить напоминания по ID одним UPDATE … RETURNING (kind: 'notified' или 'pre_notified')
+    Возвращаются только те, чей флаг поставил именно этот вызов: уже отправленные или снятые пропускаются
+    ID передаются одним JSON-параметром (json_each), поэтому лимит переменных SQLite не мешает
+    """
+    if not reminder_ids:
+        return []
+    flag, claimed = _CLAIM_COLUMNS[kind]
+    with transaction() as conn:
+        rows = conn.execute(f'''
+            UPDATE reminders SET {flag} = TRUE, {claimed} = CURRENT_TIMESTAMP
+            WHERE id IN (SELECT value FROM json_each(?)) AND {flag} = FALSE AND is_completed = FALSE
+            RETURNING *
+        ''', (json.dumps(list(reminder_ids)),)).fetchall()
+    return [reminder_from_row(row) for row in rows]
+
+
+def claim_due_reminders(limit: int = 100, kind: str = 'notified',
+                        pre_notify_before: str = '+1 hour') -> list:
+    """
+    Захватить до limit наступивших напоминаний и вернуть их одним запросом
+    kind='notified' — срок уже наступил; kind='pre_notified' — срок в ближайшие pre_notify_before
+    После отправки вызовите ack_reminders для успешных и release_reminders для неудачных
+    """
+    flag, claimed = _CLAIM_COLUMNS[kind]
+    if kind == 'pre_notified':
+        due = "remind_at > datetime('now') AND remind_at <= datetime('now', ?)"
+        params = (pre_notify_before, limit)
+    else:
+        due = "remind_at <= datetime('now')"
+        params = (limit,)
+    with transaction() as conn:
+        # Подзапрос совпадает с условием частичного индекса, поэтому выбор идёт по индексу
+        rows = conn.execute(f'''
+            UPDATE reminders SET {flag} = TRUE, {claimed} = CURRENT_TIMESTAMP
+            WHERE id IN (
+                SELECT id FROM reminders
+                WHERE is_completed = FALSE AND {flag} = FALSE AND {due}
+                ORDER BY remind_at
+                LIMIT ?
+            )
+            RETURNING *
+        ''', params).fetchall()
+    rows.sort(key=lambda row: row[4])
+    return [reminder_from_row(row) for row in rows]
+
+
+def ack_reminders(reminder_ids: list, kind: str = 'notified'):
+    """Подтвердить отправку захваченных напоминаний"""
+    if not reminder_ids:
+        return
+    _, claimed = _CLAIM_COLUMNS[kind]
+    with transaction() as conn:
+        conn.execute(
+            f"UPDATE reminders SET {claimed} = NULL WHERE id IN (SELECT value FROM json_each(?))",
+            (json.dumps(list(reminder_ids)),)
+        )
+
+
+def release_reminders(reminder_ids: list, kind: str = 'notified'):
+    """Вернуть захваченные напоминания в очередь (отправка не удалась)"""
+    if not reminder_ids:
+        return
+    flag, claimed = _CLAIM_COLUMNS[kind]
+    with transaction() as conn:
+        conn.execute(
+            f"UPDATE reminders SET {flag} = FALSE, {claimed} = NULL "
+            f"WHERE id IN (SELECT value FROM json_each(?)) AND {claimed} IS NOT NULL",
+            (json.dumps(list(reminder_ids)),)
+        )
+
+
+def release_stale_claims(older_than: str = '-10 minutes', kind: str = 'notified') -> list:
+    """
+    Вернуть в очередь захваты без подтверждения старше older_than (процесс упал посреди отправки)
+    Такие напоминания будут отправлены ещё раз: лучше дубль, чем потерянное уведомление
+    """
+    flag, claimed = _CLAIM_COLUMNS[kind]
+    with transaction() as conn:
+        rows = conn.execute(f'''
+            UPDATE reminders SET {flag} = FALSE, {claimed} = NULL
+            WHERE {claimed} IS NOT NULL AND {claimed} < datetime('now', ?)
+            RETURNING id
+        ''', (older_than,)).fetchall()
+    return [row[0] for row in rows]
+
+
 def get_pending_reminders():
     """Получить напоминания, которые нужно отправить"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    with get_connection() as conn:
+        cursor = conn.cursor()
 
-    cursor.execute('''
-        SELECT * FROM reminders
-        WHERE is_completed = FALSE
-        AND notified = FALSE
-        AND remind_at <= datetime('now')
-        ORDER BY remind_at
-    ''')
+        cursor.execute('''
+            SELECT * FROM reminders
+            WHERE is_completed = FALSE
+            AND notified = FALSE
+            AND remind_at <= datetime('now')
+            ORDER BY remind_at
+        ''')
 
-    rows = cursor.fetchall()
-    conn.close()
+        rows = cursor.fetchall()
 
-    return [
-        {
-            'id': row[0],
-            'user_id': row[1],
-            'title': row[2],
-            'description': row[3],
-            'remind_at': row[4],
-            'location': row[5],
-            'is_completed': row[6],
-            'notified': row[7],
-            'pre_notified': row[8] if len(row) > 8 else False
-        }
-        for row in rows
-    ]
+    return [reminder_from_row(row) for row in rows]
 
 
 def get_pre_notify_reminders():
     """Получить напоминания для предварительного уведомления (за 1 час)"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    with get_connection() as conn:
+        cursor = conn.cursor()
 
-    # Находим напоминания, которые сработают через 1 час
-    cursor.execute('''
-        SELECT * FROM reminders
-        WHERE is_completed = FALSE
-        AND pre_notified = FALSE
-        AND remind_at > datetime('now')
-        AND remind_at <= datetime('now', '+1 hour')
-        ORDER BY remind_at
-    ''')
+        # Находим напоминания, которые сработают через 1 час
+        cursor.execute('''
+            SELECT * FROM reminders
+            WHERE is_completed = FALSE
+            AND pre_notified = FALSE
+            AND remind_at > datetime('now')
+            AND remind_at <= datetime('now', '+1 hour')
+            ORDER BY remind_at
+        ''')
 
-    rows = cursor.fetchall()
-    conn.close()
+        rows = cursor.fetchall()
 
-    return [
-        {
-            'id': row[0],
-            'user_id': row[1],
-            'title': row[2],
-            'description': row[3],
-            'remind_at': row[4],
-            'location': row[5],
-            'is_completed': row[6],
-            'notified': row[7],
-            'pre_notified': row[8] if len(row) > 8 else False
-        }
-        for row in rows
-    ]
+    return [reminder_from_row(row) for row in rows]
 
 
 def mark_pre_notified(reminder_id: int):
     """Отметить что предварительное уведомление отправлено"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        UPDATE reminders SET pre_notified = TRUE WHERE id = ?
-    ''', (reminder_id,))
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE reminders SET pre_notified = TRUE WHERE id = ?
+        ''', (reminder_id,))
+        conn.commit()
 
 
 def get_all_reminders(user_id: int):
     """Получить все напоминания пользователя"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT * FROM reminders 
-        WHERE user_id = ?
-        ORDER BY remind_at DESC
-    ''', (user_id,))
-    rows = cursor.fetchall()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT * FROM reminders 
+            WHERE user_id = ?
+            ORDER BY remind_at DESC
+        ''', (user_id,))
+        rows = cursor.fetchall()
     
     return [
         {
@@ -571,11 +1355,10 @@ def get_all_reminders(user_id: int):
 
 def get_reminder_by_id(reminder_id: int):
     """Получить напоминание по ID"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM reminders WHERE id = ?', (reminder_id,))
-    row = cursor.fetchone()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM reminders WHERE id = ?', (reminder_id,))
+        row = cursor.fetchone()
     
     if row:
         return {
@@ -592,62 +1375,59 @@ def get_reminder_by_id(reminder_id: int):
 
 def complete_reminder(reminder_id: int):
     """Отметить напоминание выполненным"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        UPDATE reminders SET is_completed = TRUE WHERE id = ?
-    ''', (reminder_id,))
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE reminders SET is_completed = TRUE WHERE id = ?
+        ''', (reminder_id,))
+        conn.commit()
+    _notify_reminder_listeners('remove', reminder_id)
 
 
 def delete_reminder(reminder_id: int):
     """Удалить напоминание"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM reminders WHERE id = ?', (reminder_id,))
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM reminders WHERE id = ?', (reminder_id,))
+        conn.commit()
+    _notify_reminder_listeners('remove', reminder_id)
 
 
 def mark_notified(reminder_id: int):
     """Отметить что уведомление отправлено"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        UPDATE reminders SET notified = TRUE WHERE id = ?
-    ''', (reminder_id,))
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE reminders SET notified = TRUE WHERE id = ?
+        ''', (reminder_id,))
+        conn.commit()
 
 
 # ========== Заметки ==========
 
 def add_note(user_id: int, content: str, title: str = None, category: str = 'general'):
     """Добавить заметку"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO notes (user_id, title, content, category)
-        VALUES (?, ?, ?, ?)
-    ''', (user_id, title, content, category))
-    note_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO notes (user_id, title, content, category)
+            VALUES (?, ?, ?, ?)
+        ''', (user_id, title, content, category))
+        note_id = cursor.lastrowid
+        conn.commit()
     return note_id
 
 
 def get_all_notes(user_id: int):
     """Получить все заметки"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT * FROM notes 
-        WHERE user_id = ?
-        ORDER BY is_pinned DESC, created_at DESC
-    ''', (user_id,))
-    rows = cursor.fetchall()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT * FROM notes 
+            WHERE user_id = ?
+            ORDER BY is_pinned DESC, created_at DESC
+        ''', (user_id,))
+        rows = cursor.fetchall()
     
     return [
         {
@@ -664,11 +1444,10 @@ def get_all_notes(user_id: int):
 
 def get_note_by_id(note_id: int):
     """Получить заметку по ID"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM notes WHERE id = ?', (note_id,))
-    row = cursor.fetchone()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM notes WHERE id = ?', (note_id,))
+        row = cursor.fetchone()
     
     if row:
         return {
@@ -683,50 +1462,46 @@ def get_note_by_id(note_id: int):
 
 def delete_note(note_id: int):
     """Удалить заметку"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM notes WHERE id = ?', (note_id,))
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM notes WHERE id = ?', (note_id,))
+        conn.commit()
 
 
 def toggle_pin_note(note_id: int):
     """Закрепить/открепить заметку"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        UPDATE notes SET is_pinned = NOT is_pinned WHERE id = ?
-    ''', (note_id,))
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE notes SET is_pinned = NOT is_pinned WHERE id = ?
+        ''', (note_id,))
+        conn.commit()
 
 
 # ========== Привычки ==========
 
 def add_habit(user_id: int, title: str, frequency: str = 'daily'):
     """Добавить привычку"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO habits (user_id, title, frequency)
-        VALUES (?, ?, ?)
-    ''', (user_id, title, frequency))
-    habit_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO habits (user_id, title, frequency)
+            VALUES (?, ?, ?)
+        ''', (user_id, title, frequency))
+        habit_id = cursor.lastrowid
+        conn.commit()
     return habit_id
 
 
 def get_all_habits(user_id: int):
     """Получить все привычки"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT * FROM habits WHERE user_id = ?
-        ORDER BY created_at DESC
-    ''', (user_id,))
-    rows = cursor.fetchall()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT * FROM habits WHERE user_id = ?
+            ORDER BY created_at DESC
+        ''', (user_id,))
+        rows = cursor.fetchall()
     
     return [
         {
@@ -743,11 +1518,10 @@ def get_all_habits(user_id: int):
 
 def get_habit_by_id(habit_id: int):
     """Получить привычку по ID"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM habits WHERE id = ?', (habit_id,))
-    row = cursor.fetchone()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM habits WHERE id = ?', (habit_id,))
+        row = cursor.fetchone()
     
     if row:
         return {
@@ -764,249 +1538,522 @@ def get_habit_by_id(habit_id: int):
 def complete_habit(habit_id: int) -> dict:
     """Отметить привычку выполненной"""
     from datetime import date
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT streak, last_completed, total_completed FROM habits WHERE id = ?', (habit_id,))
-    row = cursor.fetchone()
-    
-    result = {'success': False, 'new_streak': 0, 'already_done': False}
-    
-    if row:
-        streak, last_completed, total_completed = row
-        today = str(date.today())
+    with get_connection() as conn:
+        cursor = conn.cursor()
         
-        if last_completed == today:
-            result['already_done'] = True
-        else:
-            new_streak = streak + 1 if last_completed else 1
-            new_total = total_completed + 1
-            
-            cursor.execute('''
-                UPDATE habits SET streak = ?, total_completed = ?, last_completed = ?
-                WHERE id = ?
-            ''', (new_streak, new_total, today, habit_id))
+        cursor.execute('SELECT streak, last_completed, total_completed FROM habits WHERE id = ?', (habit_id,))
+        row = cursor.fetchone()
+        
+        result = {'success': False, 'new_streak': 0, 'already_done': False}
+        
+        if row:
+            streak, last_completed, total_completed = row
+            today = str(date.today())
             
-            result['success'] = True
-            result['new_streak'] = new_streak
-            result['new_total'] = new_total
-    
-    conn.commit()
-    conn.close()
+            if last_completed == today:
+                result['already_done'] = True
+            else:
+                new_streak = streak + 1 if last_completed else 1
+                new_total = total_completed + 1
+                
+                cursor.execute('''
+                    UPDATE habits SET streak = ?, total_completed = ?, last_completed = ?
+                    WHERE id = ?
+                ''', (new_streak, new_total, today, habit_id))
+                
+                result['success'] = True
+                result['new_streak'] = new_streak
+                result['new_total'] = new_total
+        
+        conn.commit()
     return result
 
 
 def delete_habit(habit_id: int):
     """Удалить привычку"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM habits WHERE id = ?', (habit_id,))
-    conn.commit()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM habits WHERE id = ?', (habit_id,))
+        conn.commit()
 
 
 # ========== Статистика ==========
 
-def get_user_stats(user_id: int) -> dict:
-    """Получить полную статистику пользователя"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    # Напоминания
-    cursor.execute('SELECT COUNT(*), SUM(CASE WHEN is_completed THEN 1 ELSE 0 END) FROM reminders WHERE user_id = ?', (user_id,))
-    rem_row = cursor.fetchone()
-    
-    # Заметки
-    cursor.execute('SELECT COUNT(*), SUM(CASE WHEN is_pinned THEN 1 ELSE 0 END) FROM notes WHERE user_id = ?', (user_id,))
-    note_row = cursor.fetchone()
-    
-    # Привычки
-    cursor.execute('SELECT COUNT(*), SUM(streak), SUM(total_completed) FROM habits WHERE user_id = ?', (user_id,))
-    habit_row = cursor.fetchone()
-    
-    # XP за сегодня
-    cursor.execute('''
-        SELECT SUM(xp_earned) FROM daily_actions 
-        WHERE user_id = ? AND action_date = DATE('now')
-    ''', (user_id,))
-    today_xp_row = cursor.fetchone()
-    
-    conn.close()
-    
+# Счётчики статистики из user_stats; XP за день учитывается только за сегодня
+_USER_STATS_COLUMNS = '''
+    total_reminders, completed_reminders, total_notes, pinned_notes,
+    total_habits, total_streak, total_habit_completions,
+    CASE WHEN xp_day = DATE('now') THEN xp_day_total ELSE 0 END
+'''
+
+# Больше ID за один get_users_stats не принимаем
+USERS_STATS_MAX_IDS = 5000
+
+
+def _user_stats_from_row(row) -> dict:
+    """Строка счётчиков user_stats в словарь; None или NULL (счётчиков ещё нет) — нули"""
+    row = row or (0,) * 8
     return {
-        'total_reminders': rem_row[0] or 0,
-        'completed_reminders': rem_row[1] or 0,
-        'total_notes': note_row[0] or 0,
-        'pinned_notes': note_row[1] or 0,
-        'total_habits': habit_row[0] or 0,
-        'total_streak': habit_row[1] or 0,
-        'total_habit_completions': habit_row[2] or 0,
-        'today_xp': today_xp_row[0] or 0
+        'total_reminders': row[0] or 0,
+        'completed_reminders': row[1] or 0,
+        'total_notes': row[2] or 0,
+        'pinned_notes': row[3] or 0,
+        'total_habits': row[4] or 0,
+        'total_streak': row[5] or 0,
+        'total_habit_completions': row[6] or 0,
+        'today_xp': row[7] or 0
     }
 
 
-def get_global_stats() -> dict:
-    """Получить глобальную статистику бота"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    # Пользователи
-    cursor.execute('SELECT COUNT(*) FROM users')
-    users_count = cursor.fetchone()[0]
-    
-    # Активные сегодня
-    cursor.execute("SELECT COUNT(*) FROM users WHERE last_active = DATE('now')")
-    active_today = cursor.fetchone()[0]
-    
-    # Всего напоминаний
-    cursor.execute('SELECT COUNT(*) FROM reminders')
-    total_reminders = cursor.fetchone()[0]
-    
-    # Всего заметок
-    cursor.execute('SELECT COUNT(*) FROM notes')
-    total_notes = cursor.fetchone()[0]
-    
-    # Всего привычек
-    cursor.execute('SELECT COUNT(*) FROM habits')
-    total_habits = cursor.fetchone()[0]
+def get_user_stats(user_id: int) -> dict:
+    """Получить полную статистику пользователя (одно чтение user_stats по ключу)"""
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'SELECT {_USER_STATS_COLUMNS} FROM user_stats WHERE user_id = ?', (user_id,))
+        row = cursor.fetchone()
     
-    conn.close()
+    return _user_stats_from_row(row)
+
+
+def get_users_stats(user_ids) -> dict:
+    """
+    Статистика нескольких пользователей одним запросом: {user_id: статистика как у get_user_stats}
+    ID передаются одним JSON-параметром (json_each), поэтому лимит переменных SQLite не мешает
+    """
+    ids = list(dict.fromkeys(int(user_id) for user_id in user_ids))
+    if len(ids) > USERS_STATS_MAX_IDS:
+        raise ValueError(f"Не больше {USERS_STATS_MAX_IDS} пользователей за запрос")
+    if not ids:
+        return {}
+    with get_connection() as conn:
+        rows = conn.execute(f'''
+            SELECT ids.value, {_USER_STATS_COLUMNS}
+            FROM json_each(?) AS ids
+            LEFT JOIN user_stats s ON s.user_id = ids.value
+        ''', (json.dumps(ids),)).fetchall()
+    return {row[0]: _user_stats_from_row(row[1:]) for row in rows}
+
+
+def repair_user_stats() -> int:
+    """Пересчитать user_stats по базовым таблицам. Возвращает число строк"""
+    with transaction() as conn:
+        conn.execute('DELETE FROM user_stats')
+        conn.execute(USER_STATS_REBUILD_SQL)
+        return conn.execute('SELECT COUNT(*) FROM user_stats').fetchone()[0]
+
+
+USER_STATS_COUNTERS = (
+    'total_reminders', 'completed_reminders', 'total_notes', 'pinned_notes',
+    'total_habits', 'total_streak', 'total_habit_completions',
+)
+
+
+def check_user_stats() -> list:
+    """Сверить user_stats с базовыми таблицами. Возвращает ID пользователей с расхождениями"""
+    today_xp = "CASE WHEN {t}.xp_day = DATE('now') THEN {t}.xp_day_total ELSE 0 END"
+    mismatch = ' OR '.join(
+        [f"COALESCE(a.{col}, 0) != COALESCE(e.{col}, 0)" for col in USER_STATS_COUNTERS]
+        + [f"COALESCE({today_xp.format(t='a')}, 0) != COALESCE({today_xp.format(t='e')}, 0)"]
+    )
+    with transaction(immediate=False) as conn:
+        conn.execute('CREATE TEMP TABLE IF NOT EXISTS expected_stats AS SELECT * FROM main.user_stats WHERE 0')
+        conn.execute('DELETE FROM temp.expected_stats')
+        conn.execute(USER_STATS_REBUILD_SQL.replace('INSERT INTO user_stats', 'INSERT INTO temp.expected_stats', 1))
+        rows = conn.execute(f'''
+            SELECT ids.user_id
+            FROM (SELECT user_id FROM main.user_stats UNION SELECT user_id FROM temp.expected_stats) AS ids
+            LEFT JOIN main.user_stats AS a ON a.user_id = ids.user_id
+            LEFT JOIN temp.expected_stats AS e ON e.user_id = ids.user_id
+            WHERE {mismatch}
+        ''').fetchall()
+        conn.execute('DROP TABLE temp.expected_stats')
+    return [row[0] for row in rows]
+
+
+def get_global_stats() -> dict:
+    """Получить глобальную статистику бота (счётчики row_counts и daily_stats за сегодня, без сканов)"""
+    with get_connection() as conn:
+        row = conn.execute('''
+            SELECT (SELECT count FROM row_counts WHERE name = 'users'),
+                   (SELECT active_users FROM daily_stats WHERE day = DATE('now')),
+                   (SELECT count FROM row_counts WHERE name = 'reminders'),
+                   (SELECT count FROM row_counts WHERE name = 'notes'),
+                   (SELECT count FROM row_counts WHERE name = 'habits')
+        ''').fetchone()
     
     return {
-        'users_count': users_count,
-        'active_today': active_today,
-        'total_reminders': total_reminders,
-        'total_notes': total_notes,
-        'total_habits': total_habits
+        'users_count': row[0] or 0,
+        'active_today': row[1] or 0,
+        'total_reminders': row[2] or 0,
+        'total_notes': row[3] or 0,
+        'total_habits': row[4] or 0
     }
 
 
+def snapshot_global_stats():
+    """Записать текущие итоги (пользователи, напоминания, заметки, привычки) в daily_stats за сегодня"""
+    with transaction() as conn:
+        conn.execute('''
+            INSERT INTO daily_stats (day, users_total, reminders_total, notes_total, habits_total)
+            SELECT DATE('now'),
+                   (SELECT count FROM row_counts WHERE name = 'users'),
+                   (SELECT count FROM row_counts WHERE name = 'reminders'),
+                   (SELECT count FROM row_counts WHERE name = 'notes'),
+                   (SELECT count FROM row_counts WHERE name = 'habits')
+            WHERE TRUE
+            ON CONFLICT(day) DO UPDATE SET
+                users_total = excluded.users_total,
+                reminders_total = excluded.reminders_total,
+                notes_total = excluded.notes_total,
+                habits_total = excluded.habits_total
+        ''')
+
+
+DAILY_STATS_COLUMNS = (
+    'day', 'active_users', 'new_users', 'reminders_created', 'notes_created', 'habits_created',
+    'users_total', 'reminders_total', 'notes_total', 'habits_total',
+)
+
+
+def get_global_stats_history(days: int = 30) -> list:
+    """История общей статистики за последние days дней (по возрастанию даты) — для графиков"""
+    with get_connection() as conn:
+        rows = conn.execute(f'''
+            SELECT {', '.join(DAILY_STATS_COLUMNS)} FROM daily_stats
+            WHERE day > DATE('now', ?)
+            ORDER BY day
+        ''', (f'-{int(days)} days',)).fetchall()
+    return [dict(zip(DAILY_STATS_COLUMNS, row)) for row in rows]
+
+
 # ========== Логи ==========
 
+LOG_COLUMNS = 'id, user_id, username, user_level, user_xp, action_type, action_data, created_at'
+
+
+def log_from_row(row) -> dict:
+    """Строка logs в словарь"""
+    return {
+        'id': row[0],
+        'user_id': row[1],
+        'username': row[2],
+        'level': row[3],
+        'xp': row[4],
+        'action_type': row[5],
+        'action_data': row[6],
+        'created_at': row[7]
+    }
+
+
+# Фоновый писатель логов (log_writer.LogWriter); пока он не запущен, add_log пишет синхронно
+_log_writer = None
+
+
+def set_log_writer(writer):
+    """Направить add_log в фоновый писатель (None — снова писать синхронно)"""
+    global _log_writer
+    _log_writer = writer
+
+
 def add_log(user_id: int, username: str, level: int, xp: int, action_type: str, action_data: str = None):
     """Добавить запись в лог"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO logs (user_id, username, user_level, user_xp, action_type, action_data)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', (user_id, username, level, xp, action_type, action_data))
-    conn.commit()
-    conn.close()
+    writer = _log_writer
+    if writer is not None and writer.submit(user_id, username, level, xp, action_type, action_data):
+        return
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO logs (user_id, username, user_level, user_xp, action_type, action_data)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (user_id, username, level, xp, action_type, action_data))
+        conn.commit()
+
+
+def insert_logs(rows: list):
+    """Записать пачку логов одной транзакцией: строки (user_id, username, level, xp, action_type, action_data, created_at)"""
+    with transaction() as conn:
+        conn.executemany('''
+            INSERT INTO logs (user_id, username, user_level, user_xp, action_type, action_data, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
 
 
 def get_all_logs(limit: int = 50, offset: int = 0) -> list:
     """Получить все логи с информацией о пользователе"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT id, user_id, username, user_level, user_xp, action_type, action_data, created_at
-        FROM logs
-        ORDER BY created_at DESC
-        LIMIT ? OFFSET ?
-    ''', (limit, offset))
-    rows = cursor.fetchall()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id, user_id, username, user_level, user_xp, action_type, action_data, created_at
+            FROM logs
+            ORDER BY created_at DESC
+            LIMIT ? OFFSET ?
+        ''', (limit, offset))
+        rows = cursor.fetchall()
 
-    return [
-        {
-            'id': row[0],
-            'user_id': row[1],
-            'username': row[2],
-            'level': row[3],
-            'xp': row[4],
-            'action_type': row[5],
-            'action_data': row[6],
-            'created_at': row[7]
-        }
-        for row in rows
-    ]
+    return [log_from_row(row) for row in rows]
 
 
 def get_user_logs(user_id: int, limit: int = 50) -> list:
     """Получить логи конкретного пользователя"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT id, user_id, username, user_level, user_xp, action_type, action_data, created_at
-        FROM logs
-        WHERE user_id = ?
-        ORDER BY created_at DESC
-        LIMIT ?
-    ''', (user_id, limit))
-    rows = cursor.fetchall()
-    conn.close()
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id, user_id, username, user_level, user_xp, action_type, action_data, created_at
+            FROM logs
+            WHERE user_id = ?
+            ORDER BY created_at DESC
+            LIMIT ?
+        ''', (user_id, limit))
+        rows = cursor.fetchall()
 
-    return [
-        {
-            'id': row[0],
-            'user_id': row[1],
-            'username': row[2],
-            'level': row[3],
-            'xp': row[4],
-            'action_type': row[5],
-            'action_data': row[6],
-            'created_at': row[7]
-        }
-        for row in rows
-    ]
+    return [log_from_row(row) for row in rows]
 
 
 def get_logs_count() -> int:
-    """Получить общее количество записей в логах"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('SELECT COUNT(*) FROM logs')
-    count = cursor.fetchone()[0]
-    conn.close()
-    return count
+    """Получить общее количество записей в логах (счётчик из row_counts)"""
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT count FROM row_counts WHERE name = 'logs'")
+        row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def _log_filters(user_id: int = None, action_type: str = None) -> tuple:
+    """Условия WHERE и параметры для фильтров логов"""
+    conditions, params = [], []
+    if user_id is not None:
+        conditions.append('user_id = ?')
+        params.append(user_id)
+    if action_type is not None:
+        conditions.append('action_type = ?')
+        params.append(action_type)
+    return conditions, params
+
+
+def get_logs_page(limit: int = 50, before: tuple = None,
+                  user_id: int = None, action_type: str = None) -> tuple:
+    """
+    Страница логов от новых к старым (keyset-пагинация по (created_at, id))
+    before: курсор (created_at, id) последней записи предыдущей страницы
+    Возвращает (список логов, курсор следующей страницы или None)
+    """
+    base_conditions, base_params = _log_filters(user_id, action_type)
+    
+    def fetch(conditions: list, params: list, count: int) -> list:
+        conditions, params = base_conditions + conditions, base_params + params
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        with get_connection() as conn:
+            return conn.execute(f'''
+                SELECT {LOG_COLUMNS}
+                FROM logs
+                {where}
+                ORDER BY created_at DESC, id DESC
+                LIMIT ?
+            ''', (*params, count)).fetchall()
+    
+    # Логи без created_at (NULL) идут последними, и (created_at, id) < (?, ?) их не находит:
+    # хвост с NULL дочитывается отдельным запросом, курсор (None, id) — уже внутри хвоста
+    if not before:
+        rows = fetch([], [], limit)
+    elif before[0] is None:
+        rows = fetch(['created_at IS NULL', 'id < ?'], [before[1]], limit)
+    else:
+        rows = fetch(['(created_at, id) < (?, ?)'], list(before), limit)
+        if len(rows) < limit:
+            rows += fetch(['created_at IS NULL'], [], limit - len(rows))
+    
+    next_cursor = (rows[-1][7], rows[-1][0]) if len(rows) == limit else None
+    return [log_from_row(row) for row in rows], next_cursor
+
+
+def count_logs(user_id: int = None, action_type: str = None) -> int:
+    """Количество логов с фильтрами (без фильтров — из счётчика, с фильтрами — по индексу)"""
+    if user_id is None and action_type is None:
+        return get_logs_count()
+    conditions, params = _log_filters(user_id, action_type)
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT COUNT(*) FROM logs WHERE {' AND '.join(conditions)}", params)
+        return cursor.fetchone()[0]
+
+
+def iter_logs(batch_size: int = 1000, user_id: int = None, action_type: str = None,
+              since: str = None):
+    """
+    Генератор логов от старых к новым для выгрузки, пачками по batch_size
+    since: выдавать только записи с created_at >= since
+    Соединение не держится между пачками, поэтому запись в логи не блокируется
+    """
+    base_conditions, base_params = _log_filters(user_id, action_type)
+    if since is not None:
+        base_conditions.append('created_at >= ?')
+        base_params.append(since)
+    
+    def fetch(conditions: list, params: list, count: int) -> list:
+        conditions, params = base_conditions + conditions, base_params + params
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        with get_connection() as conn:
+            return conn.execute(f'''
+                SELECT {LOG_COLUMNS}
+                FROM logs
+                {where}
+                ORDER BY created_at, id
+                LIMIT ?
+            ''', (*params, count)).fetchall()
+    
+    # Логи без created_at (NULL) идут первыми, и (created_at, id) > (?, ?) из них не выходит:
+    # курсор (None, id) дочитывает NULL, а затем продолжает с первой непустой даты
+    after = None
+    while True:
+        if after is None:
+            rows = fetch([], [], batch_size)
+        elif after[0] is None:
+            rows = fetch(['created_at IS NULL', 'id > ?'], [after[1]], batch_size)
+            if len(rows) < batch_size:
+                rows += fetch(['created_at IS NOT NULL'], [], batch_size - len(rows))
+        else:
+            rows = fetch(['(created_at, id) > (?, ?)'], list(after), batch_size)
+        for row in rows:
+            yield log_from_row(row)
+        if len(rows) < batch_size:
+            return
+        after = (rows[-1][7], rows[-1][0])
+
+
+def _user_with_stats(row) -> dict:
+    """Строка users + user_stats в словарь"""
+    return {
+        'user_id': row[0],
+        'username': row[1],
+        'xp': row[2],
+        'level': row[3],
+        'created_at': row[4],
+        'last_active': row[5],
+        'reminders_count': row[6],
+        'completed_reminders': row[7],
+        'notes_count': row[8],
+        'habits_count': row[9],
+        'total_streak': row[10]
+    }
+
+
+def get_users_with_stats_page(limit: int = 100, after: tuple = None) -> tuple:
+    """
+    Страница пользователей со статистикой, по убыванию XP (keyset-пагинация)
+    after: курсор (xp, user_id) последней строки предыдущей страницы
+    Возвращает (список пользователей, курсор следующей страницы или None)
+    """
+    def fetch(where: str, params: list, count: int) -> list:
+        with get_connection() as conn:
+            return conn.execute(f'''
+                SELECT
+                    u.user_id,
+                    u.username,
+                    u.xp,
+                    u.level,
+                    u.created_at,
+                    u.last_active,
+                    COALESCE(s.total_reminders, 0),
+                    COALESCE(s.completed_reminders, 0),
+                    COALESCE(s.total_notes, 0),
+                    COALESCE(s.total_habits, 0),
+                    COALESCE(s.total_streak, 0)
+                FROM users u
+                LEFT JOIN user_stats s ON s.user_id = u.user_id
+                {where}
+                ORDER BY u.xp DESC, u.user_id
+                LIMIT ?
+            ''', (*params, count)).fetchall()
+    
+    # xp <= ? AND (xp < ? OR user_id > ?) — форма, которую SQLite превращает в поиск по idx_users_xp
+    # Пользователи с xp NULL идут последними и этим условием не находятся: их хвост дочитывается
+    # отдельным запросом, курсор (None, user_id) — уже внутри хвоста
+    if not after:
+        rows = fetch('', [], limit)
+    elif after[0] is None:
+        rows = fetch('WHERE u.xp IS NULL AND u.user_id > ?', [after[1]], limit)
+    else:
+        rows = fetch('WHERE u.xp <= ? AND (u.xp < ? OR u.user_id > ?)', [after[0], after[0], after[1]], limit)
+        if len(rows) < limit:
+            rows += fetch('WHERE u.xp IS NULL', [], limit - len(rows))
+    
+    users = [_user_with_stats(row) for row in rows]
+    next_cursor = (rows[-1][2], rows[-1][0]) if len(rows) == limit else None
+    return users, next_cursor
+
+
+def iter_users_with_stats(batch_size: int = 500):
+    """Генератор всех пользователей со статистикой по убыванию XP, пачками по batch_size"""
+    cursor = None
+    while True:
+        users, cursor = get_users_with_stats_page(batch_size, cursor)
+        yield from users
+        if cursor is None:
+            return
 
 
 def get_all_users_with_stats() -> list:
     """Получить всех пользователей со статистикой"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT 
-            u.user_id,
-            u.username,
-            u.xp,
-            u.level,
-            u.created_at,
-            u.last_active,
-            COUNT(DISTINCT r.id) as reminders_count,
-            SUM(CASE WHEN r.is_completed THEN 1 ELSE 0 END) as completed_reminders,
-            COUNT(DISTINCT n.id) as notes_count,
-            COUNT(DISTINCT h.id) as habits_count,
-            SUM(h.streak) as total_streak
-        FROM users u
-        LEFT JOIN reminders r ON u.user_id = r.user_id
-        LEFT JOIN notes n ON u.user_id = n.user_id
-        LEFT JOIN habits h ON u.user_id = h.user_id
-        GROUP BY u.user_id
-        ORDER BY u.xp DESC
-    ''')
-    rows = cursor.fetchall()
-    conn.close()
+    return list(iter_users_with_stats())
+
+
+# ========== Состояние сервиса ==========
+
+def record_heartbeat(name: str, lag_seconds: float = 0.0, queue_depth: int = 0):
+    """Отметить, что фоновый сервис жив: время, отставание от расписания и размер очереди"""
+    with get_connection() as conn:
+        conn.execute('''
+            INSERT INTO service_heartbeats (name, beat_at, lag_seconds, queue_depth)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET
+                beat_at = excluded.beat_at,
+                lag_seconds = excluded.lag_seconds,
+                queue_depth = excluded.queue_depth
+        ''', (name, time.time(), lag_seconds, queue_depth))
+        conn.commit()
+
+
+def get_heartbeats() -> dict:
+    """Последний пульс каждого сервиса: {name: {'age_seconds', 'lag_seconds', 'queue_depth'}}"""
+    now = time.time()
+    with get_connection() as conn:
+        rows = conn.execute('SELECT name, beat_at, lag_seconds, queue_depth FROM service_heartbeats').fetchall()
+    return {
+        name: {'age_seconds': round(now - beat_at, 3), 'lag_seconds': lag, 'queue_depth': depth}
+        for name, beat_at, lag, depth in rows
+    }
 
-    return [
-        {
-            'user_id': row[0],
-            'username': row[1],
-            'xp': row[2],
-            'level': row[3],
-            'created_at': row[4],
-            'last_active': row[5],
-            'reminders_count': row[6] or 0,
-            'completed_reminders': row[7] or 0,
-            'notes_count': row[8] or 0,
-            'habits_count': row[9] or 0,
-            'total_streak': row[10] or 0
-        }
-        for row in rows
-    ]
+
+def get_db_size() -> dict:
+    """Размер файлов БД в байтах (основной файл и WAL); таблицы не читаются"""
+    sizes = {}
+    for key, suffix in (('db_bytes', ''), ('wal_bytes', '-wal')):
+        try:
+            sizes[key] = os.path.getsize(f"{DB_PATH}{suffix}")
+        except OSError:
+            sizes[key] = 0
+    return sizes
 
 
 if __name__ == "__main__":
+    import sys
+    
     init_db()
     print("Database initialized!")
+    
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == 'repair-stats':
+        print(f"user_stats пересчитана: {repair_user_stats()} пользователей")
+    elif command == 'snapshot-stats':
+        snapshot_global_stats()
+        print(f"Общая статистика за сегодня: {get_global_stats()}")
+    elif command == 'repair-levels':
+        print(f"users.level пересчитан: {repair_levels()} пользователей")
+    elif command == 'check-levels':
+        problems = check_levels()
+        print('\n'.join(problems) if problems else "Кривая уровней согласована")
+        sys.exit(1 if problems else 0)
+    elif command == 'check-stats':
+        broken = check_user_stats()
+        print(f"Расхождения user_stats: {broken}" if broken else "user_stats согласована")
+        sys.exit(1 if broken else 0)
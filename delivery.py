@@ -0,0 +1,215 @@
+"""
+Доставка напоминаний в Telegram
+Ограниченное число одновременных отправителей, token bucket на чат и на весь бот,
+повтор с ожиданием при 429 и метрики задержки «срок напоминания → отправка»
+"""
+import asyncio
+import os
+import time
+from collections import OrderedDict, deque
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import (TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError,
+                                TelegramRetryAfter, TelegramServerError)
+
+from reminder_dispatcher import (PRE_NOTIFY, PRE_NOTIFY_BEFORE, PermanentSendError, ReminderDispatcher,
+                                 parse_remind_at, utcnow)
+
+# Лимиты Telegram: ~30 сообщений в секунду на бота и ~1 в секунду в один чат
+GLOBAL_RATE = float(os.getenv('DELIVERY_GLOBAL_RATE', '25'))
+CHAT_RATE = float(os.getenv('DELIVERY_CHAT_RATE', '1'))
+CHAT_BURST = 3
+WORKERS = int(os.getenv('DELIVERY_WORKERS', '16'))
+MAX_RETRIES = 5
+BACKOFF_BASE = 1.0
+# Сколько последних задержек хранить для перцентилей
+LATENCY_WINDOW = 10000
+
+
+def create_bot(token: str = None, api_url: str = None) -> Bot:
+    """Bot с возможностью указать свой Bot API сервер (TELEGRAM_API_URL) — локальный или фейковый для тестов"""
+    token = token or os.getenv('BOT_TOKEN', '')
+    api_url = api_url or os.getenv('TELEGRAM_API_URL')
+    if api_url:
+        return Bot(token, session=AiohttpSession(api=TelegramAPIServer.from_base(api_url)))
+    return Bot(token)
+
+
+def format_reminder(reminder: dict, kind: str) -> str:
+    """Текст уведомления"""
+    header = "🔔 Через час" if kind == PRE_NOTIFY else "⏰ Напоминание"
+    lines = [f"{header}: {reminder['title']}"]
+    if reminder.get('description'):
+        lines.append(reminder['description'])
+    if reminder.get('location'):
+        lines.append(f"📍 {reminder['location']}")
+    return '\n'.join(lines)
+
+
+class TokenBucket:
+    """Token bucket для asyncio: rate токенов в секунду, не больше capacity про запас"""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        """Дождаться и забрать один токен"""
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """
+        Не выдавать токены ещё хотя бы seconds секунд (после 429 от Telegram)
+        Паузы не складываются: несколько 429 подряд ждут самую длинную из них
+        """
+        self._refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+class DeliveryPipeline:
+    """Очередь отправки с пулом воркеров; send() ждёт, пока сообщение уйдёт или окончательно не уйдёт"""
+
+    def __init__(self, bot: Bot, workers: int = WORKERS, global_rate: float = GLOBAL_RATE,
+                 chat_rate: float = CHAT_RATE, chat_burst: float = CHAT_BURST,
+                 max_retries: int = MAX_RETRIES, max_chats: int = 10000):
+        self.bot = bot
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        self.global_bucket = TokenBucket(global_rate)
+        self._chat_buckets = OrderedDict()
+        self._queue = asyncio.Queue()
+        self._tasks = []
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._metrics = {'sent': 0, 'failed': 0, 'retries': 0, 'rate_limited': 0}
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        """Bucket чата; давно не использовавшиеся вытесняются"""
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            if len(self._chat_buckets) > self.max_chats:
+                self._chat_buckets.popitem(last=False)
+        else:
+            self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    def start(self):
+        """Запустить воркеры в текущем event loop"""
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        return self
+
+    async def stop(self):
+        """Дождаться отправки очереди и остановить воркеры"""
+        await self._queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def send(self, reminder: dict, kind: str = 'notified'):
+        """
+        Отправить напоминание; исключение — если отправить не удалось после всех повторов
+        PermanentSendError — повторять не нужно (диспетчер подтвердит напоминание)
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((reminder, kind, future))
+        return await future
+
+    async def _worker(self):
+        while True:
+            reminder, kind, future = await self._queue.get()
+            try:
+                await self._deliver(reminder, kind)
+            except Exception as e:
+                self._metrics['failed'] += 1
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(True)
+            finally:
+                self._queue.task_done()
+
+    async def _deliver(self, reminder: dict, kind: str):
+        """Отправка с лимитами и повторами"""
+        chat_id = reminder['user_id']
+        text = format_reminder(reminder, kind)
+        chat_bucket = self._chat_bucket(chat_id)
+        # 429 и сетевые ошибки считаются отдельно, у каждых свой лимит max_retries
+        rate_limits = network_errors = 0
+        while True:
+            await chat_bucket.acquire()
+            await self.global_bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id, text)
+                break
+            except TelegramRetryAfter as e:
+                # 429: Telegram сам говорит, сколько ждать. Flood control часто действует на весь бот,
+                # поэтому ждут и этот чат, и остальные воркеры (global_bucket)
+                self._metrics['rate_limited'] += 1
+                chat_bucket.pause(e.retry_after)
+                self.global_bucket.pause(e.retry_after)
+                rate_limits += 1
+                if rate_limits > self.max_retries:
+                    raise RuntimeError(f"Напоминание {reminder['id']}: {rate_limits} ответов 429 от Telegram")
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                # Пользователь заблокировал бота или чат не найден — повторять бессмысленно
+                raise PermanentSendError(str(e)) from e
+            except (TelegramNetworkError, TelegramServerError):
+                network_errors += 1
+                if network_errors > self.max_retries:
+                    raise RuntimeError(f"Не удалось отправить напоминание {reminder['id']} за {network_errors} попыток")
+                self._metrics['retries'] += 1
+                await asyncio.sleep(BACKOFF_BASE * 2 ** (network_errors - 1))
+
+        self._metrics['sent'] += 1
+        due = parse_remind_at(reminder['remind_at'])
+        if kind == PRE_NOTIFY:
+            due = due - PRE_NOTIFY_BEFORE
+        self._latencies.append(max(0.0, (utcnow() - due).total_seconds()))
+
+    def metrics(self) -> dict:
+        """
+        Счётчики, глубина очереди и перцентили задержки (секунды)
+        retries — повторы после сетевых ошибок, rate_limited — полученные 429 (после каждого — повтор)
+        """
+        latencies = sorted(self._latencies)
+
+        def percentile(p: float) -> float:
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))] if latencies else 0.0
+
+        return {
+            **self._metrics,
+            'queue_depth': self._queue.qsize(),
+            'latency_p50': percentile(0.50),
+            'latency_p99': percentile(0.99),
+            'latency_max': latencies[-1] if latencies else 0.0,
+        }
+
+
+
+def build_dispatcher(pipeline: DeliveryPipeline, **kwargs):
+    """ReminderDispatcher, который отправляет через pipeline"""
+    return ReminderDispatcher(
+        lambda reminder: pipeline.send(reminder),
+        lambda reminder: pipeline.send(reminder, PRE_NOTIFY),
+        **kwargs
+    )
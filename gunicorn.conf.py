@@ -0,0 +1,39 @@
+"""
+Production-запуск web_server.py: gunicorn -c gunicorn.conf.py web_server:app
+Число воркеров и потоков задаётся переменными окружения (WEB_WORKERS, WEB_THREADS)
+"""
+import os
+
+import database
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+
+# Процессы × потоки: SQLite в WAL читает параллельно, запись всё равно одна,
+# поэтому немного процессов и несколько потоков в каждом
+workers = int(os.getenv('WEB_WORKERS', '2'))
+worker_class = 'gthread'
+threads = int(os.getenv('WEB_THREADS', '4'))
+
+# Keep-alive для Mini App и прокси Render; плавная остановка при деплое
+keepalive = int(os.getenv('WEB_KEEPALIVE', '5'))
+timeout = 30
+graceful_timeout = int(os.getenv('WEB_GRACEFUL_TIMEOUT', '20'))
+
+# Перезапуск воркеров время от времени — страховка от утечек памяти
+max_requests = int(os.getenv('WEB_MAX_REQUESTS', '10000'))
+max_requests_jitter = max_requests // 10
+
+accesslog = os.getenv('WEB_ACCESS_LOG') or None
+errorlog = '-'
+
+
+def on_starting(server):
+    """Схема и миграции — один раз в мастере, до запуска воркеров"""
+    database.init_db()
+    # Соединения SQLite нельзя передавать через fork: у каждого воркера будет свой пул
+    database.close_connections()
+
+
+def worker_exit(server, worker):
+    """Закрыть соединения воркера при остановке"""
+    database.close_connections()
@@ -0,0 +1,235 @@
+"""
+Рейтинг пользователей по XP в памяти
+Отсортированный список, разбитый на блоки (как sortedcontainers): место пользователя,
+топ-N и окно «вокруг меня» без обращения к БД. Обновляется из add_xp в этом процессе
+и по версиям статистики (users.stats_version) — для записей из других процессов
+"""
+import json
+import os
+import threading
+import time
+from bisect import bisect_left, insort
+
+import database
+
+# Как часто подтягивать изменения XP из других процессов (версия 'user_stats' в data_versions)
+LEADERBOARD_VERSION_CHECK = float(os.getenv('LEADERBOARD_VERSION_CHECK', '1'))
+
+# Ключ сортировки — одно целое: больше XP → меньше ключ, при равном XP меньше user_id → меньше ключ
+_ID_BITS = 64
+_ID_MASK = (1 << _ID_BITS) - 1
+
+
+def make_key(user_id: int, xp: int) -> int:
+    """Ключ сортировки рейтинга"""
+    return (-xp << _ID_BITS) | user_id
+
+
+def split_key(key: int) -> tuple:
+    """(user_id, xp) из ключа"""
+    return key & _ID_MASK, -(key >> _ID_BITS)
+
+
+class RankedList:
+    """Отсортированный список блоками по ~load элементов: вставка, удаление и индекс за O(√n)"""
+
+    def __init__(self, keys=(), load: int = 1000):
+        self.load = load
+        keys = list(keys)
+        self._blocks = [keys[i:i + load] for i in range(0, len(keys), load)]
+        self._maxes = [block[-1] for block in self._blocks]
+        self._len = len(keys)
+
+    def __len__(self):
+        return self._len
+
+    def add(self, key: int):
+        if not self._blocks:
+            self._blocks.append([key])
+            self._maxes.append(key)
+        else:
+            i = min(bisect_left(self._maxes, key), len(self._blocks) - 1)
+            block = self._blocks[i]
+            insort(block, key)
+            self._maxes[i] = block[-1]
+            if len(block) > 2 * self.load:
+                self._blocks[i:i + 1] = [block[:self.load], block[self.load:]]
+                self._maxes[i:i + 1] = [block[self.load - 1], block[-1]]
+        self._len += 1
+
+    def remove(self, key: int) -> bool:
+        i = bisect_left(self._maxes, key)
+        if i == len(self._blocks):
+            return False
+        block = self._blocks[i]
+        j = bisect_left(block, key)
+        if j == len(block) or block[j] != key:
+            return False
+        del block[j]
+        if block:
+            self._maxes[i] = block[-1]
+        else:
+            del self._blocks[i]
+            del self._maxes[i]
+        self._len -= 1
+        return True
+
+    def index(self, key: int) -> int:
+        """Позиция ключа (с 0); ключ должен быть в списке"""
+        i = bisect_left(self._maxes, key)
+        return sum(len(block) for block in self._blocks[:i]) + bisect_left(self._blocks[i], key)
+
+    def slice(self, start: int, stop: int) -> list:
+        """Ключи с позиции start до stop"""
+        result = []
+        if stop <= start:
+            return result
+        position = 0
+        for block in self._blocks:
+            end = position + len(block)
+            if end > start:
+                result.extend(block[max(0, start - position):stop - position])
+                if end >= stop:
+                    break
+            position = end
+        return result
+
+
+class Leaderboard:
+    """
+    Рейтинг по XP: {user_id: ключ} + RankedList ключей
+    Загружается из БД одним проходом по индексу idx_users_xp (строки уже отсортированы)
+    """
+
+    def __init__(self, version_check: float = LEADERBOARD_VERSION_CHECK):
+        self.version_check = version_check
+        self._keys = {}
+        self._ranked = RankedList()
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._version = 0
+        self._checked_at = 0.0
+        self._sync_lock = threading.Lock()
+
+    def load(self):
+        """Построить рейтинг из БД и подписаться на add_xp в этом процессе"""
+        with database.get_connection() as conn:
+            version = conn.execute(
+                "SELECT COALESCE((SELECT version FROM data_versions WHERE scope = 'user_stats'), 0)"
+            ).fetchone()[0]
+            rows = conn.execute('SELECT user_id, xp FROM users ORDER BY xp DESC, user_id').fetchall()
+        keys = [make_key(user_id, xp or 0) for user_id, xp in rows]
+        with self._lock:
+            self._keys = {user_id: key for (user_id, _), key in zip(rows, keys)}
+            self._ranked = RankedList(keys)
+            self._version = version
+            self._checked_at = time.monotonic()
+            if not self._loaded:
+                database.add_xp_listener(self.update)
+            self._loaded = True
+        return self
+
+    def close(self):
+        """Отписаться от add_xp"""
+        database.remove_xp_listener(self.update)
+        self._loaded = False
+
+    def update(self, user_id: int, xp: int):
+        """Новый XP пользователя (или новый пользователь)"""
+        key = make_key(user_id, xp)
+        with self._lock:
+            old = self._keys.get(user_id)
+            if old == key:
+                return
+            if old is not None:
+                self._ranked.remove(old)
+            self._keys[user_id] = key
+            self._ranked.add(key)
+
+    def sync(self):
+        """Подтянуть пользователей, чей XP изменили другие процессы (не чаще version_check секунд)"""
+        if not self._loaded:
+            self.load()
+            return
+        now = time.monotonic()
+        if self.version_check <= 0 or now - self._checked_at < self.version_check:
+            return
+        if not self._sync_lock.acquire(blocking=False):
+            return
+        try:
+            self._checked_at = now
+            with database.get_connection() as conn:
+                version = conn.execute(
+                    "SELECT COALESCE((SELECT version FROM data_versions WHERE scope = 'user_stats'), 0)"
+                ).fetchone()[0]
+                if version == self._version:
+                    return
+                rows = conn.execute(
+                    'SELECT user_id, xp FROM users WHERE stats_version > ?', (self._version,)
+                ).fetchall()
+            for user_id, xp in rows:
+                self.update(user_id, xp or 0)
+            self._version = version
+        finally:
+            self._sync_lock.release()
+
+    def __len__(self):
+        return len(self._ranked)
+
+    def rank(self, user_id: int) -> int:
+        """Место пользователя (с 1) или None"""
+        self.sync()
+        with self._lock:
+            key = self._keys.get(user_id)
+            return None if key is None else self._ranked.index(key) + 1
+
+    def top(self, limit: int = 10, offset: int = 0) -> list:
+        """[(место, user_id, xp)] с позиции offset"""
+        self.sync()
+        with self._lock:
+            keys = self._ranked.slice(offset, offset + limit)
+        return [(offset + i + 1, *split_key(key)) for i, key in enumerate(keys)]
+
+    def around(self, user_id: int, radius: int = 5) -> list:
+        """radius мест выше и ниже пользователя (включая его); [] — пользователя нет"""
+        self.sync()
+        with self._lock:
+            key = self._keys.get(user_id)
+            if key is None:
+                return []
+            position = self._ranked.index(key)
+            start = max(0, position - radius)
+            keys = self._ranked.slice(start, position + radius + 1)
+        return [(start + i + 1, *split_key(key)) for i, key in enumerate(keys)]
+
+
+def with_profiles(entries: list) -> list:
+    """Дополнить записи рейтинга именем и уровнем из users (одним запросом по ключам)"""
+    if not entries:
+        return []
+    with database.get_connection() as conn:
+        profiles = {
+            row[0]: row[1:] for row in conn.execute(
+                'SELECT user_id, username, level FROM users WHERE user_id IN (SELECT value FROM json_each(?))',
+                (json.dumps([user_id for _, user_id, _ in entries]),)
+            )
+        }
+    return [
+        {'rank': rank, 'user_id': user_id, 'xp': xp,
+         'username': profiles.get(user_id, (None, None))[0], 'level': profiles.get(user_id, (None, None))[1]}
+        for rank, user_id, xp in entries
+    ]
+
+
+_leaderboard = None
+_leaderboard_lock = threading.Lock()
+
+
+def get_leaderboard() -> Leaderboard:
+    """Общий рейтинг процесса (загружается при первом обращении)"""
+    global _leaderboard
+    if _leaderboard is None:
+        with _leaderboard_lock:
+            if _leaderboard is None:
+                _leaderboard = Leaderboard().load()
+    return _leaderboard
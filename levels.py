@@ -0,0 +1,85 @@
+"""
+Кривая уровней — одна для бота, Mini App и админки
+Уровень L начинается с (L - 1)² × 100 XP: 0, 100, 400, 900, 1600, …
+Пороги первых LEVEL_TABLE_SIZE уровней посчитаны заранее, уровень по XP ищется bisect;
+названия и бонусы уровней — из level_rewards (LevelTable)
+"""
+from bisect import bisect_right
+from math import isqrt
+from typing import NamedTuple
+
+# XP на «единицу» кривой: уровень L начинается с (L - 1)² × XP_UNIT
+XP_UNIT = 100
+# Сколько порогов держать в таблице; выше — та же кривая через isqrt
+LEVEL_TABLE_SIZE = 1000
+
+
+def level_start(level: int) -> int:
+    """С какого XP начинается уровень"""
+    return (max(level, 1) - 1) ** 2 * XP_UNIT
+
+
+# THRESHOLDS[i] — начало уровня i + 1
+THRESHOLDS = tuple(level_start(level) for level in range(1, LEVEL_TABLE_SIZE + 2))
+
+
+def level_for_xp(xp: int) -> int:
+    """Уровень при данном XP"""
+    xp = max(xp or 0, 0)
+    if xp < THRESHOLDS[-1]:
+        return bisect_right(THRESHOLDS, xp)
+    return isqrt(xp // XP_UNIT) + 1
+
+
+def progress(xp: int) -> dict:
+    """Уровень и прогресс до следующего: границы уровня, XP внутри уровня и процент"""
+    xp = max(xp or 0, 0)
+    level = level_for_xp(xp)
+    level_xp, next_level_xp = level_start(level), level_start(level + 1)
+    xp_in_level, xp_needed = xp - level_xp, next_level_xp - level_xp
+    return {
+        'level': level,
+        'xp': xp,
+        'level_xp': level_xp,
+        'next_level_xp': next_level_xp,
+        'xp_in_level': xp_in_level,
+        'xp_needed': xp_needed,
+        'progress_percent': xp_in_level / xp_needed * 100,
+    }
+
+
+class Reward(NamedTuple):
+    """Строка level_rewards"""
+    level: int
+    xp_required: int
+    reward_text: str
+    reward_xp: int
+
+
+class LevelTable:
+    """
+    Неизменяемая таблица наград за уровни
+    Пороги берутся из кривой (xp_required в БД только для показа), из таблицы — название и бонус
+    """
+
+    def __init__(self, rows):
+        self.rewards = tuple(sorted(
+            Reward(level, level_start(level), text or '', reward_xp or 0) for level, _, text, reward_xp in rows
+        ))
+        self._levels = tuple(reward.level for reward in self.rewards)
+        self._by_level = {reward.level: reward for reward in self.rewards}
+
+    def reward(self, level: int) -> Reward:
+        """Награда за достижение уровня или None"""
+        return self._by_level.get(level)
+
+    def title(self, level: int) -> str:
+        """Звание на уровне: награда ближайшего уровня не выше данного"""
+        i = bisect_right(self._levels, level) - 1
+        return self.rewards[i].reward_text if i >= 0 else ''
+
+    def progress(self, xp: int) -> dict:
+        """progress() со званием"""
+        result = progress(xp)
+        result['reward'] = self.title(result['level'])
+        return result
@@ -0,0 +1,178 @@
+"""
+Фоновая запись логов пачками
+add_log кладёт запись в ограниченную очередь, поток-писатель сбрасывает её в БД
+через executemany одной транзакцией — по размеру пачки или по таймеру
+"""
+import atexit
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+
+import database
+
+# Что делать, когда очередь заполнена
+POLICY_BLOCK = 'block'  # ждать место до block_timeout, потом отбросить запись
+POLICY_DROP = 'drop'    # сразу отбросить запись
+POLICY_SYNC = 'sync'    # записать синхронно в вызывающем потоке
+
+_STOP = object()
+
+
+class LogWriter:
+    """Поток-писатель логов с ограниченной очередью и метриками"""
+
+    def __init__(self, max_queue: int = 10000, batch_size: int = 500, flush_interval: float = 0.5,
+                 policy: str = POLICY_BLOCK, block_timeout: float = 1.0):
+        if policy not in (POLICY_BLOCK, POLICY_DROP, POLICY_SYNC):
+            raise ValueError(f"Неизвестная политика переполнения: {policy}")
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._running = False
+        self._lock = threading.Lock()
+        self._metrics = {
+            'submitted': 0,
+            'written': 0,
+            'dropped': 0,
+            'overflow_sync': 0,
+            'flushes': 0,
+            'flush_errors': 0,
+            'last_flush_ms': 0.0,
+            'max_flush_ms': 0.0,
+            'total_flush_ms': 0.0,
+        }
+
+    def start(self):
+        """Запустить поток и направить в него database.add_log"""
+        if self._running:
+            return self
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+        self._thread.start()
+        database.set_log_writer(self)
+        atexit.register(self.stop)
+        return self
+
+    def stop(self, timeout: float = 10.0):
+        """Остановить поток, дописав всё из очереди"""
+        if not self._running:
+            return
+        self._running = False
+        database.set_log_writer(None)
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        atexit.unregister(self.stop)
+
+    def submit(self, user_id: int, username: str, level: int, xp: int,
+               action_type: str, action_data: str = None) -> bool:
+        """
+        Поставить запись в очередь
+        False — запись не принята и её нужно записать синхронно (писатель остановлен или политика sync)
+        """
+        if not self._running:
+            return False
+        # Время фиксируем сейчас, а не при сбросе пачки (формат как у CURRENT_TIMESTAMP)
+        created_at = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        row = (user_id, username, level, xp, action_type, action_data, created_at)
+        try:
+            if self.policy == POLICY_BLOCK:
+                self._queue.put(row, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(row)
+        except queue.Full:
+            with self._lock:
+                if self.policy == POLICY_SYNC:
+                    self._metrics['overflow_sync'] += 1
+                    return False
+                self._metrics['dropped'] += 1
+            return True
+        with self._lock:
+            self._metrics['submitted'] += 1
+        return True
+
+    def _run(self):
+        """Цикл потока: собрать пачку по размеру/времени и записать"""
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._flush(batch)
+        # Дописываем то, что успели положить до остановки
+        rest = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                rest.append(item)
+        for start in range(0, len(rest), self.batch_size):
+            self._flush(rest[start:start + self.batch_size])
+
+    def _flush(self, batch: list):
+        """Записать пачку одной транзакцией и обновить метрики"""
+        started = time.perf_counter()
+        try:
+            database.insert_logs(batch)
+        except Exception as e:
+            with self._lock:
+                self._metrics['flush_errors'] += 1
+                self._metrics['dropped'] += len(batch)
+            print(f"❌ Не удалось записать {len(batch)} логов: {e}")
+            return
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with self._lock:
+            self._metrics['written'] += len(batch)
+            self._metrics['flushes'] += 1
+            self._metrics['last_flush_ms'] = elapsed_ms
+            self._metrics['total_flush_ms'] += elapsed_ms
+            self._metrics['max_flush_ms'] = max(self._metrics['max_flush_ms'], elapsed_ms)
+
+    def metrics(self) -> dict:
+        """Глубина очереди, счётчики и задержки сброса"""
+        with self._lock:
+            metrics = dict(self._metrics)
+        metrics['queue_depth'] = self._queue.qsize()
+        metrics['avg_flush_ms'] = metrics['total_flush_ms'] / metrics['flushes'] if metrics['flushes'] else 0.0
+        return metrics
+
+
+_writer = None
+
+
+def start_log_writer(**kwargs) -> LogWriter:
+    """Запустить общий фоновый писатель логов для процесса"""
+    global _writer
+    if _writer is None:
+        _writer = LogWriter(**kwargs).start()
+    return _writer
+
+
+def stop_log_writer():
+    """Остановить общий писатель, дописав очередь"""
+    global _writer
+    if _writer is not None:
+        _writer.stop()
+        _writer = None
+
+
+def get_log_writer_metrics() -> dict:
+    """Метрики общего писателя (пустой словарь, если он не запущен)"""
+    return _writer.metrics() if _writer is not None else {}
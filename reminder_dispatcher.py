@@ -0,0 +1,283 @@
+"""
+Диспетчер напоминаний без опроса по таймеру
+Держит в памяти min-heap ближайших срабатываний (загруженных из БД окном по индексу),
+спит ровно до следующего срока и узнаёт о новых/снятых напоминаниях от database.py
+"""
+import asyncio
+import heapq
+import time
+from datetime import datetime, timedelta, timezone
+
+import async_db
+import database
+
+# За сколько до срока отправлять предварительное уведомление
+PRE_NOTIFY_BEFORE = timedelta(hours=1)
+# На сколько вперёд загружать напоминания из БД; дальше окна heap не заглядывает
+WINDOW = timedelta(minutes=30)
+
+# Повтор неудачной отправки
+RETRY_DELAY = timedelta(seconds=30)
+MAX_ATTEMPTS = 3
+
+# Захват без подтверждения старше этого считается брошенным упавшим процессом и возвращается в очередь
+STALE_CLAIM_AFTER = timedelta(minutes=10)
+
+# Пауза после ошибки цикла (например, database is locked): удваивается до ERROR_BACKOFF_MAX
+ERROR_BACKOFF = 1.0
+ERROR_BACKOFF_MAX = 60.0
+
+# Как часто отмечаться в service_heartbeats (/readyz веб-сервера); цикл просыпается не реже
+HEARTBEAT_INTERVAL = 30.0
+HEARTBEAT_NAME = 'reminder_dispatcher'
+
+DUE = 'notified'
+PRE_NOTIFY = 'pre_notified'
+
+
+class PermanentSendError(Exception):
+    """Отправка не получится и при повторе (бот заблокирован, чат не найден) — напоминание подтверждается без повторов"""
+
+
+def utcnow() -> datetime:
+    """Текущее время UTC без tzinfo (так же, как datetime('now') в SQLite)"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def parse_remind_at(value) -> datetime:
+    """remind_at из БД (строка или datetime) в datetime"""
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=None) if value.tzinfo is None else \
+            value.astimezone(timezone.utc).replace(tzinfo=None)
+    return datetime.fromisoformat(str(value))
+
+
+class ReminderDispatcher:
+    """
+    Срабатывания хранятся в heap как (время, kind, id); актуальность проверяется по self._scheduled,
+    поэтому снятие напоминания — O(1), а устаревшие записи heap просто пропускаются
+    Повторной отправки не бывает: перед отправкой пачка захватывается в БД одним UPDATE … RETURNING
+    (database.claim_reminders), и после перезапуска захваченные напоминания не загружаются
+    """
+
+    def __init__(self, send_reminder, send_pre_notify=None, window: timedelta = WINDOW,
+                 pre_notify_before: timedelta = PRE_NOTIFY_BEFORE):
+        self.send_reminder = send_reminder
+        self.send_pre_notify = send_pre_notify
+        self.window = window
+        self.pre_notify_before = pre_notify_before
+        self.stats = {'fired': 0, 'pre_notified': 0, 'skipped': 0, 'reloads': 0, 'errors': 0, 'loop_errors': 0}
+        self._heap = []
+        self._scheduled = {}
+        self._window_end = None
+        self._loop = None
+        self._wakeup = None
+        self._stopped = False
+        self._pending_changes = None  # изменения, пришедшие во время reload()
+        self._attempts = {}
+        self._lag = 0.0  # насколько позже срока сработала последняя пачка, секунды
+        self._heartbeat_at = 0.0
+
+    # ---------- Расписание ----------
+
+    def _schedule(self, kind: str, reminder_id: int, fire_at: datetime):
+        """Поставить срабатывание, если оно попадает в текущее окно"""
+        if self._window_end is not None and fire_at > self._window_end:
+            return
+        key = (kind, reminder_id)
+        if self._scheduled.get(key) == fire_at:
+            return
+        self._scheduled[key] = fire_at
+        heapq.heappush(self._heap, (fire_at, kind, reminder_id))
+
+    def _schedule_reminder(self, reminder_id: int, remind_at: datetime, notified=False, pre_notified=False):
+        """Поставить срабатывания напоминания: предварительное и основное"""
+        now = utcnow()
+        if not pre_notified and self.send_pre_notify and remind_at > now:
+            self._schedule(PRE_NOTIFY, reminder_id, max(now, remind_at - self.pre_notify_before))
+        if not notified:
+            self._schedule(DUE, reminder_id, remind_at)
+
+    def _unschedule(self, reminder_id: int):
+        """Снять все срабатывания напоминания"""
+        self._scheduled.pop((DUE, reminder_id), None)
+        self._scheduled.pop((PRE_NOTIFY, reminder_id), None)
+
+    async def reload(self):
+        """
+        Перестроить heap из БД для окна [сейчас, сейчас + window]
+        Сначала возвращает в очередь захваты, брошенные упавшим процессом между claim и ack
+        """
+        older_than = f'-{int(STALE_CLAIM_AFTER.total_seconds())} seconds'
+        for kind in (DUE, PRE_NOTIFY):
+            released = await async_db.release_stale_claims(older_than, kind)
+            if released:
+                print(f"⚠️ Возвращены в очередь брошенные захваты ({kind}): {released}")
+        now = utcnow()
+        window_end = now + self.window
+        self._pending_changes = []
+        try:
+            reminders = await async_db.get_upcoming_reminders(
+                window_end, window_end + self.pre_notify_before, now
+            )
+            self._heap = []
+            self._scheduled = {}
+            self._window_end = window_end
+            for reminder in reminders:
+                self._schedule_reminder(reminder['id'], parse_remind_at(reminder['remind_at']),
+                                        bool(reminder['notified']), bool(reminder['pre_notified']))
+        finally:
+            pending, self._pending_changes = self._pending_changes, None
+        # Изменения во время загрузки могли не попасть в выборку — применяем их поверх
+        for change in pending:
+            self._apply_change(*change)
+        self.stats['reloads'] += 1
+
+    def _on_change(self, event: str, reminder_id: int, remind_at=None):
+        """Подписчик database.py: может вызываться из любого потока"""
+        if self._loop is None or self._loop.is_closed():
+            return
+        self._loop.call_soon_threadsafe(self._apply_change, event, reminder_id, remind_at)
+
+    def _apply_change(self, event: str, reminder_id: int, remind_at):
+        """Применить изменение в потоке event loop и разбудить цикл"""
+        if self._pending_changes is not None:
+            self._pending_changes.append((event, reminder_id, remind_at))
+            return
+        if event == 'add' and remind_at is not None:
+            self._schedule_reminder(reminder_id, parse_remind_at(remind_at))
+        else:
+            self._unschedule(reminder_id)
+        self._wakeup.set()
+
+    # ---------- Отправка ----------
+
+    def _pop_due(self, now: datetime) -> list:
+        """Снять с heap все актуальные срабатывания со сроком <= now"""
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            fire_at, kind, reminder_id = heapq.heappop(self._heap)
+            if self._scheduled.get((kind, reminder_id)) != fire_at:
+                continue  # запись устарела: напоминание сняли или перенесли
+            del self._scheduled[(kind, reminder_id)]
+            due.append((kind, reminder_id))
+            self._lag = max(self._lag, (now - fire_at).total_seconds())
+        return due
+
+    async def _fire(self, kind: str, reminder_ids: list):
+        """Захватить пачку срабатываний одним запросом, отправить, подтвердить или вернуть в очередь"""
+        reminders = await async_db.claim_reminders(reminder_ids, kind)
+        self.stats['skipped'] += len(reminder_ids) - len(reminders)
+        send = self.send_pre_notify if kind == PRE_NOTIFY else self.send_reminder
+        # Отправляем пачку параллельно: темп и лимиты Telegram держит отправитель (delivery.DeliveryPipeline)
+        results = await asyncio.gather(*(send(reminder) for reminder in reminders), return_exceptions=True)
+        sent, failed, dropped = [], [], []
+        for reminder, result in zip(reminders, results):
+            if isinstance(result, Exception):
+                self.stats['errors'] += 1
+                print(f"❌ Не удалось отправить напоминание {reminder['id']}: {result}")
+                if isinstance(result, PermanentSendError):
+                    dropped.append(reminder['id'])
+                else:
+                    failed.append(reminder)
+            else:
+                sent.append(reminder['id'])
+        self.stats['pre_notified' if kind == PRE_NOTIFY else 'fired'] += len(sent)
+        await self._settle(kind, sent, failed, dropped)
+
+    async def _settle(self, kind: str, sent: list, failed: list, dropped: list = ()):
+        """
+        Подтвердить отправленные и окончательно неотправляемые (dropped);
+        остальные неудачные вернуть в очередь и повторить позже (до MAX_ATTEMPTS раз)
+        """
+        retry, give_up = [], [*sent, *dropped]
+        for reminder in failed:
+            key = (kind, reminder['id'])
+            self._attempts[key] = self._attempts.get(key, 0) + 1
+            if self._attempts[key] >= MAX_ATTEMPTS:
+                del self._attempts[key]
+                give_up.append(reminder['id'])
+            else:
+                retry.append(reminder['id'])
+        for reminder_id in give_up:
+            self._attempts.pop((kind, reminder_id), None)
+        await async_db.ack_reminders(give_up, kind)
+        await async_db.release_reminders(retry, kind)
+        retry_at = utcnow() + RETRY_DELAY
+        for reminder_id in retry:
+            self._schedule(kind, reminder_id, retry_at)
+
+    async def _heartbeat(self):
+        """Записать пульс не чаще HEARTBEAT_INTERVAL: отставание от расписания и размер heap"""
+        now = time.monotonic()
+        if now - self._heartbeat_at < HEARTBEAT_INTERVAL:
+            return
+        self._heartbeat_at = now
+        try:
+            await async_db.record_heartbeat(HEARTBEAT_NAME, self._lag, len(self._scheduled))
+        except Exception as e:
+            print(f"❌ Не удалось записать пульс диспетчера: {e}")
+        self._lag = 0.0
+
+    # ---------- Цикл ----------
+
+    async def _tick(self) -> datetime:
+        """Один проход цикла: при необходимости перечитать окно, отправить наступившие. Возвращает время следующего прохода"""
+        now = utcnow()
+        if self._window_end is None or now >= self._window_end:
+            await self.reload()
+            now = utcnow()
+        due = self._pop_due(now)
+        for kind in (PRE_NOTIFY, DUE):
+            reminder_ids = [reminder_id for due_kind, reminder_id in due if due_kind == kind]
+            if reminder_ids:
+                await self._fire(kind, reminder_ids)
+        await self._heartbeat()
+
+        next_at = self._window_end
+        if self._heap:
+            next_at = min(next_at, self._heap[0][0])
+        return next_at
+
+    async def _sleep(self, timeout: float):
+        """Ждать timeout секунд или изменения расписания / stop()"""
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def run(self):
+        """
+        Основной цикл: спать до ближайшего срока или до изменения расписания
+        Ошибка прохода (например, database is locked во время VACUUM или большой загрузки) не останавливает цикл:
+        пауза с удвоением и полная перезагрузка окна из БД — снятые с heap, но не захваченные срабатывания вернутся
+        """
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._stopped = False
+        self._window_end = None
+        database.add_reminder_listener(self._on_change)
+        failures = 0
+        try:
+            while not self._stopped:
+                try:
+                    next_at = await self._tick()
+                except Exception as e:
+                    failures += 1
+                    self.stats['loop_errors'] += 1
+                    delay = min(ERROR_BACKOFF_MAX, ERROR_BACKOFF * 2 ** (failures - 1))
+                    print(f"❌ Ошибка диспетчера напоминаний, повтор через {delay:.0f} с: {e!r}")
+                    self._window_end = None
+                    await self._sleep(delay)
+                    continue
+                failures = 0
+                await self._sleep(min(HEARTBEAT_INTERVAL, max(0.0, (next_at - utcnow()).total_seconds())))
+        finally:
+            database.remove_reminder_listener(self._on_change)
+
+    def stop(self):
+        """Остановить цикл run()"""
+        self._stopped = True
+        if self._wakeup is not None and self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
@@ -0,0 +1,184 @@
+"""
+Хранение истории: свёртка старых daily_actions и архивация старых логов
+Сроки хранения задаются в bot_settings: daily_actions_retention_days, logs_retention_days,
+retention_batch_size. Запуск вручную: python retention.py [vacuum-setup]
+"""
+import gzip
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+import database
+
+# Куда складывать архивы логов (по умолчанию рядом с БД)
+ARCHIVE_DIR = os.getenv('LOGS_ARCHIVE_DIR', '')
+# Сколько строк логов класть в один файл архива
+ARCHIVE_SEGMENT_ROWS = 50000
+# Сколько страниц освобождать за один вызов incremental_vacuum
+VACUUM_PAGES = 2000
+
+
+def _cutoff(days: int) -> str:
+    """Граница хранения в формате DATE('now', '-N days')"""
+    with database.get_connection() as conn:
+        return conn.execute("SELECT DATE('now', ?)", (f'-{int(days)} days',)).fetchone()[0]
+
+
+def get_archive_dir() -> Path:
+    """Папка архивов логов"""
+    return Path(ARCHIVE_DIR) if ARCHIVE_DIR else Path(database.DB_PATH).parent / 'archive'
+
+
+# ========== daily_actions ==========
+
+def rollup_daily_actions(days: int = None, batch_size: int = None, pause: float = 0.0) -> int:
+    """
+    Свернуть daily_actions старше days дней в daily_xp_rollups (пользователь × день × тип действия)
+    и удалить свёрнутые строки. Каждая пачка — отдельная короткая транзакция
+    Возвращает число удалённых строк
+    """
+    days = int(database.get_setting('daily_actions_retention_days', '30')) if days is None else days
+    batch_size = int(database.get_setting('retention_batch_size', '1000')) if batch_size is None else batch_size
+    cutoff = _cutoff(days)
+    total = 0
+    while True:
+        with database.transaction() as conn:
+            row = conn.execute('''
+                SELECT MAX(id), COUNT(*) FROM (
+                    SELECT id FROM daily_actions WHERE action_date < ? ORDER BY id LIMIT ?
+                )
+            ''', (cutoff, batch_size)).fetchone()
+            max_id, count = row
+            if not count:
+                break
+            conn.execute('''
+                INSERT INTO daily_xp_rollups (user_id, action_date, action_type, actions, xp_earned)
+                SELECT user_id, action_date, COALESCE(action_type, ''), SUM(count), SUM(xp_earned)
+                FROM daily_actions
+                WHERE id <= ? AND action_date < ?
+                GROUP BY user_id, action_date, COALESCE(action_type, '')
+                ON CONFLICT (user_id, action_date, action_type) DO UPDATE SET
+                    actions = actions + excluded.actions,
+                    xp_earned = xp_earned + excluded.xp_earned
+            ''', (max_id, cutoff))
+            deleted = conn.execute(
+                'DELETE FROM daily_actions WHERE id <= ? AND action_date < ?', (max_id, cutoff)
+            ).rowcount
+        total += deleted
+        if count < batch_size:
+            break
+        if pause:
+            time.sleep(pause)
+    return total
+
+
+# ========== Логи ==========
+
+def _write_segment(rows: list, archive_dir: Path) -> Path:
+    """Записать строки логов в сжатый JSONL-сегмент и сбросить его на диск"""
+    archive_dir.mkdir(parents=True, exist_ok=True)
+    first, last = rows[0], rows[-1]
+    stamp = str(first[7]).replace(' ', 'T').replace(':', '')
+    path = archive_dir / f"logs-{stamp}-{first[0]}-{last[0]}.jsonl.gz"
+    tmp_path = path.with_suffix('.tmp')
+    with open(tmp_path, 'wb') as raw:
+        with gzip.GzipFile(fileobj=raw, mode='wb') as gz:
+            for row in rows:
+                gz.write(json.dumps(database.log_from_row(row), ensure_ascii=False).encode('utf-8') + b'\n')
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(tmp_path, path)
+    return path
+
+
+def archive_logs(days: int = None, batch_size: int = None, pause: float = 0.0,
+                 archive_dir: Path = None) -> list:
+    """
+    Перенести логи старше days дней в архивы logs-*.jsonl.gz и удалить их из БД пачками
+    Строки удаляются только после того, как сегмент записан на диск; если процесс упадёт
+    между записью и удалением, эти строки попадут в следующий сегмент повторно (дубли по id)
+    Возвращает список созданных файлов
+    """
+    days = int(database.get_setting('logs_retention_days', '90')) if days is None else days
+    batch_size = int(database.get_setting('retention_batch_size', '1000')) if batch_size is None else batch_size
+    batch_size = max(batch_size, 1)
+    archive_dir = Path(archive_dir) if archive_dir else get_archive_dir()
+    cutoff = _cutoff(days)
+    segments = []
+    while True:
+        with database.get_connection() as conn:
+            rows = conn.execute(f'''
+                SELECT {database.LOG_COLUMNS}
+                FROM logs
+                WHERE created_at < ?
+                ORDER BY created_at, id
+                LIMIT ?
+            ''', (cutoff, ARCHIVE_SEGMENT_ROWS)).fetchall()
+        if not rows:
+            break
+        segments.append(_write_segment(rows, archive_dir))
+
+        # Удаление диапазонами (created_at, id) по порядку сегмента — число параметров не зависит
+        # от batch_size. id <= max_id не даёт удалить строку, вставленную после чтения сегмента
+        max_id = max(row[0] for row in rows)
+        for start in range(0, len(rows), batch_size):
+            last = rows[min(start + batch_size, len(rows)) - 1]
+            with database.transaction() as conn:
+                conn.execute(
+                    'DELETE FROM logs WHERE created_at <= ? AND (created_at, id) <= (?, ?) AND id <= ?',
+                    (last[7], last[7], last[0], max_id)
+                )
+            if pause:
+                time.sleep(pause)
+        if len(rows) < ARCHIVE_SEGMENT_ROWS:
+            break
+    return segments
+
+
+def read_archive(path: Path):
+    """Генератор записей из сегмента архива"""
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            yield json.loads(line)
+
+
+# ========== Место на диске ==========
+
+def incremental_vacuum(pages: int = VACUUM_PAGES) -> int:
+    """Вернуть ОС до pages свободных страниц. Возвращает число страниц, оставшихся свободными"""
+    with database.get_connection() as conn:
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            return conn.execute('PRAGMA freelist_count').fetchone()[0]
+        conn.execute(f'PRAGMA incremental_vacuum({int(pages)})').fetchall()
+        return conn.execute('PRAGMA freelist_count').fetchone()[0]
+
+
+def enable_incremental_vacuum():
+    """Перевести существующую БД в режим auto_vacuum = INCREMENTAL (полный VACUUM, один раз)"""
+    with database.get_connection() as conn:
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+
+
+def run_retention(pause: float = 0.05) -> dict:
+    """Ежедневный проход: снимок общей статистики, свёртка daily_actions, архивация логов, incremental vacuum"""
+    database.snapshot_global_stats()
+    rolled_up = rollup_daily_actions(pause=pause)
+    segments = archive_logs(pause=pause)
+    free_pages = incremental_vacuum()
+    return {
+        'daily_actions_rolled_up': rolled_up,
+        'log_segments': [str(path) for path in segments],
+        'free_pages_left': free_pages
+    }
+
+
+if __name__ == "__main__":
+    database.init_db()
+    if len(sys.argv) > 1 and sys.argv[1] == 'vacuum-setup':
+        enable_incremental_vacuum()
+        print("✅ auto_vacuum = INCREMENTAL")
+    else:
+        print(run_retention())
@@ -0,0 +1,101 @@
+"""
+Проверка initData Telegram Mini App
+Подпись HMAC-SHA256 с ключом из токена бота (https://core.telegram.org/bots/webapps#validating-data-received-via-the-mini-app);
+уже проверенные строки initData держатся в LRU-кэше, чтобы повторные открытия не считали HMAC заново
+"""
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qsl, urlencode
+
+# Сколько секунд initData считается действительной после auth_date
+INIT_DATA_MAX_AGE = int(os.getenv('INIT_DATA_MAX_AGE', '86400'))
+INIT_DATA_CACHE_SIZE = int(os.getenv('INIT_DATA_CACHE_SIZE', '4096'))
+
+
+class InvalidInitData(Exception):
+    """initData не прошла проверку"""
+
+
+def secret_key(bot_token: str) -> bytes:
+    """Ключ подписи WebApp: HMAC-SHA256(key='WebAppData', msg=токен бота)"""
+    return hmac.new(b'WebAppData', bot_token.encode(), hashlib.sha256).digest()
+
+
+def sign_init_data(fields: dict, bot_token: str) -> str:
+    """Собрать подписанную строку initData (для тестов и бенчмарков)"""
+    check_string = '\n'.join(f"{key}={value}" for key, value in sorted(fields.items()))
+    signature = hmac.new(secret_key(bot_token), check_string.encode(), hashlib.sha256).hexdigest()
+    return urlencode({**fields, 'hash': signature})
+
+
+class InitDataValidator:
+    """Проверка initData с LRU-кэшем проверенных строк: {initData: (user_id, auth_date)}"""
+
+    def __init__(self, bot_token: str, max_age: int = INIT_DATA_MAX_AGE, cache_size: int = INIT_DATA_CACHE_SIZE):
+        self.max_age = max_age
+        self.cache_size = cache_size
+        self._key = secret_key(bot_token)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._metrics = {'hits': 0, 'misses': 0, 'rejected': 0}
+
+    def _check_age(self, auth_date: int):
+        if self.max_age and time.time() - auth_date > self.max_age:
+            raise InvalidInitData('initData устарела')
+
+    def verify(self, init_data: str) -> int:
+        """ID пользователя из проверенной initData; InvalidInitData, если подпись неверна или устарела"""
+        with self._lock:
+            cached = self._cache.get(init_data)
+            if cached is not None:
+                self._cache.move_to_end(init_data)
+                self._metrics['hits'] += 1
+        if cached is not None:
+            self._check_age(cached[1])
+            return cached[0]
+
+        try:
+            user_id, auth_date = self._verify_signature(init_data)
+            self._check_age(auth_date)
+        except InvalidInitData:
+            with self._lock:
+                self._metrics['rejected'] += 1
+            raise
+        with self._lock:
+            self._metrics['misses'] += 1
+            self._cache[init_data] = (user_id, auth_date)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return user_id
+
+    def _verify_signature(self, init_data: str) -> tuple:
+        """Проверить HMAC и достать (user_id, auth_date)"""
+        fields = dict(parse_qsl(init_data, keep_blank_values=True))
+        received = fields.pop('hash', None)
+        if not received:
+            raise InvalidInitData('В initData нет hash')
+        check_string = '\n'.join(f"{key}={value}" for key, value in sorted(fields.items()))
+        expected = hmac.new(self._key, check_string.encode(), hashlib.sha256).hexdigest()
+        # compare_digest на str принимает только ASCII — сравниваем байты, чтобы мусор в hash давал 401, а не 500
+        if not hmac.compare_digest(expected.encode(), received.encode()):
+            raise InvalidInitData('Неверная подпись initData')
+        try:
+            user_id = int(json.loads(fields['user'])['id'])
+            auth_date = int(fields['auth_date'])
+        except (KeyError, TypeError, ValueError) as e:
+            raise InvalidInitData(f"В initData нет пользователя или auth_date: {e}")
+        return user_id, auth_date
+
+    def metrics(self) -> dict:
+        """Попадания/промахи кэша и отклонённые initData"""
+        with self._lock:
+            metrics = dict(self._metrics)
+            metrics['size'] = len(self._cache)
+        total = metrics['hits'] + metrics['misses']
+        metrics['hit_rate'] = metrics['hits'] / total if total else 0.0
+        return metrics
@@ -0,0 +1,33 @@
+import sqlite3
+
+import pytest
+
+import database
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """Чистая временная БД; кэши database.py не переживают тест"""
+    monkeypatch.setattr(database, 'DB_PATH', tmp_path / 'test.db')
+    monkeypatch.setattr(database, '_settings_cache', database.SettingsCache())
+    monkeypatch.setattr(database, '_admin_registry', database.AdminRegistry())
+    monkeypatch.setattr(database, '_level_table', None)
+    database.init_db()
+    yield database
+    database.close_connections()
+
+
+@pytest.fixture
+def low_variable_limit(db, monkeypatch):
+    """Лимит переменных в запросе как в SQLite до 3.32 (999) на всех соединениях пула"""
+    limit = 999
+    connect = database.ConnectionPool._connect
+
+    def limited_connect(pool):
+        conn = connect(pool)
+        conn.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, limit)
+        return conn
+
+    database.close_connections()
+    monkeypatch.setattr(database.ConnectionPool, '_connect', limited_connect)
+    return limit
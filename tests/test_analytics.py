@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+import analytics
+
+
+@pytest.fixture
+def activity_rows(db):
+    db.add_user(1, 'one')
+    with db.transaction() as conn:
+        conn.executemany(
+            'INSERT INTO daily_actions (user_id, action_type, xp_earned, action_date) VALUES (?, ?, ?, ?)',
+            [(1, 'note', 10, '2026-01-05'), (1, 'note', 5, None), (1, 'habit', 7, 'не дата'), (None, 'note', 3, '2026-01-05')])
+        conn.executemany(
+            'INSERT INTO logs (user_id, action_type, created_at) VALUES (?, ?, ?)',
+            [(1, 'start', '2026-01-05 10:00:00'), (1, 'start', None), (1, 'start', 'не дата')])
+    return db
+
+
+def test_rows_without_date_are_skipped(activity_rows):
+    activity = analytics.load_activity('daily_actions', chunk_rows=2)
+    assert activity.user_ids.tolist() == [1]
+    assert analytics.to_dates(activity.days).tolist() == [np.datetime64('2026-01-05', 'D')]
+    assert activity.xp.tolist() == [10]
+
+    logs = analytics.load_activity('logs', chunk_rows=2)
+    assert logs.user_ids.tolist() == [1]
+    assert logs.actions.tolist() == [1]
+
+
+def test_report_with_rows_without_date(activity_rows):
+    assert analytics.report()['pairs'] == 1
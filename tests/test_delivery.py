@@ -0,0 +1,83 @@
+import asyncio
+import time
+
+import pytest
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+import delivery
+from delivery import DeliveryPipeline, TokenBucket
+from reminder_dispatcher import utcnow
+
+
+class FakeBot:
+    """Bot, который отвечает ошибками из errors (по очереди), а потом отправляет"""
+
+    def __init__(self, errors=()):
+        self.errors = list(errors)
+        self.sent = []
+
+    async def send_message(self, chat_id, text):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.sent.append((chat_id, time.monotonic()))
+
+
+def retry_after(seconds: int) -> TelegramRetryAfter:
+    return TelegramRetryAfter(SendMessage(chat_id=1, text='t'), 'Too Many Requests', seconds)
+
+
+def reminder(reminder_id: int, chat_id: int) -> dict:
+    return {'id': reminder_id, 'user_id': chat_id, 'title': 't', 'remind_at': utcnow()}
+
+
+async def deliver(bot, reminders, **kwargs):
+    pipeline = DeliveryPipeline(bot, workers=4, global_rate=100, chat_rate=100, chat_burst=10, **kwargs).start()
+    results = await asyncio.gather(*(pipeline.send(r) for r in reminders), return_exceptions=True)
+    await pipeline.stop()
+    return pipeline, results
+
+
+def test_retry_after_pauses_the_whole_bot():
+    bot = FakeBot([retry_after(1)])
+
+    async def main():
+        started = time.monotonic()
+        # Первое сообщение получает 429; сообщение в другой чат тоже ждёт retry_after
+        pipeline, results = await deliver(bot, [reminder(1, 1), reminder(2, 2)])
+        return started, pipeline, results
+
+    started, pipeline, results = asyncio.run(main())
+    assert results == [True, True]
+    assert sorted(chat_id for chat_id, _ in bot.sent) == [1, 2]
+    assert all(sent_at - started >= 0.9 for _, sent_at in bot.sent)
+    metrics = pipeline.metrics()
+    assert (metrics['rate_limited'], metrics['retries']) == (1, 0)
+
+
+def test_rate_limits_and_network_errors_counted_separately(monkeypatch):
+    monkeypatch.setattr(delivery, 'BACKOFF_BASE', 0.01)
+    bot = FakeBot([TelegramNetworkError(SendMessage(chat_id=1, text='t'), 'reset'), retry_after(0)])
+    pipeline, results = asyncio.run(deliver(bot, [reminder(1, 1)], max_retries=1))
+    assert results == [True]
+    metrics = pipeline.metrics()
+    assert (metrics['sent'], metrics['rate_limited'], metrics['retries']) == (1, 1, 1)
+
+
+def test_gives_up_after_max_rate_limits():
+    bot = FakeBot([retry_after(0)] * 3)
+    pipeline, results = asyncio.run(deliver(bot, [reminder(1, 1)], max_retries=2))
+    assert isinstance(results[0], RuntimeError)
+    assert pipeline.metrics()['rate_limited'] == 3
+
+
+def test_pauses_do_not_stack():
+    async def main():
+        bucket = TokenBucket(10)
+        for _ in range(5):
+            bucket.pause(0.3)
+        started = time.monotonic()
+        await bucket.acquire()
+        return time.monotonic() - started
+
+    assert asyncio.run(main()) == pytest.approx(0.4, abs=0.15)
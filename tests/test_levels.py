@@ -0,0 +1,112 @@
+import random
+from math import isqrt
+
+import pytest
+
+import levels
+import web_server
+
+
+def random_xp(count: int, seed: int = 24) -> list:
+    """XP на всех порядках величины: от единиц до 10¹²"""
+    rng = random.Random(seed)
+    return [rng.randint(0, 10 ** rng.randint(1, 12)) for _ in range(count)]
+
+
+def test_thresholds_increase():
+    assert levels.THRESHOLDS[0] == 0
+    assert all(a < b for a, b in zip(levels.THRESHOLDS, levels.THRESHOLDS[1:]))
+
+
+@pytest.mark.parametrize('level', [1, 2, 3, 10, levels.LEVEL_TABLE_SIZE, levels.LEVEL_TABLE_SIZE + 1,
+                                   levels.LEVEL_TABLE_SIZE + 2, 10 ** 5])
+def test_level_boundaries(level):
+    start = levels.level_start(level)
+    assert levels.level_for_xp(start) == level
+    assert levels.level_for_xp(levels.level_start(level + 1) - 1) == level
+    if level > 1:
+        assert levels.level_for_xp(start - 1) == level - 1
+
+
+def test_every_table_boundary():
+    for level in range(1, levels.LEVEL_TABLE_SIZE + 50):
+        start = levels.level_start(level)
+        assert levels.level_for_xp(start) == level
+        assert level == 1 or levels.level_for_xp(start - 1) == level - 1
+
+
+@pytest.mark.parametrize('xp', [None, -1, -10 ** 6])
+def test_missing_or_negative_xp_is_level_one(xp):
+    assert levels.level_for_xp(xp) == 1
+    assert levels.progress(xp)['xp'] == 0
+
+
+def test_bisect_matches_isqrt_and_old_formula():
+    for xp in random_xp(20000):
+        level = levels.level_for_xp(xp)
+        assert level == isqrt(xp // levels.XP_UNIT) + 1, xp
+        # Прежняя формула add_xp: float точен на этом диапазоне
+        assert level == int((xp / 100) ** 0.5) + 1, xp
+
+
+def test_progress_within_level():
+    for xp in random_xp(20000, seed=25):
+        progress = levels.progress(xp)
+        assert progress['level'] == levels.level_for_xp(xp)
+        assert progress['level_xp'] <= xp < progress['next_level_xp']
+        assert progress['xp_in_level'] + progress['level_xp'] == xp
+        assert 0 <= progress['progress_percent'] < 100
+
+
+def test_level_table_title_and_curve(db):
+    table = db.get_level_table()
+    assert table.title(1) == 'Новичок'
+    assert table.title(10) == table.title(500) == 'Легенда'
+    assert all(reward.xp_required == levels.level_start(reward.level) for reward in table.rewards)
+    assert db.get_xp_for_level(1) == levels.level_start(2)
+
+
+def test_bot_and_mini_app_agree(db):
+    db.set_setting('daily_xp_limit', str(10 ** 9))
+    rng = random.Random(24)
+    for user_id in range(1, 21):
+        db.add_user(user_id, f'user{user_id}')
+    for _ in range(500):
+        user_id = rng.randint(1, 20)
+        result = db.add_xp(user_id, rng.randint(1, 400), 'test')
+        user = db.get_user(user_id)
+        progress = db.get_level_progress(user_id)
+        stats = web_server.get_user_stats(user_id)
+        assert result['level'] == user['level'] == levels.level_for_xp(user['xp'])
+        assert progress['level'] == stats['level'] == user['level']
+        assert stats['nextLevelXp'] == progress['next_level_xp']
+        assert stats['progressPercent'] == progress['progress_percent']
+        assert stats['reward'] == progress['reward']
+    assert db.check_levels() == []
+
+
+def test_level_up_bonus_crossing_next_threshold(db):
+    db.set_setting('daily_xp_limit', str(10 ** 9))
+    db.add_user(1, 'one')
+    # 390 XP — уровень 2 с бонусом 50 → 440 XP, а это уже уровень 3
+    result = db.add_xp(1, 390, 'test')
+    assert result['level_up'] and result['level'] == 3
+    assert db.get_user(1)['xp'] == 440
+    assert db.get_user(1)['level'] == 3
+    assert db.check_levels() == []
+
+
+def test_build_user_stats_uses_curve(db):
+    stats = web_server.build_user_stats({'xp': 50, 'daily_xp': 0, 'daily_limit': 500, 'reminders': 0,
+                                         'completed': 0, 'notes': 0, 'total_streak': 0, 'habits': 0})
+    assert (stats['level'], stats['nextLevelXp'], stats['progressPercent'], stats['reward']) == (1, 100, 50, 'Новичок')
+
+
+def test_repair_levels_fixes_stale_users(db):
+    db.add_user(1, 'one')
+    with db.transaction() as conn:
+        conn.execute('UPDATE users SET xp = 2500, level = 2 WHERE user_id = 1')
+    assert db.check_levels()
+    assert db.repair_levels() == 1
+    assert db.get_user(1)['level'] == 6
+    assert db.check_levels() == []
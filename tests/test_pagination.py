@@ -0,0 +1,49 @@
+import pytest
+
+
+@pytest.fixture
+def users_with_null_xp(db):
+    with db.transaction() as conn:
+        conn.executemany('INSERT INTO users (user_id, username, xp) VALUES (?, ?, ?)',
+                         [(user_id, f'user{user_id}', None if user_id % 3 == 0 else user_id % 5 * 10)
+                          for user_id in range(1, 31)])
+    return db
+
+
+@pytest.fixture
+def logs_with_null_dates(db):
+    with db.transaction() as conn:
+        conn.executemany('INSERT INTO logs (user_id, action_type, created_at) VALUES (?, ?, ?)',
+                         [(i % 2, 'a' if i % 4 else 'b', None if i % 3 == 0 else f'2026-01-{1 + i % 7:02d} 00:00:00')
+                          for i in range(1, 41)])
+    return db
+
+
+def baseline(db, sql: str) -> list:
+    with db.get_connection() as conn:
+        return [row[0] for row in conn.execute(sql)]
+
+
+@pytest.mark.parametrize('batch_size', [1, 4, 10, 30, 100])
+def test_users_pages_include_null_xp(users_with_null_xp, batch_size):
+    db = users_with_null_xp
+    expected = baseline(db, 'SELECT user_id FROM users ORDER BY xp DESC, user_id')
+    assert [user['user_id'] for user in db.iter_users_with_stats(batch_size)] == expected
+    assert len(db.get_all_users_with_stats()) == 30
+
+
+@pytest.mark.parametrize('filters', [{}, {'user_id': 1}, {'action_type': 'b'}])
+@pytest.mark.parametrize('limit', [1, 3, 7, 40, 100])
+def test_logs_pages_include_null_created_at(logs_with_null_dates, filters, limit):
+    db = logs_with_null_dates
+    conditions = ' AND '.join(f'{column} = {value!r}' for column, value in filters.items()) or '1'
+    expected = baseline(db, f'SELECT id FROM logs WHERE {conditions} ORDER BY created_at DESC, id DESC')
+    seen, cursor = [], None
+    while True:
+        logs, cursor = db.get_logs_page(limit, cursor, **filters)
+        seen += [log['id'] for log in logs]
+        if cursor is None:
+            break
+    assert seen == expected
+
+    assert [log['id'] for log in db.iter_logs(limit, **filters)] == expected[::-1]
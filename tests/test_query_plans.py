@@ -0,0 +1,74 @@
+"""
+Планы горячих запросов: ни один не должен сканировать таблицу целиком
+Проверяется SQL, который функции database.py выполняют на самом деле — он перехватывается трассировкой соединений
+"""
+from datetime import timedelta
+
+import pytest
+
+from database import ConnectionPool
+from reminder_dispatcher import utcnow
+
+# Горячая функция и аргументы, с которыми она вызывается ботом, Mini App или админкой
+HOT_CALLS = {
+    'get_all_reminders': lambda db: db.get_all_reminders(1),
+    'get_all_notes': lambda db: db.get_all_notes(1),
+    'get_all_habits': lambda db: db.get_all_habits(1),
+    'get_user_stats': lambda db: db.get_user_stats(1),
+    'get_users_stats': lambda db: db.get_users_stats([1, 2]),
+    'get_user_logs': lambda db: db.get_user_logs(1),
+    'get_all_logs': lambda db: db.get_all_logs(),
+    'get_logs_page': lambda db: db.get_logs_page(),
+    'get_logs_page (курсор)': lambda db: db.get_logs_page(before=('2030-01-01 00:00:00', 100)),
+    'get_logs_page (пользователь)': lambda db: db.get_logs_page(user_id=1),
+    'get_logs_page (действие)': lambda db: db.get_logs_page(action_type='add_note'),
+    'get_logs_page (хвост без даты)': lambda db: db.get_logs_page(before=(None, 100)),
+    'get_logs_page (хвост без даты, пользователь)': lambda db: db.get_logs_page(before=(None, 100), user_id=1),
+    'count_logs (пользователь)': lambda db: db.count_logs(user_id=1),
+    'get_users_with_stats_page': lambda db: db.get_users_with_stats_page(),
+    'get_users_with_stats_page (курсор)': lambda db: db.get_users_with_stats_page(after=(100, 1)),
+    'get_users_with_stats_page (хвост без XP)': lambda db: db.get_users_with_stats_page(after=(None, 1)),
+    'get_pending_reminders': lambda db: db.get_pending_reminders(),
+    'get_pre_notify_reminders': lambda db: db.get_pre_notify_reminders(),
+    'get_upcoming_reminders': lambda db: db.get_upcoming_reminders(
+        utcnow() + timedelta(minutes=5), utcnow() + timedelta(hours=1), utcnow()),
+    'claim_due_reminders': lambda db: db.claim_due_reminders(),
+    'claim_reminders': lambda db: db.claim_reminders([1, 2]),
+    'ack_reminders': lambda db: db.ack_reminders([1, 2]),
+    'release_reminders': lambda db: db.release_reminders([1, 2]),
+    'claim_due_reminders (pre_notified)': lambda db: db.claim_due_reminders(kind='pre_notified'),
+}
+
+
+@pytest.fixture
+def traced(db, monkeypatch):
+    """Список SQL, выполненных соединениями пула"""
+    statements = []
+    connect = ConnectionPool._connect
+
+    def traced_connect(pool):
+        conn = connect(pool)
+        conn.set_trace_callback(statements.append)
+        return conn
+
+    db.close_connections()
+    monkeypatch.setattr(ConnectionPool, '_connect', traced_connect)
+    return statements
+
+
+def full_scans(conn, sql: str) -> list:
+    """Шаги плана с полным сканированием таблицы (обход json_each — это список аргументов, а не таблица)"""
+    plan = [row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}')]
+    return [step for step in plan
+            if step.startswith('SCAN ') and 'USING' not in step and 'VIRTUAL TABLE' not in step]
+
+
+@pytest.mark.parametrize('name', HOT_CALLS)
+def test_hot_query_uses_index(db, traced, name):
+    db.add_user(1, 'one')
+    HOT_CALLS[name](db)
+    queries = [sql for sql in traced if sql.lstrip().upper().startswith(('SELECT', 'WITH', 'UPDATE', 'DELETE'))]
+    assert queries, f"{name} не выполнила ни одного запроса"
+    with db.get_connection() as conn:
+        for sql in queries:
+            assert not full_scans(conn, sql), sql
@@ -0,0 +1,170 @@
+import asyncio
+import sqlite3
+from collections import Counter
+from datetime import timedelta
+
+import async_db
+import database
+import reminder_dispatcher
+from reminder_dispatcher import ReminderDispatcher, utcnow
+
+
+class Recorder:
+    """Отправитель, который запоминает, сколько раз ушло каждое напоминание"""
+
+    def __init__(self):
+        self.sent = Counter()
+
+    async def __call__(self, reminder):
+        await asyncio.sleep(0.01)
+        self.sent[reminder['id']] += 1
+
+
+async def run_for(dispatcher: ReminderDispatcher, seconds: float):
+    task = asyncio.create_task(dispatcher.run())
+    await asyncio.sleep(seconds)
+    dispatcher.stop()
+    await asyncio.wait_for(task, 5)
+
+
+def add_in(seconds: float, user_id: int = 1) -> int:
+    return database.add_reminder(user_id, 't', utcnow() + timedelta(seconds=seconds))
+
+
+def test_restart_delete_and_add_without_duplicates_or_misses(db):
+    send = Recorder()
+
+    async def main():
+        ids = [add_in(0.3 + i * 0.03, user_id=i % 7) for i in range(60)]
+        deleted = set(ids[-10:])  # срок у них позже всего — удаляем до него
+        added = []
+        for restart in range(3):
+            dispatcher = ReminderDispatcher(send)
+            task = asyncio.create_task(dispatcher.run())
+            await asyncio.sleep(0.1)
+            if restart == 0:
+                for reminder_id in deleted:
+                    await asyncio.to_thread(database.delete_reminder, reminder_id)
+                added.append(await asyncio.to_thread(add_in, 0.5))
+            elif restart == 1:
+                added.append(await asyncio.to_thread(add_in, 0.2))
+            await asyncio.sleep(0.9)
+            dispatcher.stop()
+            await asyncio.wait_for(task, 5)
+        return set(ids) - deleted | set(added), deleted
+
+    expected, deleted = asyncio.run(main())
+    assert [rid for rid, count in send.sent.items() if count > 1] == []
+    assert set(send.sent) == expected
+    assert not deleted & set(send.sent)
+
+
+def test_loop_survives_database_errors(db, monkeypatch):
+    monkeypatch.setattr(reminder_dispatcher, 'ERROR_BACKOFF', 0.05)
+    real_claim = async_db.claim_reminders
+    failures = {'left': 2}
+
+    async def flaky_claim(reminder_ids, kind):
+        if failures['left']:
+            failures['left'] -= 1
+            raise sqlite3.OperationalError('database is locked')
+        return await real_claim(reminder_ids, kind)
+
+    monkeypatch.setattr(async_db, 'claim_reminders', flaky_claim)
+    send = Recorder()
+    dispatcher = ReminderDispatcher(send)
+
+    async def main():
+        ids = [add_in(0.1 + i * 0.05) for i in range(5)]
+        await run_for(dispatcher, 1.5)
+        return ids
+
+    ids = asyncio.run(main())
+    assert dispatcher.stats['loop_errors'] == 2
+    assert send.sent == Counter({reminder_id: 1 for reminder_id in ids})
+
+
+def test_loop_survives_reload_errors(db, monkeypatch):
+    monkeypatch.setattr(reminder_dispatcher, 'ERROR_BACKOFF', 0.05)
+    real_upcoming = async_db.get_upcoming_reminders
+    failures = {'left': 1}
+
+    async def flaky_upcoming(*args):
+        if failures['left']:
+            failures['left'] -= 1
+            raise sqlite3.OperationalError('database is locked')
+        return await real_upcoming(*args)
+
+    monkeypatch.setattr(async_db, 'get_upcoming_reminders', flaky_upcoming)
+    send = Recorder()
+    dispatcher = ReminderDispatcher(send)
+
+    async def main():
+        reminder_id = add_in(0.2)
+        await run_for(dispatcher, 1.0)
+        return reminder_id
+
+    reminder_id = asyncio.run(main())
+    assert dispatcher.stats['loop_errors'] == 1
+    assert send.sent == Counter({reminder_id: 1})
+
+
+def test_stale_claim_from_crashed_process_is_sent(db):
+    """Процесс упал между claim_reminders и ack_reminders: напоминание не теряется"""
+    stale, fresh = add_in(-60), add_in(-60)
+    database.claim_reminders([stale, fresh])
+    with database.get_connection() as conn:
+        conn.execute("UPDATE reminders SET claimed_at = datetime('now', '-11 minutes') WHERE id = ?", (stale,))
+        conn.commit()
+    send = Recorder()
+    asyncio.run(run_for(ReminderDispatcher(send), 0.5))
+    # Свежий захват может ещё отправляться другим процессом — его не трогаем
+    assert send.sent == Counter({stale: 1})
+    with database.get_connection() as conn:
+        rows = dict(conn.execute('SELECT id, claimed_at IS NULL FROM reminders WHERE notified'))
+    assert rows == {stale: 1, fresh: 0}
+
+
+def test_permanent_failure_is_acked_without_retries(db, monkeypatch):
+    monkeypatch.setattr(reminder_dispatcher, 'RETRY_DELAY', timedelta(seconds=0.05))
+    calls = Counter()
+
+    async def send(reminder):
+        calls[reminder['id']] += 1
+        if reminder['id'] == blocked:
+            raise reminder_dispatcher.PermanentSendError('Forbidden: bot was blocked by the user')
+        raise ConnectionError('temporary')
+
+    blocked, flaky = add_in(0.1), add_in(0.1)
+    asyncio.run(run_for(ReminderDispatcher(send), 1.0))
+    assert calls[blocked] == 1
+    assert calls[flaky] == reminder_dispatcher.MAX_ATTEMPTS
+    with database.get_connection() as conn:
+        rows = dict(conn.execute('SELECT id, notified AND claimed_at IS NULL FROM reminders'))
+    assert rows == {blocked: 1, flaky: 1}
+
+
+def test_claim_ack_release_more_ids_than_variable_limit(db, low_variable_limit):
+    ids = [add_in(-60) for _ in range(low_variable_limit * 2)]
+    assert len(database.claim_reminders(ids)) == len(ids)
+    database.release_reminders(ids[::2])
+    database.ack_reminders(ids[1::2])
+    with database.get_connection() as conn:
+        rows = conn.execute('SELECT COUNT(*), SUM(notified), COUNT(claimed_at) FROM reminders').fetchone()
+    assert rows == (len(ids), len(ids) // 2, 0)
+
+
+def test_backlog_larger_than_variable_limit_is_delivered(db, low_variable_limit):
+    """После простоя наступивших напоминаний больше, чем переменных в одном запросе"""
+    with database.transaction() as conn:
+        conn.executemany('INSERT INTO reminders (user_id, title, remind_at) VALUES (?, ?, ?)',
+                         ((i % 50, 't', utcnow() - timedelta(hours=1)) for i in range(low_variable_limit * 2)))
+    sent = Counter()
+
+    async def send(reminder):
+        sent[reminder['id']] += 1
+
+    dispatcher = ReminderDispatcher(send)
+    asyncio.run(run_for(dispatcher, 1.0))
+    assert dispatcher.stats['loop_errors'] == 0
+    assert len(sent) == low_variable_limit * 2 and set(sent.values()) == {1}
@@ -0,0 +1,36 @@
+import pytest
+
+import retention
+
+
+@pytest.fixture
+def old_logs(db):
+    # 25 строк старше срока хранения (часть с одинаковым created_at) и 3 свежие
+    rows = [(i % 4, 'old', f'2020-01-{1 + i // 3:02d} 00:00:00') for i in range(25)]
+    rows += [(1, 'new', '2999-01-01 00:00:00')] * 3
+    with db.transaction() as conn:
+        conn.executemany('INSERT INTO logs (user_id, action_type, created_at) VALUES (?, ?, ?)', rows)
+    return db
+
+
+@pytest.mark.parametrize('batch_size', [1, 7, 25, 10 ** 6])
+def test_archive_logs_moves_every_old_row_once(old_logs, tmp_path, monkeypatch, batch_size):
+    monkeypatch.setattr(retention, 'ARCHIVE_SEGMENT_ROWS', 10)
+    segments = retention.archive_logs(days=90, batch_size=batch_size, archive_dir=tmp_path / 'archive')
+    archived = [entry for path in segments for entry in retention.read_archive(path)]
+    assert sorted(entry['id'] for entry in archived) == list(range(1, 26))
+    assert {entry['action_type'] for entry in archived} == {'old'}
+    with old_logs.get_connection() as conn:
+        assert conn.execute("SELECT action_type, COUNT(*) FROM logs GROUP BY action_type").fetchall() == [('new', 3)]
+
+
+def test_batch_size_setting_above_sqlite_variable_limit(db, tmp_path, low_variable_limit):
+    # retention_batch_size больше лимита переменных SQLite
+    rows = 2000
+    with db.transaction() as conn:
+        conn.executemany('INSERT INTO logs (user_id, action_type, created_at) VALUES (?, ?, ?)',
+                         ((1, 'old', '2020-01-01 00:00:00') for _ in range(rows)))
+    db.set_setting('retention_batch_size', str(10 ** 6))
+    segments = retention.archive_logs(days=90, archive_dir=tmp_path / 'archive')
+    assert sum(1 for path in segments for _ in retention.read_archive(path)) == rows
+    assert db.count_logs() == 0
@@ -0,0 +1,63 @@
+from datetime import timedelta
+
+import pytest
+
+from reminder_dispatcher import utcnow
+
+
+@pytest.fixture
+def users(db):
+    for user_id in (1, 2):
+        db.add_user(user_id, f'user{user_id}')
+    return db
+
+
+def test_write_paths_keep_user_stats_consistent(users):
+    db = users
+    steps = []
+
+    def step(name, action):
+        action()
+        steps.append((name, db.check_user_stats()))
+
+    reminders = []
+    step('add_reminder', lambda: reminders.extend(
+        db.add_reminder(user_id, 'r', utcnow() + timedelta(hours=i)) for user_id in (1, 2) for i in range(3)))
+    step('complete_reminder', lambda: db.complete_reminder(reminders[0]))
+    step('complete_reminder (повторно)', lambda: db.complete_reminder(reminders[0]))
+    step('delete_reminder (выполненное)', lambda: db.delete_reminder(reminders[0]))
+    step('delete_reminder', lambda: db.delete_reminder(reminders[1]))
+
+    notes = []
+    step('add_note', lambda: notes.extend(db.add_note(user_id, 'n') for user_id in (1, 2, 1)))
+    step('toggle_pin_note', lambda: [db.toggle_pin_note(note_id) for note_id in notes])
+    step('toggle_pin_note (открепить)', lambda: db.toggle_pin_note(notes[1]))
+    step('delete_note (закреплённая)', lambda: db.delete_note(notes[0]))
+
+    habits = []
+    step('add_habit', lambda: habits.extend(db.add_habit(user_id, 'h') for user_id in (1, 1, 2)))
+    step('complete_habit', lambda: [db.complete_habit(habit_id) for habit_id in habits])
+    step('complete_habit (сегодня уже)', lambda: db.complete_habit(habits[0]))
+    step('delete_habit (со стриком)', lambda: db.delete_habit(habits[1]))
+
+    step('add_xp', lambda: [db.add_xp(user_id, 15, 'test') for user_id in (1, 1, 2)])
+
+    assert [name for name, mismatched in steps if mismatched] == []
+    assert db.get_user_stats(1) == {
+        'total_reminders': 1, 'completed_reminders': 0,
+        'total_notes': 1, 'pinned_notes': 1,
+        'total_habits': 1, 'total_streak': 1, 'total_habit_completions': 1,
+        'today_xp': 30,
+    }
+    assert db.get_user_stats(2)['total_reminders'] == 3
+    assert db.get_user_stats(2)['pinned_notes'] == 0
+
+
+def test_check_user_stats_finds_drift(users):
+    db = users
+    db.add_note(1, 'n')
+    with db.transaction() as conn:
+        conn.execute('UPDATE user_stats SET total_notes = total_notes + 5 WHERE user_id = 1')
+    assert db.check_user_stats() == [1]
+    db.repair_user_stats()
+    assert db.check_user_stats() == []
@@ -0,0 +1,114 @@
+import json
+import time
+
+import pytest
+
+import leaderboard
+import telegram_auth
+import web_server
+
+TOKEN = '123456:TEST'
+ADMIN_ID = 100
+
+
+def init_data(user_id: int, token: str = TOKEN) -> dict:
+    """Заголовок с подписанной initData пользователя"""
+    signed = telegram_auth.sign_init_data({
+        'user': json.dumps({'id': user_id, 'first_name': f'user{user_id}'}),
+        'auth_date': str(int(time.time())),
+    }, token)
+    return {'X-Telegram-Init-Data': signed}
+
+
+@pytest.fixture
+def client(db, monkeypatch):
+    monkeypatch.setenv('BOT_TOKEN', TOKEN)
+    monkeypatch.setattr(web_server, '_init_data_validator', None)
+    monkeypatch.setattr(web_server, '_stats_cache', web_server.StatsCache())
+    monkeypatch.setattr(leaderboard, '_leaderboard', None)
+    for user_id in (1, 2, ADMIN_ID):
+        db.add_user(user_id, f'user{user_id}')
+    db.set_admin(ADMIN_ID, True)
+    return web_server.app.test_client()
+
+
+def test_stats_by_id_requires_init_data(client):
+    assert client.get('/api/stats/1').status_code == 401
+    assert client.get('/api/stats/1', headers=init_data(1, token='654321:OTHER')).status_code == 401
+
+
+def test_stats_by_id_for_own_user(client):
+    response = client.get('/api/stats/1', headers=init_data(1))
+    assert response.status_code == 200
+    assert response.get_json()['success']
+
+
+def test_stats_by_id_of_other_user_is_forbidden(client):
+    assert client.get('/api/stats/2', headers=init_data(1)).status_code == 403
+
+
+def test_admin_reads_any_user(client):
+    assert client.get('/api/stats/2', headers=init_data(ADMIN_ID)).status_code == 200
+    assert client.get('/api/stats/999', headers=init_data(ADMIN_ID)).status_code == 404
+
+
+def test_current_user_stats(client):
+    assert client.get('/api/stats').status_code == 401
+    response = client.get('/api/stats', headers=init_data(2))
+    assert response.status_code == 200
+
+
+def test_batch_is_admin_only(client):
+    assert client.post('/api/stats/batch', json={'user_ids': [1]}).status_code == 401
+    assert client.post('/api/stats/batch', json={'user_ids': [1]}, headers=init_data(1)).status_code == 403
+
+
+def test_batch_for_admin(client):
+    response = client.post('/api/stats/batch', json={'user_ids': [1, 2, 999, 1]}, headers=init_data(ADMIN_ID))
+    assert response.status_code == 200
+    body = json.loads(response.get_data())
+    assert sorted(body['data']) == ['1', '2']
+    assert body['missing'] == [999]
+
+
+@pytest.mark.parametrize('user_ids', [[True], [1, False], ['1'], [1.0], 5, None])
+def test_batch_rejects_non_integer_ids(client, user_ids):
+    response = client.post('/api/stats/batch', json={'user_ids': user_ids}, headers=init_data(ADMIN_ID))
+    assert response.status_code == 400
+
+
+def test_leaderboard_requires_init_data(client):
+    assert client.get('/api/leaderboard').status_code == 401
+    response = client.get('/api/leaderboard', headers=init_data(1))
+    assert response.status_code == 200
+    assert len(response.get_json()['data']) == 3
+
+
+def test_leaderboard_around_only_own_id(client):
+    assert client.get('/api/leaderboard?around=1', headers=init_data(1)).status_code == 200
+    assert client.get('/api/leaderboard?around=2', headers=init_data(1)).status_code == 403
+    assert client.get('/api/leaderboard?around=2', headers=init_data(ADMIN_ID)).status_code == 200
+
+
+def test_rank_only_own_id(client):
+    assert client.get('/api/rank/1').status_code == 401
+    assert client.get('/api/rank/1', headers=init_data(1)).status_code == 200
+    assert client.get('/api/rank/2', headers=init_data(1)).status_code == 403
+    assert client.get('/api/rank/2', headers=init_data(ADMIN_ID)).status_code == 200
+
+
+def test_metrics_admin_only(client):
+    assert client.get('/api/metrics').status_code == 401
+    assert client.get('/api/metrics', headers=init_data(1)).status_code == 403
+    assert 'stats_cache' in client.get('/api/metrics', headers=init_data(ADMIN_ID)).get_json()
+
+
+@pytest.mark.parametrize('hash_value', ['%D0%B0', '%D0%B0' * 32, 'zz', ''])
+def test_malformed_hash_is_rejected(client, hash_value):
+    signed = init_data(1)['X-Telegram-Init-Data']
+    forged = signed[:signed.index('hash=')] + f'hash={hash_value}'
+    response = client.get('/api/stats', headers={'X-Telegram-Init-Data': forged})
+    assert response.status_code == 401
+    validator = web_server.get_init_data_validator()
+    with pytest.raises(telegram_auth.InvalidInitData):
+        validator.verify(forged)
@@ -0,0 +1,253 @@
+"""
+Выгрузка и загрузка данных пользователей в NDJSON: резервные копии, переезд, перенос шардов
+Каждая таблица — файл <таблица>.ndjson: первая строка — заголовок {"table", "columns", "dump", "schema"},
+дальше по JSON-массиву на строку таблицы. Память не зависит от объёма: выгрузка читает курсором
+пачками fetchmany, загрузка пишет executemany большими транзакциями. Обе продолжаются
+с контрольной точки, если процесс упал или был остановлен
+Запуск: python transfer.py export <папка> [--shard K/N] | import <папка> [--on-conflict update] [--new-ids]
+"""
+import argparse
+import json
+import os
+import time
+import uuid
+from itertools import islice
+from pathlib import Path
+
+import database
+
+# Сколько строк читать за один fetchmany
+TRANSFER_BATCH_ROWS = int(os.getenv('TRANSFER_BATCH_ROWS', '5000'))
+# Сколько строк между контрольными точками выгрузки
+TRANSFER_CHECKPOINT_ROWS = int(os.getenv('TRANSFER_CHECKPOINT_ROWS', '100000'))
+# Сколько строк в одной транзакции загрузки: пока она идёт, бот ждёт блокировку записи (busy_timeout 5 s)
+TRANSFER_COMMIT_ROWS = int(os.getenv('TRANSFER_COMMIT_ROWS', '20000'))
+
+# Таблицы в порядке выгрузки и загрузки (пользователи первыми) и ключ, по которому идёт обход
+TABLES = (
+    ('users', 'user_id'),
+    ('reminders', 'id'),
+    ('notes', 'id'),
+    ('habits', 'id'),
+    ('daily_actions', 'id'),
+    ('daily_xp_rollups', 'rowid'),
+    ('logs', 'id'),
+)
+# Уникальный ключ для --on-conflict update, если он не совпадает с ключом обхода
+_CONFLICT_KEYS = {'daily_xp_rollups': ('user_id', 'action_date', 'action_type')}
+# Колонки, которые при загрузке заполняют триггеры целевой БД
+_DERIVED_COLUMNS = {'users': {'stats_version'}}
+
+CHECKPOINT_FILE = 'export.checkpoint.json'
+
+_encode = json.JSONEncoder(ensure_ascii=False, separators=(',', ':')).encode
+
+
+def table_columns(conn, table: str) -> list:
+    """Колонки таблицы в порядке схемы"""
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+
+
+def _write_json(path: Path, data: dict):
+    """Атомарно записать JSON на диск"""
+    tmp_path = path.with_suffix('.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+# ========== Выгрузка ==========
+
+def export_data(directory, tables: list = None, shard: tuple = None, fresh: bool = False,
+                batch_rows: int = TRANSFER_BATCH_ROWS, checkpoint_rows: int = TRANSFER_CHECKPOINT_ROWS,
+                progress=None) -> dict:
+    """
+    Выгрузить таблицы в directory/<таблица>.ndjson
+    shard=(k, n) — только пользователи с user_id % n == k и их данные
+    Всё читается в одной читающей транзакции — согласованный снимок (WAL не мешает записи,
+    но checkpoint WAL дождётся конца выгрузки)
+    Каждые checkpoint_rows строк файл сбрасывается на диск, а позиция и последний ключ — в export.checkpoint.json;
+    повторный запуск обрезает файл до этой позиции и продолжает с ключа после неё. fresh — начать заново
+    progress(table, rows) вызывается после каждой контрольной точки
+    Возвращает {таблица: выгружено строк}
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    checkpoint_path = directory / CHECKPOINT_FILE
+    shard = list(shard) if shard else None
+    if checkpoint_path.exists() and not fresh:
+        with open(checkpoint_path, encoding='utf-8') as f:
+            state = json.load(f)
+        if state['shard'] != shard:
+            raise ValueError(f"В {directory} незавершённая выгрузка шарда {state['shard']}")
+    else:
+        state = {'dump': uuid.uuid4().hex, 'shard': shard, 'tables': {}}
+
+    with database.transaction(immediate=False) as conn:
+        schema = conn.execute('PRAGMA user_version').fetchone()[0]
+        for table, key in TABLES:
+            if tables and table not in tables:
+                continue
+            entry = state['tables'].get(table)
+            if entry and entry['done']:
+                continue
+            columns = table_columns(conn, table)
+            path = directory / f"{table}.ndjson"
+            if entry is None:
+                header = {'table': table, 'columns': columns, 'dump': state['dump'], 'schema': schema}
+                with open(path, 'wb') as f:
+                    f.write(_encode(header).encode('utf-8') + b'\n')
+                    position = f.tell()
+                entry = state['tables'][table] = {'key': -(1 << 63), 'rows': 0, 'position': position, 'done': False}
+
+            conditions, params = [f'{key} > ?'], [entry['key']]
+            if shard:
+                conditions.append('user_id % ? = ?')
+                params += [shard[1], shard[0]]
+            cursor = conn.execute(f'''
+                SELECT {key}, {', '.join(columns)} FROM {table}
+                WHERE {' AND '.join(conditions)}
+                ORDER BY {key}
+            ''', params)
+
+            def save(f):
+                f.flush()
+                os.fsync(f.fileno())
+                entry['position'] = f.tell()
+                _write_json(checkpoint_path, state)
+                if progress:
+                    progress(table, entry['rows'])
+
+            with open(path, 'r+b') as f:
+                # Всё, что записано после последней контрольной точки, выгружается заново
+                f.truncate(entry['position'])
+                f.seek(entry['position'])
+                pending = 0
+                while True:
+                    rows = cursor.fetchmany(batch_rows)
+                    if not rows:
+                        break
+                    f.write(''.join([_encode(row[1:]) + '\n' for row in rows]).encode('utf-8'))
+                    entry['rows'] += len(rows)
+                    entry['key'] = rows[-1][0]
+                    pending += len(rows)
+                    if pending >= checkpoint_rows:
+                        save(f)
+                        pending = 0
+                entry['done'] = True
+                save(f)
+    return {table: entry['rows'] for table, entry in state['tables'].items()}
+
+
+# ========== Загрузка ==========
+
+def _insert_sql(table: str, key: str, columns: list, on_conflict: str) -> str:
+    """INSERT с обработкой конфликтов: 'ignore' — оставить существующую строку, 'update' — перезаписать"""
+    sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+    if on_conflict == 'ignore':
+        return sql + ' ON CONFLICT DO NOTHING'
+    if on_conflict == 'update':
+        keys = _CONFLICT_KEYS.get(table, (key,))
+        updates = ', '.join(f'{column} = excluded.{column}' for column in columns if column not in keys)
+        return sql + f" ON CONFLICT ({', '.join(keys)}) DO " + (f'UPDATE SET {updates}' if updates else 'NOTHING')
+    raise ValueError(f"Неизвестный режим конфликтов: {on_conflict}")
+
+
+def import_data(directory, tables: list = None, on_conflict: str = 'ignore', new_ids: bool = False,
+                commit_rows: int = TRANSFER_COMMIT_ROWS, progress=None) -> dict:
+    """
+    Загрузить выгрузку из directory
+    Пачка строк и позиция в файле (transfer_checkpoints) пишутся в одной транзакции, поэтому
+    после падения загрузка продолжается ровно с первой незагруженной строки
+    Триггеры срабатывают как при обычной записи: user_stats, счётчики и версии статистики остаются верными
+    on_conflict: 'ignore' — строки с существующим ключом пропускаются, 'update' — перезаписываются
+    new_ids: не переносить id напоминаний, заметок, привычек, действий и логов (шард переезжает в БД,
+    где эти id уже заняты)
+    Колонки, которых нет в схеме этой БД, пропускаются
+    Возвращает {таблица: обработано строк выгрузки}
+    """
+    directory = Path(directory)
+    checkpoint_path = directory / CHECKPOINT_FILE
+    exported = {}
+    if checkpoint_path.exists():
+        with open(checkpoint_path, encoding='utf-8') as f:
+            exported = json.load(f)['tables']
+    result = {}
+    for table, key in TABLES:
+        path = directory / f"{table}.ndjson"
+        if (tables and table not in tables) or not path.exists():
+            continue
+        if table in exported and not exported[table]['done']:
+            raise ValueError(f"Выгрузка {table} не завершена: сначала продолжите export")
+        with open(path, 'rb') as f:
+            header_line = f.readline()
+            header = json.loads(header_line)
+            name = f"import:{header['dump']}:{table}"
+            with database.get_connection() as conn:
+                target = set(table_columns(conn, table))
+                checkpoint = conn.execute(
+                    'SELECT position, rows, done FROM transfer_checkpoints WHERE name = ?', (name,)
+                ).fetchone()
+            if checkpoint and checkpoint[2]:
+                result[table] = checkpoint[1]
+                continue
+            position, loaded = checkpoint[:2] if checkpoint else (len(header_line), 0)
+
+            skip = set(_DERIVED_COLUMNS.get(table, ()))
+            if new_ids and key == 'id':
+                skip.add('id')
+            indexes = [i for i, column in enumerate(header['columns']) if column in target and column not in skip]
+            sql = _insert_sql(table, key, [header['columns'][i] for i in indexes], on_conflict)
+            whole_rows = len(indexes) == len(header['columns'])
+
+            f.seek(position)
+            done = False
+            while not done:
+                lines = list(islice(f, commit_rows))
+                done = len(lines) < commit_rows
+                position += sum(map(len, lines))
+                loaded += len(lines)
+                rows = map(json.loads, lines)
+                with database.transaction() as conn:
+                    conn.executemany(sql, rows if whole_rows else ([row[i] for i in indexes] for row in rows))
+                    conn.execute('''
+                        INSERT INTO transfer_checkpoints (name, position, rows, done, updated_at)
+                        VALUES (?, ?, ?, ?, ?)
+                        ON CONFLICT(name) DO UPDATE SET
+                            position = excluded.position,
+                            rows = excluded.rows,
+                            done = excluded.done,
+                            updated_at = excluded.updated_at
+                    ''', (name, position, loaded, done, time.time()))
+                if progress:
+                    progress(table, loaded)
+        result[table] = loaded
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Выгрузка и загрузка данных пользователей (NDJSON)")
+    parser.add_argument('command', choices=('export', 'import'))
+    parser.add_argument('directory')
+    parser.add_argument('--tables', nargs='+', choices=[table for table, _ in TABLES])
+    parser.add_argument('--shard', help="K/N — только пользователи с user_id % N == K (export)")
+    parser.add_argument('--fresh', action='store_true', help="начать выгрузку заново (export)")
+    parser.add_argument('--on-conflict', choices=('ignore', 'update'), default='ignore', help="(import)")
+    parser.add_argument('--new-ids', action='store_true', help="не переносить id строк (import)")
+    args = parser.parse_args()
+
+    database.init_db()
+    started = time.perf_counter()
+
+    def report(table: str, rows: int):
+        print(f"{table:<20} {rows:>12,} строк  {time.perf_counter() - started:8.1f} s")
+
+    if args.command == 'export':
+        shard = tuple(int(part) for part in args.shard.split('/')) if args.shard else None
+        counts = export_data(args.directory, args.tables, shard, args.fresh, progress=report)
+    else:
+        counts = import_data(args.directory, args.tables, args.on_conflict, args.new_ids, progress=report)
+    total, elapsed = sum(counts.values()), time.perf_counter() - started
+    print(f"Итого: {total:,} строк за {elapsed:.1f} s ({total / elapsed:,.0f} строк/с)")
@@ -2,130 +2,442 @@
 Web server для Mini App статистики
 Отдаёт данные из базы данных по API
 """
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 from flask_cors import CORS
+import json
 import sqlite3
 import os
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, date
 from pathlib import Path
 
+import database
+import leaderboard
+import telegram_auth
+
 app = Flask(__name__)
 CORS(app)  # Разрешаем CORS для Mini App
 
-DB_PATH = Path(__file__).parent / "assistant.db"
+# Кэш готовых ответов /api/stats: сколько пользователей держать и сколько секунд
+STATS_CACHE_SIZE = int(os.getenv('STATS_CACHE_SIZE', '10000'))
+STATS_CACHE_TTL = float(os.getenv('STATS_CACHE_TTL', '60'))
+# Как часто сверять версии в data_versions, чтобы сбросить изменённых ботом пользователей
+STATS_VERSION_CHECK = float(os.getenv('STATS_VERSION_CHECK', '1'))
 
 
 def get_db_connection():
-    """Подключение к БД"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+    """Подключение к БД из общего пула database.py"""
+    return database.get_connection()
+
+
+# Пользователь, счётчики user_stats, лимит XP и версии для ETag — одним запросом
+USER_STATS_SELECT = '''
+    SELECT u.user_id, u.xp, u.daily_xp, u.stats_version,
+           COALESCE(s.total_reminders, 0) AS reminders,
+           COALESCE(s.completed_reminders, 0) AS completed,
+           COALESCE(s.total_notes, 0) AS notes,
+           COALESCE(s.total_habits, 0) AS habits,
+           COALESCE(s.total_streak, 0) AS total_streak,
+           COALESCE((SELECT CAST(value AS INTEGER) FROM bot_settings WHERE key = 'daily_xp_limit'), 500)
+               AS daily_limit,
+           COALESCE((SELECT version FROM data_versions WHERE scope = 'settings'), 0) AS settings_version
+    FROM users u
+    LEFT JOIN user_stats s ON s.user_id = u.user_id
+'''
+USER_STATS_SQL = USER_STATS_SELECT + 'WHERE u.user_id = ?'
+# Для пачки ID — одним JSON-параметром, без лимита переменных SQLite
+USERS_STATS_SQL = USER_STATS_SELECT + 'WHERE u.user_id IN (SELECT value FROM json_each(?))'
+
+
+def fetch_user_stats_row(user_id: int):
+    """Строка статистики пользователя (None, если пользователя нет)"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.row_factory = sqlite3.Row
+        cursor.execute(USER_STATS_SQL, (user_id,))
+        return cursor.fetchone()
+
+
+def fetch_users_stats_rows(user_ids: list) -> list:
+    """Строки статистики нескольких пользователей (только существующих)"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.row_factory = sqlite3.Row
+        cursor.execute(USERS_STATS_SQL, (json.dumps(user_ids),))
+        return cursor.fetchall()
+
+
+def stats_etag(user_id: int, row) -> str:
+    """ETag ответа: меняется при любой записи, влияющей на статистику пользователя, и при смене настроек"""
+    return f"{user_id}-{row['stats_version']}-{row['settings_version']}"
+
+
+def build_user_stats(row) -> dict:
+    """Данные для Mini App из строки статистики"""
+    # Уровень, прогресс и звание — по общей кривой уровней (levels.py) и level_rewards
+    progress = database.get_level_table().progress(row['xp'])
+    
+    return {
+        'level': progress['level'],
+        'xp': progress['xp'],
+        'nextLevelXp': progress['next_level_xp'],
+        'progressPercent': progress['progress_percent'],
+        'reward': progress['reward'],
+        'dailyXp': row['daily_xp'],
+        'dailyLimit': row['daily_limit'],
+        'reminders': row['reminders'],
+        'completedReminders': row['completed'],
+        'notes': row['notes'],
+        'streak': row['total_streak'],
+        'habits': row['habits']
+    }
 
 
 def get_user_stats(user_id: int) -> dict:
     """Получить статистику пользователя"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Пользователь
-    cursor.execute('SELECT xp, level, daily_xp FROM users WHERE user_id = ?', (user_id,))
-    user_row = cursor.fetchone()
+    row = fetch_user_stats_row(user_id)
+    return build_user_stats(row) if row else None
+
+
+class StatsCache:
+    """
+    LRU-кэш готовых ответов /api/stats (ETag и JSON) по user_id с TTL
+    Записи бота сбрасывают кэш через версии в data_versions: раз в version_check секунд
+    сверяется общий счётчик 'user_stats', и если он вырос — вытесняются только пользователи
+    с users.stats_version больше прошлого значения. Смена настроек сбрасывает весь кэш
+    """
+
+    def __init__(self, max_size: int = STATS_CACHE_SIZE, ttl: float = STATS_CACHE_TTL,
+                 version_check: float = STATS_VERSION_CHECK):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.version_check = version_check
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._versions = None
+        self._checked_at = 0.0
+        self._generation = 0
+        self._metrics = {'hits': 0, 'misses': 0, 'expired': 0, 'evicted': 0, 'invalidated': 0, 'syncs': 0}
+
+    @property
+    def generation(self) -> int:
+        """Номер сброса: запоминается до чтения из БД и передаётся в put()"""
+        return self._generation
+
+    def sync(self):
+        """Вытеснить пользователей, чью статистику изменили после прошлой сверки"""
+        now = time.monotonic()
+        if self.version_check <= 0 or now - self._checked_at < self.version_check:
+            return
+        # Сверяет один поток; остальные не ждут и отвечают из кэша
+        if not self._sync_lock.acquire(blocking=False):
+            return
+        try:
+            self._checked_at = now
+            with get_db_connection() as conn:
+                versions = conn.execute('''
+                    SELECT COALESCE((SELECT version FROM data_versions WHERE scope = 'user_stats'), 0),
+                           COALESCE((SELECT version FROM data_versions WHERE scope = 'settings'), 0)
+                ''').fetchone()
+                changed = []
+                if self._versions is not None and versions[1] == self._versions[1] \
+                        and versions[0] != self._versions[0]:
+                    changed = [row[0] for row in conn.execute(
+                        'SELECT user_id FROM users WHERE stats_version > ?', (self._versions[0],)
+                    )]
+            if self._versions is not None and versions[1] != self._versions[1]:
+                self.invalidate()
+            elif changed:
+                self.invalidate(changed)
+            self._versions = versions
+            self._metrics['syncs'] += 1
+        finally:
+            self._sync_lock.release()
+
+    def get(self, user_id: int):
+        """(etag, body) из кэша или None"""
+        self.sync()
+        now = time.monotonic()
+        with self._lock:
+            item = self._items.get(user_id)
+            if item is not None:
+                if item[2] > now:
+                    self._items.move_to_end(user_id)
+                    self._metrics['hits'] += 1
+                    return item[0], item[1]
+                del self._items[user_id]
+                self._metrics['expired'] += 1
+            self._metrics['misses'] += 1
+            return None
+
+    def put(self, user_id: int, etag: str, body: bytes, generation: int):
+        """Положить ответ, если с момента чтения из БД кэш не сбрасывался"""
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._items[user_id] = (etag, body, time.monotonic() + self.ttl)
+            self._items.move_to_end(user_id)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                self._metrics['evicted'] += 1
+
+    def invalidate(self, user_ids=None):
+        """Сбросить указанных пользователей или весь кэш"""
+        with self._lock:
+            self._generation += 1
+            if user_ids is None:
+                self._metrics['invalidated'] += len(self._items)
+                self._items.clear()
+            else:
+                for user_id in user_ids:
+                    if self._items.pop(user_id, None) is not None:
+                        self._metrics['invalidated'] += 1
+
+    def stats(self) -> dict:
+        """Счётчики и доля попаданий"""
+        with self._lock:
+            metrics = dict(self._metrics)
+            metrics['size'] = len(self._items)
+        total = metrics['hits'] + metrics['misses']
+        metrics['hit_rate'] = metrics['hits'] / total if total else 0.0
+        return metrics
+
+
+_stats_cache = StatsCache()
+
+
+def stats_response(user_id: int):
+    """
+    Ответ /api/stats: 304, если у клиента актуальная версия (If-None-Match),
+    иначе JSON с ETag. Cache-Control: no-cache — браузер хранит ответ, но каждый раз перепроверяет
+    """
+    cached = _stats_cache.get(user_id)
+    if cached is None:
+        generation = _stats_cache.generation
+        row = fetch_user_stats_row(user_id)
+        if not row:
+            return jsonify({
+                'success': False,
+                'error': 'Пользователь не найден'
+            }), 404
+        etag = stats_etag(user_id, row)
+        body = app.json.dumps({
+            'success': True,
+            'data': build_user_stats(row)
+        })
+        _stats_cache.put(user_id, etag, body, generation)
+    else:
+        etag, body = cached
     
-    if not user_row:
-        conn.close()
-        return None
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+@app.route('/api/stats/<int:user_id>')
+def api_stats(user_id):
+    """Статистика пользователя по ID: только для него самого или админа (по initData)"""
+    _, error = verified_access(user_id)
+    if error:
+        return error
+    return stats_response(user_id)
+
+
+@app.route('/api/stats/batch', methods=['POST'])
+def api_stats_batch():
+    """
+    Статистика нескольких пользователей: {"user_ids": [...]} → {"success", "data": {id: статистика}, "missing": [...]}
+    Только для админов (по initData). Один запрос к БД на всю пачку; ответ отдаётся потоком, по пользователю за раз
+    """
+    _, error = verified_access()
+    if error:
+        return error
     
-    # Напоминания
-    cursor.execute('''
-        SELECT COUNT(*) as total, SUM(CASE WHEN is_completed THEN 1 ELSE 0 END) as completed
-        FROM reminders WHERE user_id = ?
-    ''', (user_id,))
-    rem_row = cursor.fetchone()
+    payload = request.get_json(silent=True) or {}
+    user_ids = payload.get('user_ids')
+    # bool — подкласс int: true/false не должны превращаться в ID 1 и 0
+    if not isinstance(user_ids, list) or not all(
+            isinstance(user_id, int) and not isinstance(user_id, bool) for user_id in user_ids):
+        return jsonify({'success': False, 'error': 'Нужен список user_ids из чисел'}), 400
+    user_ids = list(dict.fromkeys(user_ids))
+    if len(user_ids) > database.USERS_STATS_MAX_IDS:
+        return jsonify({
+            'success': False,
+            'error': f'Не больше {database.USERS_STATS_MAX_IDS} пользователей за запрос'
+        }), 413
     
-    # Заметки
-    cursor.execute('SELECT COUNT(*) FROM notes WHERE user_id = ?', (user_id,))
-    notes_count = cursor.fetchone()[0]
+    rows = fetch_users_stats_rows(user_ids)
     
-    # Привычки
-    cursor.execute('''
-        SELECT COUNT(*) as habits, SUM(streak) as total_streak
-        FROM habits WHERE user_id = ?
-    ''', (user_id,))
-    habit_row = cursor.fetchone()
+    def generate():
+        yield '{"success": true, "data": {'
+        found = set()
+        for i, row in enumerate(rows):
+            found.add(row['user_id'])
+            yield f'{"," if i else ""}"{row["user_id"]}": {app.json.dumps(build_user_stats(row))}'
+        yield f'}}, "missing": {json.dumps([user_id for user_id in user_ids if user_id not in found])}}}'
     
-    conn.close()
+    return Response(generate(), mimetype='application/json')
+
+
+# Сколько мест отдавать за раз в /api/leaderboard
+LEADERBOARD_MAX_LIMIT = 100
+
+
+@app.route('/api/leaderboard')
+def api_leaderboard():
+    """
+    Рейтинг по XP: ?limit=10&offset=0 — топ, ?around=<user_id>&radius=5 — окно вокруг пользователя
+    Нужна initData; окно вокруг — только своё (админу — любое)
+    """
+    _, error = verified_user_id()
+    if error:
+        return error
+    board = leaderboard.get_leaderboard()
+    try:
+        limit = min(int(request.args.get('limit', 10)), LEADERBOARD_MAX_LIMIT)
+        offset = max(int(request.args.get('offset', 0)), 0)
+        radius = min(int(request.args.get('radius', 5)), LEADERBOARD_MAX_LIMIT // 2)
+        around = request.args.get('around', type=int)
+    except ValueError:
+        return jsonify({'success': False, 'error': 'limit, offset и radius должны быть числами'}), 400
+    if around is not None:
+        _, error = verified_access(around)
+        if error:
+            return error
     
-    # Расчёт прогресса уровня
-    current_level = user_row['level']
-    current_xp = user_row['xp']
-    next_level_xp = ((current_level + 1) ** 2) * 100
-    prev_level_xp = (current_level ** 2) * 100
-    progress_percent = ((current_xp - prev_level_xp) / (next_level_xp - prev_level_xp)) * 100 if next_level_xp > prev_level_xp else 0
+    entries = board.around(around, max(radius, 0)) if around is not None else board.top(max(limit, 0), offset)
+    return jsonify({
+        'success': True,
+        'data': leaderboard.with_profiles(entries),
+        'total': len(board)
+    })
+
+
+@app.route('/api/rank/<int:user_id>')
+def api_rank(user_id):
+    """Место пользователя в рейтинге: только своё (админу — любое)"""
+    _, error = verified_access(user_id)
+    if error:
+        return error
+    board = leaderboard.get_leaderboard()
+    rank = board.rank(user_id)
+    if rank is None:
+        return jsonify({'success': False, 'error': 'Пользователь не найден'}), 404
+    return jsonify({'success': True, 'data': {'user_id': user_id, 'rank': rank, 'total': len(board)}})
+
+
+_init_data_validator = None
+
+
+def get_init_data_validator():
+    """Проверка initData с токеном бота из BOT_TOKEN (None, если токен не задан)"""
+    global _init_data_validator
+    if _init_data_validator is None:
+        token = os.getenv('BOT_TOKEN')
+        if token:
+            _init_data_validator = telegram_auth.InitDataValidator(token)
+    return _init_data_validator
+
+
+def verified_user_id() -> tuple:
+    """
+    ID пользователя из проверенной initData Mini App (заголовок X-Telegram-Init-Data или параметр tg_data)
+    Возвращает (user_id, None) или (None, ответ с ошибкой)
+    """
+    init_data = request.headers.get('X-Telegram-Init-Data') or request.args.get('tg_data', '')
+    if not init_data:
+        return None, (jsonify({'success': False, 'error': 'Нужны данные Telegram WebApp (initData)'}), 401)
     
-    # Награды
-    rewards = ['Новичок', 'Любитель', 'Пользователь', 'Активный', 'Опытный', 'Эксперт', 'Мастер', 'Профи', 'Ветеран', 'Легенда']
-    reward = rewards[min(current_level - 1, len(rewards) - 1)]
+    validator = get_init_data_validator()
+    if validator is None:
+        return None, (jsonify({'success': False, 'error': 'BOT_TOKEN не задан'}), 503)
     
-    return {
-        'level': current_level,
-        'xp': current_xp,
-        'nextLevelXp': next_level_xp,
-        'progressPercent': max(0, min(100, progress_percent)),
-        'reward': reward,
-        'dailyXp': user_row['daily_xp'],
-        'dailyLimit': 500,
-        'reminders': rem_row['total'] or 0,
-        'completedReminders': rem_row['completed'] or 0,
-        'notes': notes_count,
-        'streak': habit_row['total_streak'] or 0,
-        'habits': habit_row['habits'] or 0
-    }
+    try:
+        return validator.verify(init_data), None
+    except telegram_auth.InvalidInitData as e:
+        return None, (jsonify({'success': False, 'error': str(e)}), 401)
 
 
-@app.route('/api/stats/<int:user_id>')
-def api_stats(user_id):
-    """API для получения статистики"""
-    stats = get_user_stats(user_id)
-    
-    if stats:
-        return jsonify({
-            'success': True,
-            'data': stats
-        })
-    else:
-        return jsonify({
-            'success': False,
-            'error': 'Пользователь не найден'
-        }), 404
+def verified_access(user_id: int = None) -> tuple:
+    """
+    initData и право на данные user_id: сам пользователь или админ; без user_id — только админ
+    Возвращает (ID вызывающего, None) или (None, ответ с ошибкой)
+    """
+    caller_id, error = verified_user_id()
+    if error:
+        return None, error
+    if caller_id != user_id and not database.is_admin(caller_id):
+        message = 'Нет доступа к данным этого пользователя' if user_id is not None else 'Только для администраторов'
+        return None, (jsonify({'success': False, 'error': message}), 403)
+    return caller_id, None
 
 
 @app.route('/api/stats')
 def api_stats_current():
     """API для получения статистики текущего пользователя (из Telegram)"""
-    # Получаем данные из Telegram WebApp
-    tg_data = request.args.get('tg_data', '')
-    
-    # Для простоты возвращаем демо-данные если нет tg_data
-    if not tg_data:
-        return jsonify({
-            'success': True,
-            'data': {
-                'level': 5,
-                'xp': 450,
-                'nextLevelXp': 900,
-                'progressPercent': 50,
-                'reward': 'Опытный',
-                'dailyXp': 150,
-                'dailyLimit': 500,
-                'reminders': 12,
-                'completedReminders': 8,
-                'notes': 24,
-                'streak': 7,
-                'habits': 5
-            }
-        })
+    user_id, error = verified_user_id()
+    if error:
+        return error
+    return stats_response(user_id)
+
+
+@app.route('/api/metrics')
+def api_metrics():
+    """Метрики кэшей сервера (только для админов)"""
+    _, error = verified_access()
+    if error:
+        return error
+    return jsonify({
+        'stats_cache': _stats_cache.stats(),
+        'settings_cache': database.get_settings_cache_stats(),
+        'init_data_cache': _init_data_validator.metrics() if _init_data_validator else {}
+    })
+
+
+# Пульс фонового сервиса старше этого — сервис считается остановленным (в /readyz)
+HEARTBEAT_STALE_AFTER = float(os.getenv('HEARTBEAT_STALE_AFTER', '120'))
+
+
+@app.route('/healthz')
+def healthz():
+    """Живость: процесс отвечает и БД открывается (PRAGMA, без чтения таблиц)"""
+    try:
+        database.get_schema_version()
+    except sqlite3.Error as e:
+        return jsonify({'status': 'error', 'error': str(e)}), 503
+    return jsonify({'status': 'ok'})
+
+
+@app.route('/readyz')
+def readyz():
+    """
+    Готовность: БД доступна и схема актуальна; плюс размер БД и пульс фоновых сервисов
+    (отставание планировщика напоминаний, очередь). Таблицы пользователей не читаются
+    """
+    try:
+        schema_version = database.get_schema_version()
+        heartbeats = database.get_heartbeats()
+    except sqlite3.Error as e:
+        return jsonify({'status': 'error', 'error': str(e)}), 503
     
-    return jsonify({'success': False, 'error': 'Not implemented'})
+    for heartbeat in heartbeats.values():
+        heartbeat['stale'] = heartbeat['age_seconds'] > HEARTBEAT_STALE_AFTER
+    latest_version = database.MIGRATIONS[-1][0]
+    ready = schema_version >= latest_version
+    return jsonify({
+        'status': 'ok' if ready else 'migrating',
+        'schema_version': schema_version,
+        'latest_schema_version': latest_version,
+        **database.get_db_size(),
+        'services': heartbeats
+    }), 200 if ready else 503
 
 
 @app.route('/')
@@ -136,13 +448,16 @@ def index():
 
 
 if __name__ == '__main__':
+    # Dev-сервер Flask для локальной отладки; в production: gunicorn -c gunicorn.conf.py web_server:app
     # Инициализация БД
-    from database import init_db
-    init_db()
+    database.init_db()
     print("✅ Database initialized!")
     
     print("🚀 Запуск сервера Mini App...")
-    print("📊 API: /api/stats/<user_id>")
+    print("📊 API: /api/stats (initData), /api/stats/<user_id> (свой ID или админ)")
+    print("🏆 Рейтинг (initData): /api/leaderboard, /api/rank/<user_id>")
+    print("📈 Метрики (админ): /api/metrics")
+    print("💓 Проверки: /healthz, /readyz")
     print("🎮 Mini App: /")
     
     # Render автоматически назначает порт через переменную окружения